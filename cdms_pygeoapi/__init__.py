@@ -1,8 +1,554 @@
+import json
+from contextlib import contextmanager
+from datetime import date, datetime
+from decimal import Decimal
+
+from pygeoapi.process.base import BaseProcessor, ProcessorExecuteError
+from pygeoapi.provider.base import (
+    ProviderConnectionError,
+    ProviderInvalidDataError,
+    ProviderQueryError,
+)
 from pygeoapi.provider.postgresql import PostgreSQLProvider
+from pygeoapi.provider.tile import (
+    BaseTileProvider,
+    ProviderTileQueryError,
+    ProviderTilesetIdNotFoundError,
+)
+from pygeoapi.util import url_join
+from sqlalchemy import (
+    Date,
+    DateTime,
+    Numeric,
+    Text,
+    case,
+    cast,
+    create_engine,
+    func,
+    literal,
+    literal_column,
+    select,
+)
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.postgresql import JSON, aggregate_order_by
+from sqlalchemy.orm import Session
+
+from opencdms.utils.bulk import write_features
+from opencdms.utils.db import get_connection_string
+from opencdms.utils.limits import (
+    Limits,
+    QueryTimeoutError,
+    clamp_limit,
+    install,
+    limits_for,
+    operation,
+)
+from opencdms.utils.tiles import LAYERS, TileCache, TileService
+from opencdms.utils.units import (
+    canonical_columns,
+    canonical_records,
+    canonical_units,
+    join_units,
+)
+
+# Engines and tile services are kept between requests as pygeoapi loads
+# providers anew for every request
+_ENGINE_STORE = {}
+_TILE_SERVICE_STORE = {}
+
+
+def _get_engine(data):
+    """Return a pooled engine for a provider ``data`` connection block"""
+    key = (data.get("user"), data.get("host"), data.get("port", 5432),
+           data.get("dbname"))
+    try:
+        return _ENGINE_STORE[key]
+    except KeyError:
+        engine = create_engine(
+            get_connection_string(
+                engine="postgresql",
+                driver="psycopg2",
+                user=data.get("user"),
+                password=data.get("password"),
+                host=data.get("host"),
+                port=data.get("port", 5432),
+                db_name=data.get("dbname"),
+            ),
+            pool_pre_ping=True,
+        )
+        _ENGINE_STORE[key] = install(engine)
+        return engine
+
+
+def _isoformat(column):
+    return func.to_char(column, 'YYYY-MM-DD"T"HH24:MI:SS.US')
+
+
+def _utc_isoformat(column):
+    return func.to_char(
+        func.timezone("UTC", column), 'YYYY-MM-DD"T"HH24:MI:SS.US"+00:00"'
+    )
 
 
 class CDMSProvider(PostgreSQLProvider):
     def __init__(self, provider_def):
         super().__init__(provider_def=provider_def)
         self.conn_dic = provider_def["data"]
+        # Build GeoJSON with PostGIS instead of one Python object per row
+        self.sql_features = provider_def.get("sql_features", False)
+        # Values in the canonical units of their observed property
+        self.canonical_units = provider_def.get("canonical_units", False)
+        # Per request limits, "timeout" in seconds and "max_rows" (0 for none)
+        defaults = limits_for("query")
+        timeout = provider_def.get("timeout", defaults.statement_timeout)
+        self.limits = Limits(
+            statement_timeout=timeout or None,
+            deadline=timeout or None,
+            max_rows=provider_def.get("max_rows", defaults.max_rows) or None,
+        )
+        install(self._engine)
         self.get_fields()
+
+    @contextmanager
+    def _limited(self, name, limits=None):
+        try:
+            with operation(name, limits or self.limits) as op:
+                yield op
+        except QueryTimeoutError as err:
+            raise ProviderQueryError(str(err))
+
+    def query(self, offset=0, limit=10, resulttype='results',
+              bbox=[], datetime_=None, properties=[], sortby=[],
+              select_properties=[], skip_geometry=False, q=None,
+              filterq=None, **kwargs):
+        with self._limited("query"):
+            limit = clamp_limit(limit)
+            if not self.sql_features or resulttype == "hits":
+                collection = super().query(
+                    offset=offset, limit=limit, resulttype=resulttype,
+                    bbox=bbox, datetime_=datetime_, properties=properties,
+                    sortby=sortby, select_properties=select_properties,
+                    skip_geometry=skip_geometry, q=q, filterq=filterq,
+                    **kwargs
+                )
+                self._in_canonical_units(collection["features"])
+                return collection
+            # pygeoapi adds links to the collection, so it needs a dict.
+            # Values JSON has no type for come as text and are parsed to
+            # the types the ORM path returns.
+            collection = json.loads(self._collection_json(
+                offset=offset, limit=limit, bbox=bbox, properties=properties,
+                sortby=sortby, select_properties=select_properties,
+                skip_geometry=skip_geometry, filterq=filterq, typed=True,
+            ))
+            parsers = {
+                name: parse for name, (_, parse)
+                in self._typed_properties(select_properties).items()
+            }
+            for feature in collection["features"]:
+                values = feature["properties"]
+                for name, parse in parsers.items():
+                    if values.get(name) is not None:
+                        values[name] = parse(values[name])
+            return collection
+
+    def get(self, identifier, **kwargs):
+        with self._limited("get"):
+            feature = super().get(identifier, **kwargs)
+            self._in_canonical_units([feature])
+            return feature
+
+    def _in_canonical_units(self, features):
+        """Convert the values of features in place when ``canonical_units``"""
+        names = ["result_value", "result_uom", "observed_property_id"]
+        features = [
+            f for f in features
+            if f and all(name in f["properties"] for name in names)
+        ]
+        if not self.canonical_units or not features:
+            return
+        with self._engine.connect() as conn:
+            units = canonical_units(conn)
+        records = canonical_records(
+            [[f["properties"][name] for name in names] for f in features],
+            names, units,
+        )
+        for feature, (value, uom, _) in zip(features, records):
+            feature["properties"].update(result_value=value, result_uom=uom)
+
+    def query_json(self, offset=0, limit=10, bbox=[], properties=[],
+                   sortby=[], select_properties=[], skip_geometry=False,
+                   filterq=None):
+        """
+        Return a page of features as GeoJSON FeatureCollection text built by
+        PostgreSQL with ST_AsGeoJSON and json_agg, ready to be sent as is.
+        """
+        return self._collection_json(
+            offset=offset, limit=limit, bbox=bbox, properties=properties,
+            sortby=sortby, select_properties=select_properties,
+            skip_geometry=skip_geometry, filterq=filterq
+        )
+
+    def _page_columns(self):
+        table = self.table_model.__table__
+        if self.canonical_units:
+            return canonical_columns(table), join_units(table)
+        return list(table.c), table
+
+    def _typed_properties(self, select_properties):
+        """
+        Selected properties the ORM path returns as ``Decimal``, ``datetime``
+        or ``date``, by name: a function rendering the column as JSON text
+        and a parser of that text
+        """
+        types = {column.name: column.type for column in self._page_columns()[0]}
+        typed = {}
+        for name in self._selected_property_names(select_properties):
+            type_ = types[name]
+            if isinstance(type_, Numeric) and type_.asdecimal:
+                typed[name] = (lambda c: cast(c, Text), Decimal)
+            elif isinstance(type_, DateTime) and type_.timezone:
+                typed[name] = (_utc_isoformat, datetime.fromisoformat)
+            elif isinstance(type_, DateTime):
+                typed[name] = (_isoformat, datetime.fromisoformat)
+            elif isinstance(type_, Date):
+                typed[name] = (lambda c: cast(c, Text), date.fromisoformat)
+        return typed
+
+    def _collection_json(self, offset, limit, bbox, properties, sortby,
+                         select_properties, skip_geometry, filterq,
+                         typed=False):
+        order_by = self._get_order_by_clauses(sortby, self.table_model)
+        columns, source = self._page_columns()
+        page = (
+            select(
+                *columns,
+                func.row_number().over(order_by=order_by).label("_position"),
+            )
+            .select_from(source)
+            .filter(self._get_property_filters(properties))
+            .filter(self._get_cql_filters(filterq))
+            .filter(self._get_bbox_filter(bbox))
+            .order_by(*order_by)
+            .offset(offset)
+            .limit(limit)
+            .subquery("page")
+        )
+
+        names = self._selected_property_names(select_properties)
+        as_text = {
+            name: render for name, (render, _)
+            in self._typed_properties(select_properties).items()
+        } if typed else {}
+        values = [
+            (literal(name), as_text[name](page.c[name]) if name in as_text
+             else page.c[name])
+            for name in names
+        ]
+        properties_json = func.json_build_object(
+            *[arg for value in values for arg in value]
+        )
+        if skip_geometry:
+            geometry = literal_column("NULL::json")
+        else:
+            # Like the ORM path, a missing geometry stays in the properties
+            properties_json = case(
+                (page.c[self.geom].is_(None), func.json_build_object(
+                    *[arg for value in values for arg in value],
+                    literal(self.geom), literal_column("NULL::json"),
+                )),
+                else_=properties_json,
+            )
+            geometry = cast(func.ST_AsGeoJSON(page.c[self.geom], 15), JSON)
+        feature = func.json_build_object(
+            literal("type"), literal("Feature"),
+            literal("properties"), properties_json,
+            literal("id"), page.c[self.id_field],
+            literal("geometry"), geometry,
+        )
+        collection = func.json_build_object(
+            literal("type"), literal("FeatureCollection"),
+            literal("features"), func.coalesce(
+                func.json_agg(
+                    aggregate_order_by(feature, page.c._position)
+                ),
+                literal_column("'[]'::json"),
+            ),
+        )
+
+        with Session(self._engine) as session:
+            return session.execute(select(cast(collection, Text))).scalar()
+
+    def create(self, item):
+        """Create one observation through the bulk write path"""
+        try:
+            feature = json.loads(item)
+        except (TypeError, ValueError):
+            raise ProviderInvalidDataError("Invalid JSON data")
+        result = self.transaction([feature], all_or_nothing=True)
+        if result.errors:
+            raise ProviderInvalidDataError("; ".join(result.errors[0]))
+        return result.ids[0]
+
+    def transaction(self, features, on_conflict="error", all_or_nothing=False):
+        """
+        Validate and write many observation features in a single database
+        transaction, returning a ``BulkResult`` with per feature ids and
+        errors.
+        """
+        with self._limited("write", limits_for("write")):
+            with self._engine.begin() as conn:
+                return write_features(
+                    conn, features, on_conflict=on_conflict,
+                    all_or_nothing=all_or_nothing
+                )
+
+    def _selected_property_names(self, select_properties):
+        """Property columns of a feature, in table order"""
+        names = set(select_properties or self.fields.keys())
+        if self.properties:
+            names &= set(self.properties)
+        return [
+            column.name for column in self.table_model.__table__.columns
+            if column.name in names
+            and column.name not in (self.id_field, self.geom)
+        ]
+
+
+class CDMSTileProvider(BaseTileProvider):
+    """
+    Vector tiles of hosts and observations rendered by PostGIS and kept in a
+    z/x/y cache that is invalidated as observations change.
+
+    ``options`` may contain ``layers``, ``observed_property_ids``,
+    ``period`` (only show observations from the last ``period`` seconds),
+    ``cache_path`` (cache on disk instead of in memory), ``max_tiles``,
+    ``max_age`` (seconds a cached tile is kept), ``check_interval`` (seconds
+    between checks for changed observations) and ``window_interval``
+    (seconds before tiles of the ``period`` window are rendered again).
+    """
+
+    def __init__(self, provider_def):
+        super().__init__(provider_def)
+        self.options = {
+            "schemes": ["WebMercatorQuad"],
+            "zoom": {"min": 0, "max": 16},
+            "metadata_format": "tilejson",
+            **(self.options or {}),
+        }
+        self.layers = self.options.get("layers", list(LAYERS))
+        self.observed_property_ids = self.options.get("observed_property_ids")
+        self.period = self.options.get("period")
+        self._service_url = None
+        self.service = self._get_service()
+
+    def __repr__(self):
+        return f"<CDMSTileProvider> {self.layers}"
+
+    def _get_service(self):
+        key = (
+            self.data.get("host"), self.data.get("port", 5432),
+            self.data.get("dbname"), self.options.get("cache_path"),
+        )
+        try:
+            return _TILE_SERVICE_STORE[key]
+        except KeyError:
+            engine = _get_engine(self.data)
+            cache = TileCache(
+                path=self.options.get("cache_path"),
+                max_tiles=self.options.get("max_tiles", 10000),
+                max_age=self.options.get("max_age"),
+            )
+            service = TileService(
+                engine, cache, self.options.get("check_interval", 30),
+                self.options.get("window_interval", 60),
+            )
+            _TILE_SERVICE_STORE[key] = service
+            return service
+
+    def get_layer(self):
+        return "-".join(self.layers)
+
+    def get_fields(self):
+        return {
+            column: {"type": "string"}
+            for name in self.layers for column in LAYERS[name]["columns"]
+        }
+
+    def get_tiling_schemes(self):
+        return [{
+            "tileMatrixSet": "WebMercatorQuad",
+            "tileMatrixSetURI": "http://schemas.opengis.net/tms/1.0/json/examples/WebMercatorQuad.json",  # noqa
+            "crs": "http://www.opengis.net/def/crs/EPSG/0/3857"
+        }]
+
+    def get_tiles_service(self, baseurl=None, servicepath=None,
+                          dirpath=None, tile_type=None):
+        if servicepath.startswith(baseurl):
+            self._service_url = servicepath
+        else:
+            self._service_url = url_join(baseurl, servicepath)
+        metadata_url = self._service_url.split(
+            "{tileMatrix}/{tileRow}/{tileCol}")[0] + "metadata"
+        return {
+            "links": [
+                {
+                    "type": "application/json",
+                    "rel": "self",
+                    "title": "This collection as multi vector tilesets",
+                    "href": self._service_url,
+                },
+                {
+                    "type": self.mimetype,
+                    "rel": "item",
+                    "title": "This collection as multi vector tiles",
+                    "href": self._service_url,
+                },
+                {
+                    "type": "application/json",
+                    "rel": "describedby",
+                    "title": "Collection metadata in TileJSON format",
+                    "href": f"{metadata_url}?f=json",
+                },
+            ]
+        }
+
+    def get_tiles(self, layer=None, tileset=None,
+                  z=None, y=None, x=None, format_=None):
+        if tileset not in self.options["schemes"]:
+            raise ProviderTilesetIdNotFoundError(f"Unknown tileset {tileset}")
+        try:
+            z, y, x = int(z), int(y), int(x)
+        except (TypeError, ValueError):
+            raise ProviderTileQueryError(f"Invalid tile {z}/{y}/{x}")
+        if not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+            raise ProviderTileQueryError(f"Invalid tile {z}/{y}/{x}")
+
+        try:
+            with operation("tiles"):
+                return self.service.get_tile(
+                    z, x, y,
+                    period=self.period,
+                    layers=tuple(self.layers),
+                    observed_property_ids=self.observed_property_ids,
+                )
+        except QueryTimeoutError as err:
+            raise ProviderQueryError(str(err))
+        except OperationalError as err:
+            raise ProviderConnectionError(err)
+
+    def get_metadata(self, dataset, server_url, layer=None,
+                     tileset=None, tilejson=True, **kwargs):
+        tiles_url = url_join(
+            server_url,
+            f"collections/{dataset}/tiles/{tileset}/"
+            "{tileMatrix}/{tileRow}/{tileCol}?f=mvt"
+        )
+        return {
+            "tilejson": "3.0.0",
+            "name": dataset,
+            "tiles": tiles_url,
+            "minzoom": self.options["zoom"]["min"],
+            "maxzoom": self.options["zoom"]["max"],
+            "bounds": [-180, -85.0511287798, 180, 85.0511287798],
+            "vector_layers": [
+                {
+                    "id": name,
+                    "fields": {
+                        column: "" for column in LAYERS[name]["columns"]
+                    },
+                }
+                for name in self.layers
+            ],
+        }
+
+
+TRANSACTION_PROCESS_METADATA = {
+    "version": "0.1.0",
+    "id": "cdms-transaction",
+    "title": {"en": "Bulk observation transaction"},
+    "description": {
+        "en": "Validates a FeatureCollection of observations and writes "
+              "them in a single transaction, returning the id or errors of "
+              "each feature."
+    },
+    "keywords": ["cdms", "observation", "transaction"],
+    "links": [],
+    "inputs": {
+        "features": {
+            "title": "Observations",
+            "description": "GeoJSON FeatureCollection of observations",
+            "schema": {"type": "object",
+                       "contentMediaType": "application/geo+json"},
+            "minOccurs": 1,
+            "maxOccurs": 1,
+        },
+        "on_conflict": {
+            "title": "On conflict",
+            "description": "What to do with existing ids: error, skip or "
+                           "update",
+            "schema": {"type": "string",
+                       "enum": ["error", "skip", "update"]},
+            "minOccurs": 0,
+            "maxOccurs": 1,
+        },
+        "all_or_nothing": {
+            "title": "All or nothing",
+            "description": "Write nothing if any feature is invalid",
+            "schema": {"type": "boolean"},
+            "minOccurs": 0,
+            "maxOccurs": 1,
+        },
+    },
+    "outputs": {
+        "result": {
+            "title": "Per feature result",
+            "schema": {"type": "object",
+                       "contentMediaType": "application/json"},
+        }
+    },
+    "example": {
+        "inputs": {
+            "features": {"type": "FeatureCollection", "features": []},
+            "on_conflict": "error",
+        }
+    },
+}
+
+
+class CDMSTransactionProcessor(BaseProcessor):
+    """Bulk create of observations from a FeatureCollection"""
+
+    def __init__(self, processor_def):
+        super().__init__(processor_def, TRANSACTION_PROCESS_METADATA)
+        self.data = processor_def["data"]
+
+    def execute(self, data):
+        collection = data.get("features")
+        if not isinstance(collection, dict) or \
+                collection.get("type") != "FeatureCollection":
+            raise ProcessorExecuteError("features must be a FeatureCollection")
+        on_conflict = data.get("on_conflict", "error")
+        if on_conflict not in ("error", "skip", "update"):
+            raise ProcessorExecuteError(f"Invalid on_conflict: {on_conflict}")
+
+        try:
+            with operation("write"), _get_engine(self.data).begin() as conn:
+                result = write_features(
+                    conn, collection.get("features") or [],
+                    on_conflict=on_conflict,
+                    all_or_nothing=bool(data.get("all_or_nothing", False)),
+                )
+        except QueryTimeoutError as err:
+            raise ProcessorExecuteError(str(err))
+        return "application/json", {
+            "id": "result",
+            "value": {
+                "inserted": result.inserted,
+                "failed": len(result.errors),
+                "features": result.as_features(),
+            },
+        }
+
+    def __repr__(self):
+        return f"<CDMSTransactionProcessor> {self.name}"
@@ -1,9 +1,28 @@
 """Console script for opencdms."""
 import pathlib
+from datetime import timedelta
 import sys
 import click
 import yaml
-from opencdms.utils import seeder
+from sqlalchemy import create_engine, text
+from opencdms.utils import (
+    archive,
+    changefeed,
+    compact,
+    hierarchy,
+    hotqueries,
+    ids,
+    ingest,
+    latest,
+    normals,
+    precision,
+    reports,
+    seeder,
+    sync,
+    tiles,
+)
+from opencdms.utils.db import get_cdm_connection_string
+from opencdms.utils.export import DEFAULT_BATCH_SIZE, FORMATS, export
 
 @click.group()
 def main(args=None):
@@ -26,6 +45,354 @@ def clear_db():
     seeder.down()
     click.echo("Successfully cleared database")
 
+@click.command(name="export")
+@click.argument("output", type=click.File("w", encoding="utf-8", lazy=False))
+@click.option("--format", "fmt", type=click.Choice(list(FORMATS)), default="csv")
+@click.option("--start", type=click.DateTime(), help="Earliest phenomenon_end")
+@click.option("--end", type=click.DateTime(), help="Exclusive latest phenomenon_end")
+@click.option("--host", "host_ids", multiple=True, help="Host id, may be repeated")
+@click.option("--property", "observed_property_ids", type=int, multiple=True,
+              help="Observed property id, may be repeated")
+@click.option("--collection", "collection_ids", multiple=True,
+              help="Collection id, may be repeated")
+@click.option("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+@click.option("--canonical-units", "canonical", is_flag=True,
+              help="Convert values to the units of their observed property")
+def export_observations(output, fmt, start, end, host_ids, observed_property_ids,
+                        collection_ids, batch_size, canonical):
+    """
+    Streams observations to OUTPUT as CSV or newline delimited GeoJSON.
+    Use - for standard output.
+    """
+    db_engine = create_engine(get_cdm_connection_string())
+    with db_engine.connect() as conn:
+        export(
+            conn,
+            output,
+            format=fmt,
+            batch_size=batch_size,
+            canonical=canonical,
+            start=start,
+            end=end,
+            host_ids=host_ids or None,
+            observed_property_ids=observed_property_ids or None,
+            collection_ids=collection_ids or None,
+        )
+
+
+@click.command(name="archive")
+@click.option("--before", type=click.DateTime(), required=True,
+              help="Archive observations with an earlier phenomenon_end")
+@click.option("--path", help="Archive directory, defaults to CDM_ARCHIVE_PATH")
+@click.option("--batch-size", type=int, default=archive.DEFAULT_BATCH_SIZE)
+def archive_observations(before, path, batch_size):
+    """
+    Moves old observations into monthly Parquet partitions and deletes them
+    from the database in batches.
+    """
+    db_engine = create_engine(get_cdm_connection_string())
+    moved = archive.archive_observations(db_engine, before, path, batch_size)
+    click.echo(f"Archived {moved} observations")
+
+
+@click.command(name="compact-storage")
+@click.option("--disable", is_flag=True, help="Restore the JSON columns instead")
+@click.option("--batch-size", type=int, default=compact.DEFAULT_BATCH_SIZE)
+def compact_storage(disable, batch_size):
+    """
+    Stores QC flags as bitmasks and parameters in a lookup table, reporting
+    table size and flag scan time before and after.
+    """
+    db_engine = create_engine(get_cdm_connection_string())
+    with db_engine.connect() as conn:
+        before = compact.storage_report(conn)
+    if disable:
+        rows = compact.disable(db_engine, batch_size)
+    else:
+        rows = compact.enable(db_engine, batch_size)
+    with db_engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").execute(
+            text("VACUUM (ANALYZE) cdm.observation")
+        )
+        after = compact.storage_report(conn)
+    click.echo(f"Rewrote {rows} observations")
+    for name in before:
+        click.echo(f"{name}: {before[name]} -> {after[name]}")
+    click.echo("Space freed by VACUUM is reused, VACUUM FULL returns it to the OS")
+
+
+@click.command(name="id-defaults")
+@click.option("--uninstall", is_flag=True, help="Remove the defaults instead")
+def id_defaults(uninstall):
+    """ Fills observation, host and source ids with UUIDv7 in the database"""
+    db_engine = create_engine(get_cdm_connection_string())
+    with db_engine.begin() as conn:
+        if uninstall:
+            ids.uninstall(conn)
+        else:
+            ids.install(conn)
+    click.echo(f"Id defaults {'removed' if uninstall else 'installed'}")
+
+
+@click.command(name="benchmark-ids")
+@click.option("--rows", type=int, default=1_000_000)
+@click.option("--batch-size", type=int, default=10000)
+def benchmark_ids(rows, batch_size):
+    """
+    Compares insert throughput and primary key index size of random and
+    time ordered ids stored as text and as uuid.
+    """
+    db_engine = create_engine(get_cdm_connection_string())
+    for name, result in ids.benchmark(db_engine, rows, batch_size).items():
+        click.echo(
+            f"{name}: {result['rows_per_second']:.0f} rows/s, "
+            f"index {result['index_bytes'] / 2 ** 20:.1f} MiB"
+        )
+
+
+@click.command(name="benchmark-hot-queries")
+@click.option("--calls", type=int, default=1000)
+def benchmark_hot_queries(calls):
+    """
+    Compares the time per call of the registered hot queries compiled every
+    time, from the compiled cache and as prepared statements.
+    """
+    db_engine = create_engine(get_cdm_connection_string())
+    with db_engine.connect() as conn:
+        params = hotqueries.benchmark_params(conn)
+    if params is None:
+        raise click.ClickException("No observations to benchmark with")
+    for name, timings in hotqueries.benchmark(db_engine, params, calls).items():
+        click.echo(
+            f"{name}: " + ", ".join(f"{mode} {us:.0f} us" for mode, us in timings.items())
+        )
+
+
+@click.command(name="migrate-double-precision")
+@click.option("--batch-size", type=int, default=precision.DEFAULT_BATCH_SIZE)
+@click.option("--pause", type=float, default=0.0,
+              help="Seconds to wait between batches")
+def migrate_double_precision(batch_size, pause):
+    """
+    Converts result_value and the elevation columns to double precision
+    without long locks. Set CDM_DB_DOUBLE_PRECISION afterwards.
+    """
+    db_engine = create_engine(get_cdm_connection_string())
+    for result in precision.migrate(db_engine, batch_size=batch_size, pause=pause):
+        if result.skipped:
+            click.echo(f"{result.table}.{result.column}: already double precision")
+        else:
+            click.echo(
+                f"{result.table}.{result.column}: {result.rows} rows "
+                f"in {result.seconds:.1f}s"
+            )
+
+
+@click.command(name="ingest")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option("--format", "fmt", type=click.Choice(["csv", "geojson"]), default="csv")
+@click.option("--workers", type=int, help="Parse processes, defaults to CPU count")
+@click.option("--writers", type=int, default=2, help="Writer connections")
+@click.option("--queue-size", type=int, default=4, help="Chunks between stages")
+@click.option("--chunk-size", type=int, default=ingest.DEFAULT_CHUNK_SIZE)
+@click.option("--on-conflict", type=click.Choice(["error", "skip", "update"]),
+              default="error")
+def ingest_observations(paths, fmt, workers, writers, queue_size, chunk_size,
+                        on_conflict):
+    """
+    Loads observations from CSV or newline delimited GeoJSON files with
+    parallel parsing and COPY writers, reporting throughput as it goes.
+    """
+    reader = ingest.csv_chunks if fmt == "csv" else ingest.geojsonseq_chunks
+
+    def progress(result):
+        _, parse_depth, write_depth = result.queue_depths[-1]
+        click.echo(
+            f"{result.seconds:.0f}s read {result.rows_read} "
+            f"written {result.rows_written} ({result.rows_per_second:.0f}/s) "
+            f"queues {parse_depth}/{write_depth}",
+            err=True,
+        )
+
+    result = ingest.ingest(
+        reader(paths, chunk_size),
+        workers=workers,
+        writers=writers,
+        queue_size=queue_size,
+        on_conflict=on_conflict,
+        sample_interval=5.0,
+        progress=progress,
+    )
+    for name, stage in result.stages.items():
+        click.echo(f"{name}: {stage.chunks} chunks, {stage.rows} rows, "
+                   f"{stage.busy_seconds:.1f}s busy")
+    click.echo(f"Wrote {result.rows_written}, rejected {result.rows_rejected} "
+               f"in {result.seconds:.1f}s")
+    for chunk, row, messages in result.errors[:20]:
+        click.echo(f"chunk {chunk} row {row}: {'; '.join(messages)}", err=True)
+
+
+@click.command(name="change-feed")
+@click.option("--uninstall", is_flag=True, help="Remove the trigger instead")
+def change_feed(uninstall):
+    """ Installs the trigger notifying observation changes"""
+    db_engine = create_engine(get_cdm_connection_string())
+    if not uninstall:
+        changefeed.install_indexes(db_engine)
+    with db_engine.begin() as conn:
+        if uninstall:
+            changefeed.uninstall(conn)
+        else:
+            changefeed.install(conn)
+    click.echo(f"Change feed {'removed' if uninstall else 'installed'}")
+
+
+@click.command(name="tile-changes")
+@click.option("--uninstall", is_flag=True, help="Remove the table and triggers")
+def tile_changes(uninstall):
+    """ Records where observations and hosts moved from, for tile caches"""
+    db_engine = create_engine(get_cdm_connection_string())
+    if not uninstall:
+        tiles.install_indexes(db_engine)
+    with db_engine.begin() as conn:
+        if uninstall:
+            tiles.uninstall(conn)
+        else:
+            tiles.install(conn)
+    click.echo(f"Tile changes {'removed' if uninstall else 'installed'}")
+
+
+@click.command(name="feature-closure")
+@click.option("--uninstall", is_flag=True, help="Remove the table and triggers")
+@click.option("--rebuild", is_flag=True, help="Recompute the table only")
+def feature_closure(uninstall, rebuild):
+    """ Maintains the closure table of the feature hierarchy"""
+    db_engine = create_engine(get_cdm_connection_string())
+    if not uninstall and not rebuild:
+        hierarchy.install_indexes(db_engine)
+    with db_engine.begin() as conn:
+        if uninstall:
+            hierarchy.uninstall(conn)
+        elif rebuild:
+            hierarchy.rebuild(conn)
+        else:
+            hierarchy.install(conn)
+    click.echo(
+        "Feature closure "
+        + ("removed" if uninstall else "rebuilt" if rebuild else "installed")
+    )
+
+
+@click.command(name="latest-observation")
+@click.option("--uninstall", is_flag=True, help="Remove the table and triggers")
+@click.option("--rebuild", is_flag=True, help="Recompute the table only")
+def latest_observation(uninstall, rebuild):
+    """ Maintains the latest observation of every host and property"""
+    db_engine = create_engine(get_cdm_connection_string())
+    if not uninstall and not rebuild:
+        latest.install_indexes(db_engine)
+    with db_engine.begin() as conn:
+        if uninstall:
+            latest.uninstall(conn)
+        elif rebuild:
+            latest.rebuild(conn)
+        else:
+            latest.install(conn)
+    click.echo(
+        "Latest observations "
+        + ("removed" if uninstall else "rebuilt" if rebuild else "installed")
+    )
+
+
+@click.command(name="climate-normals")
+@click.option("--period", type=click.Choice(list(normals.PERIODS)), default="month")
+@click.option("--base-start", type=int, default=normals.DEFAULT_BASE[0],
+              help="First year of the base period")
+@click.option("--base-end", type=int, default=normals.DEFAULT_BASE[1],
+              help="Last year of the base period")
+@click.option("--host", "host_ids", multiple=True,
+              help="Host id, may be repeated, defaults to all hosts")
+@click.option("--property", "observed_property_ids", type=int, multiple=True,
+              help="Observed property id, may be repeated")
+@click.option("--min-years", type=int, help="Defaults to 80% of the base period")
+@click.option("--workers", type=int, help="Processes, defaults to CPU count")
+@click.option("--hosts-per-task", type=int, default=normals.DEFAULT_HOSTS_PER_TASK)
+@click.option("--uninstall", is_flag=True, help="Remove the normals table instead")
+def climate_normals(period, base_start, base_end, host_ids, observed_property_ids,
+                    min_years, workers, hosts_per_task, uninstall):
+    """ Computes climate normals into cdm.climate_normal"""
+    db_engine = create_engine(get_cdm_connection_string())
+    with db_engine.begin() as conn:
+        if uninstall:
+            normals.uninstall(conn)
+        else:
+            normals.install(conn)
+    if uninstall:
+        click.echo("Climate normals removed")
+        return
+    results = normals.run_normals(
+        host_ids=host_ids or None,
+        period=period,
+        base=(base_start, base_end),
+        observed_property_ids=observed_property_ids or None,
+        min_years=min_years,
+        workers=workers,
+        hosts_per_task=hosts_per_task,
+    )
+    click.echo(
+        f"{sum(r.normals for r in results)} normals of "
+        f"{sum(r.series for r in results)} series"
+    )
+
+
+@click.command(name="sync")
+@click.argument("source_url")
+@click.option("--name", "source_name", required=True,
+              help="Name the watermarks of this source are stored under")
+@click.option("--batch-size", type=int, default=sync.DEFAULT_BATCH_SIZE)
+@click.option("--overlap", type=float, default=0.0,
+              help="Seconds re-read below the watermarks")
+def sync_db(source_url, source_name, batch_size, overlap):
+    """
+    Copies host, observer, source, collection and observation rows changed
+    since the last run from SOURCE_URL into the configured database.
+    """
+    result = sync.sync(
+        create_engine(source_url),
+        create_engine(get_cdm_connection_string()),
+        source_name,
+        batch_size=batch_size,
+        overlap=timedelta(seconds=overlap),
+    )
+    for table_name, rows in result.rows.items():
+        click.echo(f"{table_name}: {rows} rows")
+
+
+@click.command(name="export-reports")
+@click.argument("output", type=click.File("w", encoding="utf-8", lazy=False))
+@click.option("--start", type=click.DateTime(), help="Earliest phenomenon_end")
+@click.option("--end", type=click.DateTime(), help="Exclusive latest phenomenon_end")
+@click.option("--host", "host_ids", multiple=True, help="Host id, may be repeated")
+@click.option("--property", "observed_property_ids", type=int, multiple=True,
+              help="Observed property id, may be repeated, default all")
+@click.option("--chunk-size", type=int, default=reports.DEFAULT_CHUNK_SIZE)
+def export_reports(output, start, end, host_ids, observed_property_ids, chunk_size):
+    """
+    Streams one CSV row per report_id with a column per observed property.
+    """
+    db_engine = create_engine(get_cdm_connection_string())
+    with db_engine.connect() as conn:
+        reports.export_reports(
+            conn,
+            output,
+            observed_property_ids or None,
+            chunk_size,
+            start=start,
+            end=end,
+            host_ids=host_ids or None,
+        )
+
+
 @click.command(name="relocate-schema")
 @click.argument("filepath")
 @click.argument("resource")
@@ -73,6 +440,21 @@ def relocate_schema(filepath, resource):
 main.add_command(relocate_schema)
 main.add_command(seed_db)
 main.add_command(clear_db)
+main.add_command(export_observations)
+main.add_command(export_reports)
+main.add_command(archive_observations)
+main.add_command(change_feed)
+main.add_command(tile_changes)
+main.add_command(latest_observation)
+main.add_command(feature_closure)
+main.add_command(climate_normals)
+main.add_command(compact_storage)
+main.add_command(id_defaults)
+main.add_command(benchmark_ids)
+main.add_command(benchmark_hot_queries)
+main.add_command(migrate_double_precision)
+main.add_command(ingest_observations)
+main.add_command(sync_db)
 
 if __name__ == "__main__":
     sys.exit(main())  # pragma: no cover
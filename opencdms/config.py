@@ -10,4 +10,25 @@ class OpenCDMSConfig:
     CDM_DB_NAME = os.getenv("CDM_DB_NAME", "postgres")
     CDM_DB_ENGINE = os.getenv("CDM_DB_ENGINE", "postgresql")
     CDM_DB_DRIVER = os.getenv("CDM_DB_DRIVER", "psycopg2")
+    # Comma separated host:port list of read replicas, empty to disable
+    CDM_DB_REPLICAS = os.getenv("CDM_DB_REPLICAS", "")
+    # round_robin or least_load
+    CDM_DB_REPLICA_STRATEGY = os.getenv("CDM_DB_REPLICA_STRATEGY", "round_robin")
+    # Replicas lagging more than this many seconds are not used
+    CDM_DB_REPLICA_MAX_LAG = float(os.getenv("CDM_DB_REPLICA_MAX_LAG", 30))
+    # Seconds a statement may run inside an operation (opencdms.utils.limits),
+    # 0 for no limit
+    CDM_DB_STATEMENT_TIMEOUT = float(os.getenv("CDM_DB_STATEMENT_TIMEOUT", 30))
+    # Per operation overrides of the timeout, e.g. "query=10,export=0"
+    CDM_DB_OPERATION_TIMEOUTS = os.getenv("CDM_DB_OPERATION_TIMEOUTS", "")
+    # Rows a single request may return, 0 for no limit
+    CDM_DB_MAX_ROWS = int(os.getenv("CDM_DB_MAX_ROWS", 100000))
+    # Directory of the Parquet observation archive, empty to disable
+    CDM_ARCHIVE_PATH = os.getenv("CDM_ARCHIVE_PATH", "")
+    # result_value and elevation columns are double precision instead of numeric
+    CDM_DB_DOUBLE_PRECISION = os.getenv("CDM_DB_DOUBLE_PRECISION", "").lower() in (
+        "1",
+        "true",
+        "yes",
+    )
 config = OpenCDMSConfig()
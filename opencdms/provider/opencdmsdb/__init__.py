@@ -32,14 +32,22 @@ from sqlalchemy import (
     String,
     Table
 )
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION, JSONB
 from sqlalchemy.orm import registry, relationship
 
+from opencdms.config import config
 from opencdms.models import cdm
 
 
 mapper_registry = registry()
 
+# Type of result_value and the elevation columns. Set CDM_DB_DOUBLE_PRECISION
+# once they are double precision (see opencdms.utils.precision) so they are
+# read as floats rather than Decimal.
+MEASUREMENT_TYPE = (
+    DOUBLE_PRECISION(asdecimal=False) if config.CDM_DB_DOUBLE_PRECISION else Numeric
+)
+
 
 observation_type = Table(
     "observation_type",
@@ -125,7 +133,7 @@ host = Table(
     Column("description", String, comment="Description of host", index=False),
     Column("links", JSONB, comment="URI to host, e.g. to OSCAR/Surface", index=False),
     Column("location", Geography(geometry_type="POINT",srid=4326), comment="Location of station", index=False),
-    Column("elevation", Numeric, comment="Elevation of station above mean sea level", index=False),
+    Column("elevation", MEASUREMENT_TYPE, comment="Elevation of station above mean sea level", index=False),
     Column("wigos_station_identifier", String, comment="WIGOS station identifier", index=False),
     Column("facility_type", String, comment="Type of observing facility, fixed land, mobile sea, etc", index=False),
     Column("date_established", DateTime(timezone=True), comment="Date host was first established", index=False),
@@ -152,7 +160,7 @@ observer = Table(
     Column("description", String, comment="Description of sensor", index=False),
     Column("links", JSONB, comment="Link(s) to further information", index=False),
     Column("location", Geography(geometry_type="POINT",srid=4326), comment="Location of observer", index=False),
-    Column("elevation", Numeric, comment="Elevation of observer above mean sea level", index=False),
+    Column("elevation", MEASUREMENT_TYPE, comment="Elevation of observer above mean sea level", index=False),
     Column("manufacturer", String, comment="Make, or manufacturer, of sensor", index=False),
     Column("model", String, comment="Model of sensor", index=False),
     Column("serial_number", String, comment="Serial number of sensor", index=False),
@@ -179,7 +187,7 @@ feature = Table(
     Column("id", String, comment="ID / primary key", primary_key=True, index=False),
     Column("type_id",ForeignKey("cdm.feature_type.id"), comment="enumerated feature type", index=False),
     Column("geometry", Geography(geometry_type="POINT",srid=4326), comment="", index=False),
-    Column("elevation", Numeric, comment="Elevation of feature above mean sea level", index=False),
+    Column("elevation", MEASUREMENT_TYPE, comment="Elevation of feature above mean sea level", index=False),
     Column("parent_id",ForeignKey("cdm.feature.id"), comment="Parent feature for this feature if nested", index=False),
     Column("name", String, comment="Name of feature", index=False),
     Column("description", String, comment="Description of feature", index=False),
@@ -214,11 +222,11 @@ observation = Table(
     mapper_registry.metadata,
     Column("id", String, comment="ID / primary key", primary_key=True, index=False),
     Column("location", Geography(geometry_type="POINT",srid=4326, spatial_index=True), comment="Location of observation"),
-    Column("elevation", Numeric, comment="Elevation of observation above mean sea level", index=False),
+    Column("elevation", MEASUREMENT_TYPE, comment="Elevation of observation above mean sea level", index=False),
     Column("observation_type_id",ForeignKey("cdm.observation_type.id"), comment="Type of observation", index=True),
     Column("phenomenon_start", DateTime(timezone=True), comment="Start time of the phenomenon being observed or observing period, if missing assumed instantaneous with time given by phenomenon_end", index=False),
     Column("phenomenon_end", DateTime(timezone=True), comment="End time of the phenomenon being observed or observing period", index=True),
-    Column("result_value", Numeric, comment="The value of the result in float representation", index=False),
+    Column("result_value", MEASUREMENT_TYPE, comment="The value of the result in float representation", index=False),
     Column("result_uom", String, comment="Units used to represent the value being observed", index=False),
     Column("result_description", String, comment="str representation of the result if applicable", index=False),
     Column("result_quality", JSONB, comment="JSON representation of the result quality, key / value pairs", index=False),
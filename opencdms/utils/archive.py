@@ -0,0 +1,491 @@
+"""
+Cold storage of old observations in Parquet files partitioned by month,
+read back together with the rows still in ``cdm.observation``.
+"""
+import hashlib
+import json
+import math
+import os
+import re
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+from geoalchemy2 import Geometry
+from sqlalchemy import DateTime, Integer, Numeric, cast, func, select, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.engine import Engine
+
+from opencdms.config import config
+from opencdms.provider.opencdmsdb import observation
+from opencdms.utils.compact import READ_EXPRESSIONS, is_enabled, source_table
+from opencdms.utils.query import observation_query
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - pyarrow is optional
+    pa = None
+
+DEFAULT_BATCH_SIZE = 50000
+
+PROPERTY_COLUMNS = [c for c in observation.c if c.name != "location"]
+COLUMNS = [c.name for c in PROPERTY_COLUMNS] + ["longitude", "latitude"]
+JSON_COLUMNS = [c.name for c in PROPERTY_COLUMNS if isinstance(c.type, JSONB)]
+
+_PARTITION = re.compile(r"^year=(\d{4})$|^month=(\d{1,2})$")
+
+# Files of a batch whose delete has not committed yet. The leading
+# underscore hides them from Arrow datasets, so readers never see them.
+_PENDING = "_pending-"
+
+# Ids looked up in the database at a time
+_ID_BATCH_SIZE = 10000
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError(
+            "pyarrow is required for the observation archive, "
+            'install it with pip install "opencdms[archive]"'
+        )
+
+
+def archive_root(root: Optional[str] = None) -> Optional[str]:
+    """The archive directory, ``CDM_ARCHIVE_PATH`` unless given"""
+    root = config.CDM_ARCHIVE_PATH if root is None else root
+    return root or None
+
+
+def schema():
+    """Arrow schema of archived observations"""
+    _require_pyarrow()
+    fields = []
+    for column in PROPERTY_COLUMNS:
+        if isinstance(column.type, DateTime):
+            kind = pa.timestamp("us", tz="UTC")
+        elif isinstance(column.type, Integer):
+            kind = pa.int64()
+        elif isinstance(column.type, Numeric):
+            kind = pa.float64()
+        else:  # strings, and JSON kept as text
+            kind = pa.string()
+        fields.append(pa.field(column.name, kind))
+    fields += [pa.field("longitude", pa.float64()), pa.field("latitude", pa.float64())]
+    return pa.schema(fields)
+
+
+def _utc(value: Optional[datetime]) -> Optional[pd.Timestamp]:
+    if value is None:
+        return None
+    value = pd.Timestamp(value)
+    return value.tz_localize("UTC") if value.tzinfo is None else value.tz_convert("UTC")
+
+
+def partitions(
+    root: str, start: Optional[datetime] = None, end: Optional[datetime] = None
+) -> List[Tuple[int, int, str]]:
+    """
+    (year, month, directory) of the archive partitions overlapping
+    ``[start, end)``, oldest first.
+    """
+    start, end = _utc(start), _utc(end)
+    found = []
+    if not root or not os.path.isdir(root):
+        return found
+    for year_dir in os.listdir(root):
+        match = _PARTITION.match(year_dir)
+        if not match or not match.group(1):
+            continue
+        for month_dir in os.listdir(os.path.join(root, year_dir)):
+            match_month = _PARTITION.match(month_dir)
+            if not match_month or not match_month.group(2):
+                continue
+            year, month = int(match.group(1)), int(match_month.group(2))
+            first = pd.Timestamp(year=year, month=month, day=1, tz="UTC")
+            if end is not None and first >= end:
+                continue
+            if start is not None and first + pd.offsets.MonthBegin(1) <= start:
+                continue
+            found.append((year, month, os.path.join(root, year_dir, month_dir)))
+    return sorted(found)
+
+
+def _batch_name(ids: Iterable[str]) -> str:
+    """File name of a batch, the same whenever the same rows are archived"""
+    digest = hashlib.sha1("\n".join(sorted(ids)).encode("utf-8")).hexdigest()
+    return f"part-{digest}.parquet"
+
+
+def stage_partitions(root: str, df: pd.DataFrame) -> List[str]:
+    """
+    Write observations to hidden pending files in their monthly partitions,
+    one per month, to be published by ``publish`` or removed by ``discard``.
+    """
+    _require_pyarrow()
+    ends = pd.to_datetime(df["phenomenon_end"], utc=True)
+    staged = []
+    for (year, month), part in df.groupby([ends.dt.year, ends.dt.month]):
+        directory = os.path.join(root, f"year={year:04d}", f"month={month:02d}")
+        os.makedirs(directory, exist_ok=True)
+        part = part.sort_values(["phenomenon_end", "id"])
+        table = pa.Table.from_pandas(part[COLUMNS], schema=schema(), preserve_index=False)
+        filename = os.path.join(directory, _PENDING + _batch_name(part["id"]))
+        tmp = f"{filename}.tmp"
+        pq.write_table(table, tmp)
+        os.replace(tmp, filename)
+        staged.append(filename)
+    return staged
+
+
+def publish(staged: Iterable[str]) -> List[str]:
+    """Make pending files visible; the same rows replace their earlier file"""
+    published = []
+    for filename in staged:
+        directory, name = os.path.split(filename)
+        target = os.path.join(directory, name[len(_PENDING):])
+        os.replace(filename, target)
+        published.append(target)
+    return published
+
+
+def discard(staged: Iterable[str]):
+    for filename in staged:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def write_partitions(root: str, df: pd.DataFrame) -> List[str]:
+    """Add observations to the monthly partitions, one file per month"""
+    return publish(stage_partitions(root, df))
+
+
+def pending_files(root: str) -> List[str]:
+    """Pending files left by an archive run that stopped between its steps"""
+    found = []
+    for _, _, directory in partitions(root):
+        found += sorted(
+            os.path.join(directory, name)
+            for name in os.listdir(directory)
+            if name.startswith(_PENDING) and name.endswith(".parquet")
+        )
+    return found
+
+
+def hot_ids(conn, ids: Iterable[str]) -> Set[str]:
+    """Those of ``ids`` still in ``cdm.observation``"""
+    ids = list(ids)
+    found = set()
+    for start in range(0, len(ids), _ID_BATCH_SIZE):
+        batch = ids[start:start + _ID_BATCH_SIZE]
+        found.update(
+            conn.execute(
+                select(observation.c.id).where(observation.c.id.in_(batch))
+            ).scalars()
+        )
+    return found
+
+
+def without_hot(conn, df: pd.DataFrame) -> pd.DataFrame:
+    """Archived rows whose id is not in the database, which reads prefer"""
+    if df.empty:
+        return df
+    return df[~df["id"].isin(hot_ids(conn, df["id"]))]
+
+
+def recover(conn, root: str) -> List[str]:
+    """
+    Finish an archive run that stopped between its steps. Deletes are
+    atomic, so a pending file whose rows are all gone from the database
+    belongs to a committed batch and is published, any other is discarded.
+    """
+    recovered = []
+    for filename in pending_files(root):
+        ids = pq.read_table(filename, columns=["id"]).column("id").to_pylist()
+        if hot_ids(conn, ids):
+            discard([filename])
+        else:
+            recovered += publish([filename])
+    return recovered
+
+
+def _archive_select(compact: bool = False):
+    columns = []
+    for column in PROPERTY_COLUMNS:
+        if isinstance(column.type, JSONB):
+            value = READ_EXPRESSIONS[column.name] if compact else column.name
+            columns.append(f"CAST({value} AS text) AS {column.name}")
+        elif isinstance(column.type, Numeric):
+            columns.append(f"CAST({column.name} AS double precision) AS {column.name}")
+        else:
+            columns.append(column.name)
+    columns += [
+        "ST_X(CAST(location AS geometry)) AS longitude",
+        "ST_Y(CAST(location AS geometry)) AS latitude",
+    ]
+    return text(
+        f"""
+        DELETE FROM cdm.observation AS o
+        WHERE o.id IN (
+            SELECT id FROM cdm.observation
+            WHERE phenomenon_end < :cutoff
+            ORDER BY phenomenon_end
+            LIMIT :batch_size
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING {", ".join(columns)}
+        """
+    )
+
+
+def archive_observations(
+    engine: Engine,
+    cutoff: datetime,
+    root: Optional[str] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> int:
+    """
+    Move observations with ``phenomenon_end`` before ``cutoff`` into the
+    archive, one transaction per batch so locks stay short.
+
+    Each batch is staged in pending files while its delete runs and only
+    published once the delete has committed, under a name derived from its
+    ids, so a failed or repeated run never archives rows twice. A run that
+    stopped between commit and publish is finished by the next one.
+    """
+    _require_pyarrow()
+    root = archive_root(root)
+    if root is None:
+        raise ValueError("No archive path given and CDM_ARCHIVE_PATH is not set")
+    with engine.connect() as conn:
+        sql = _archive_select(is_enabled(conn))
+        recover(conn, root)
+    moved = 0
+    while True:
+        staged = []
+        try:
+            with engine.begin() as conn:
+                result = conn.execute(sql, {"cutoff": cutoff, "batch_size": batch_size})
+                df = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+                if df.empty:
+                    return moved
+                staged = stage_partitions(root, df)
+        except BaseException:
+            discard(staged)
+            raise
+        publish(staged)
+        moved += len(df)
+
+
+def _filter(start, end, host_ids, observed_property_ids, collection_ids):
+    timestamp = schema().field("phenomenon_end").type
+    terms = []
+    if start is not None:
+        terms.append(ds.field("phenomenon_end") >= pa.scalar(_utc(start), timestamp))
+    if end is not None:
+        terms.append(ds.field("phenomenon_end") < pa.scalar(_utc(end), timestamp))
+    if host_ids is not None:
+        terms.append(ds.field("host_id").isin(list(host_ids)))
+    if observed_property_ids is not None:
+        terms.append(
+            ds.field("observed_property_id").isin([int(i) for i in observed_property_ids])
+        )
+    if collection_ids is not None:
+        terms.append(ds.field("collection_id").isin(list(collection_ids)))
+    expression = None
+    for term in terms:
+        expression = term if expression is None else expression & term
+    return expression
+
+
+def iter_archive(
+    root: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    host_ids: Optional[Iterable[str]] = None,
+    observed_property_ids: Optional[Iterable[int]] = None,
+    collection_ids: Optional[Iterable[str]] = None,
+) -> Iterator[pd.DataFrame]:
+    """
+    Yield archived observations matching the filters one monthly partition
+    at a time, ordered by ``phenomenon_end`` and id. Partitions outside the
+    window are never opened and the filters are pushed down to the Parquet
+    row group statistics. An id archived more than once is read once.
+    """
+    root = archive_root(root)
+    months = partitions(root, start, end) if root else []
+    if not months:
+        return
+    _require_pyarrow()
+    expression = _filter(start, end, host_ids, observed_property_ids, collection_ids)
+    for _, _, directory in months:
+        dataset = ds.dataset(directory, schema=schema(), format="parquet")
+        table = dataset.to_table(filter=expression)
+        if table.num_rows:
+            df = table.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+            df = df.drop_duplicates("id", keep="last")
+            yield df.sort_values(["phenomenon_end", "id"], ignore_index=True)
+
+
+def _decode(df: pd.DataFrame) -> pd.DataFrame:
+    for name in JSON_COLUMNS:
+        df[name] = df[name].map(lambda v: json.loads(v) if isinstance(v, str) else v)
+    return df
+
+
+def _missing(value) -> bool:
+    return (
+        value is None
+        or value is pd.NA
+        or value is pd.NaT
+        or (isinstance(value, float) and math.isnan(value))
+    )
+
+
+def iter_archive_rows(
+    root: Optional[str] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    conn=None,
+    **filters,
+) -> Iterator[List[tuple]]:
+    """
+    ``iter_archive`` as lists of row tuples in ``COLUMNS`` order, with None
+    for missing values and JSON decoded, like rows read from the database.
+    With ``conn``, rows whose id is still in the database are left out.
+    """
+    for df in iter_archive(root, **filters):
+        if conn is not None:
+            df = without_hot(conn, df)
+        df = _decode(df[COLUMNS].astype(object))
+        rows = [
+            tuple(None if _missing(v) else v for v in row)
+            for row in df.itertuples(index=False, name=None)
+        ]
+        for i in range(0, len(rows), batch_size):
+            yield rows[i:i + batch_size]
+
+
+def _hot_query(conn, start, end, host_ids, observed_property_ids, collection_ids):
+    table = source_table(conn)
+    location = cast(table.c.location, Geometry)
+    columns = [table.c[c.name] for c in PROPERTY_COLUMNS] + [
+        func.ST_X(location).label("longitude"),
+        func.ST_Y(location).label("latitude"),
+    ]
+    return observation_query(
+        start,
+        end,
+        host_ids,
+        observed_property_ids,
+        collection_ids,
+        columns=columns,
+        table=table,
+    )
+
+
+def read_observations(
+    conn,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    host_ids: Optional[Iterable[str]] = None,
+    observed_property_ids: Optional[Iterable[int]] = None,
+    collection_ids: Optional[Iterable[str]] = None,
+    root: Optional[str] = None,
+) -> pd.DataFrame:
+    """
+    Observations in the window from the database and, when the window
+    reaches into it, the archive, as one frame ordered by ``phenomenon_end``.
+    """
+    filters = dict(
+        start=start,
+        end=end,
+        host_ids=list(host_ids) if host_ids is not None else None,
+        observed_property_ids=(
+            list(observed_property_ids) if observed_property_ids is not None else None
+        ),
+        collection_ids=list(collection_ids) if collection_ids is not None else None,
+    )
+    result = conn.execute(_hot_query(conn, **filters))
+    hot = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+    for name in ("result_value", "elevation"):
+        hot[name] = pd.to_numeric(hot[name], errors="coerce").astype(float)
+    frames = [_decode(without_hot(conn, df)) for df in iter_archive(root, **filters)]
+    if not frames:
+        return hot
+    archived = pd.concat(frames, ignore_index=True)
+    hot["phenomenon_end"] = pd.to_datetime(hot["phenomenon_end"], utc=True)
+    combined = pd.concat([archived, hot], ignore_index=True)
+    return combined.sort_values(["phenomenon_end", "id"], ignore_index=True)
+
+
+_DAILY_SQL = text(
+    """
+    SELECT
+        host_id,
+        observed_property_id,
+        date_trunc('day', phenomenon_end AT TIME ZONE 'UTC') AS day,
+        count(result_value) AS count,
+        sum(CAST(result_value AS double precision)) AS sum,
+        min(CAST(result_value AS double precision)) AS min,
+        max(CAST(result_value AS double precision)) AS max
+    FROM cdm.observation
+    WHERE phenomenon_end >= :start AND phenomenon_end < :end
+      AND (CAST(:host_ids AS text[]) IS NULL
+           OR host_id = ANY(CAST(:host_ids AS text[])))
+      AND (CAST(:property_ids AS integer[]) IS NULL
+           OR observed_property_id = ANY(CAST(:property_ids AS integer[])))
+    GROUP BY 1, 2, 3
+    """
+)
+
+_KEYS = ["host_id", "observed_property_id", "day"]
+
+
+def daily_summary(
+    conn,
+    start: datetime,
+    end: datetime,
+    host_ids: Optional[Iterable[str]] = None,
+    observed_property_ids: Optional[Iterable[int]] = None,
+    root: Optional[str] = None,
+) -> pd.DataFrame:
+    """
+    Daily (UTC) count, min, max and mean of ``result_value`` per host and
+    property. The database aggregates its rows, archived partitions in the
+    window are aggregated one month at a time and the partials combined.
+    Archived rows still in the database are only counted there.
+    """
+    host_ids = list(host_ids) if host_ids is not None else None
+    observed_property_ids = (
+        list(observed_property_ids) if observed_property_ids is not None else None
+    )
+    result = conn.execute(
+        _DAILY_SQL,
+        {
+            "start": start,
+            "end": end,
+            "host_ids": host_ids,
+            "property_ids": observed_property_ids,
+        },
+    )
+    parts = [pd.DataFrame(result.fetchall(), columns=list(result.keys()))]
+    parts[0]["day"] = pd.to_datetime(parts[0]["day"])
+    for df in iter_archive(root, start, end, host_ids, observed_property_ids):
+        df = without_hot(conn, df)
+        df = df[df["result_value"].notna()]
+        df = df.assign(day=df["phenomenon_end"].dt.tz_convert(None).dt.floor("D"))
+        parts.append(
+            df.groupby(_KEYS)["result_value"]
+            .agg(["count", "sum", "min", "max"])
+            .reset_index()
+        )
+    combined = pd.concat(parts, ignore_index=True)
+    summary = combined.groupby(_KEYS, as_index=False).agg(
+        count=("count", "sum"), sum=("sum", "sum"), min=("min", "min"), max=("max", "max")
+    )
+    summary["mean"] = np.where(
+        summary["count"] > 0, summary["sum"] / summary["count"], np.nan
+    )
+    return summary.drop(columns="sum").sort_values(_KEYS, ignore_index=True)
@@ -0,0 +1,172 @@
+"""
+Walk over many ORM objects with a bounded memory footprint.
+
+A session keeps what it loaded until it is closed; ``iter_chunks`` pages
+through an entity by primary key (keyset pagination, no OFFSET) and lets go
+of each chunk once it has been processed.
+"""
+import sys
+import time
+import tracemalloc
+from contextlib import closing
+from dataclasses import dataclass
+from typing import Callable, Iterator, List, Optional, Sequence
+
+from sqlalchemy import inspect, select, tuple_
+from sqlalchemy.orm import Session
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - not available on Windows
+    resource = None
+
+DEFAULT_CHUNK_SIZE = 1000
+
+RELEASE_MODES = ("expunge", "expire", "none")
+
+
+@dataclass()
+class ChunkStats:
+    """Work and memory of one chunk"""
+
+    number: int
+    rows: int
+    seconds: float
+    # Last primary key of the chunk, where to resume after a failure
+    last_key: tuple
+    # Peak resident set size of the process so far, in bytes
+    peak_rss: int
+    # Peak traced Python allocations during the chunk, when tracing
+    traced_peak: Optional[int] = None
+
+
+def _peak_rss() -> int:
+    if resource is None:  # pragma: no cover
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _reset_traced_peak():
+    if hasattr(tracemalloc, "reset_peak"):  # Python 3.9+
+        tracemalloc.reset_peak()
+    else:  # pragma: no cover
+        tracemalloc.clear_traces()
+
+
+def _release(session: Session, chunk: List, release: str):
+    if release == "expunge":
+        for obj in chunk:
+            if obj in session:
+                session.expunge(obj)
+    elif release == "expire":
+        for obj in chunk:
+            if obj in session:
+                session.expire(obj)
+
+
+def iter_chunks(
+    session: Session,
+    entity,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    where: Sequence = (),
+    after: Optional[tuple] = None,
+    release: str = "expunge",
+    commit: bool = False,
+    trace_memory: bool = False,
+    progress: Optional[Callable[[ChunkStats], None]] = None,
+) -> Iterator[List]:
+    """
+    Yield lists of up to ``chunk_size`` objects of a mapped ``entity``
+    matching the ``where`` conditions, in primary key order and starting
+    after primary key ``after``.
+
+    Once the caller asks for the next chunk the current one is flushed, or
+    committed with ``commit``, and its objects are expunged from the
+    session (``release="expunge"``) or expired, keeping them but dropping
+    their loaded state (``"expire"``). ``progress`` then gets the chunk's
+    ``ChunkStats``; ``trace_memory`` adds Python allocation peaks from
+    ``tracemalloc``, at a cost in speed.
+
+    When the caller stops early, by breaking out or raising, the last chunk
+    is flushed and released on ``close()`` but never committed.
+    """
+    if release not in RELEASE_MODES:
+        raise ValueError(f"release must be one of {', '.join(RELEASE_MODES)}")
+    key = list(inspect(entity).primary_key)
+    if len(key) == 1:
+        key_expression, key_value = key[0], lambda value: value[0]
+    else:
+        key_expression, key_value = tuple_(*key), lambda value: tuple_(*value)
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    number = 0
+    try:
+        while True:
+            started = time.perf_counter()
+            if trace_memory:
+                _reset_traced_peak()
+            q = select(entity).where(*where).order_by(*key).limit(chunk_size)
+            if after is not None:
+                q = q.where(key_expression > key_value(after))
+            chunk = session.execute(q).scalars().all()
+            if not chunk:
+                return
+            identity = inspect(chunk[-1]).identity
+            try:
+                yield chunk
+            except GeneratorExit:
+                # The caller stopped, done with the chunk or failing on it
+                try:
+                    session.flush()
+                finally:
+                    _release(session, chunk, release)
+                raise
+
+            if commit:
+                session.commit()
+            else:
+                session.flush()
+            _release(session, chunk, release)
+            after = identity
+            stats = ChunkStats(
+                number=number,
+                rows=len(chunk),
+                seconds=time.perf_counter() - started,
+                last_key=identity,
+                peak_rss=_peak_rss(),
+                traced_peak=tracemalloc.get_traced_memory()[1] if trace_memory else None,
+            )
+            del chunk
+            number += 1
+            if progress is not None:
+                progress(stats)
+            if stats.rows < chunk_size:
+                return
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+
+
+def run_in_chunks(
+    session: Session, entity, process: Callable[[List], None], **options
+) -> List[ChunkStats]:
+    """
+    Call ``process`` with each chunk of ``iter_chunks(session, entity,
+    **options)`` and return the statistics of every chunk.
+    """
+    stats = []
+    progress = options.pop("progress", None)
+
+    def record(chunk_stats: ChunkStats):
+        stats.append(chunk_stats)
+        if progress is not None:
+            progress(chunk_stats)
+
+    with closing(iter_chunks(session, entity, progress=record, **options)) as chunks:
+        for chunk in chunks:
+            process(chunk)
+    return stats
@@ -0,0 +1,272 @@
+"""Vectorised validation and COPY based bulk writes of observations"""
+import io
+import json
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Set
+
+import numpy as np
+import pandas as pd
+
+from opencdms.provider.opencdmsdb import observation
+from opencdms.utils.compact import is_enabled, upsert_assignments
+from opencdms.utils.ids import uuid7_batch
+
+COLUMNS = [c.name for c in observation.c]
+REQUIRED = ["location", "phenomenon_end", "host_id", "observed_property_id"]
+DATETIME_COLUMNS = [
+    "phenomenon_start",
+    "phenomenon_end",
+    "result_time",
+    "valid_from",
+    "valid_to",
+    "change_date",
+]
+FLOAT_COLUMNS = ["result_value", "elevation"]
+INTEGER_COLUMNS = [
+    "observation_type_id",
+    "observed_property_id",
+    "observing_procedure_id",
+    "status_id",
+    "version",
+]
+JSON_COLUMNS = ["result_quality", "parameter"]
+
+
+@dataclass()
+class BulkResult:
+    """Outcome of a bulk write, one entry per input row"""
+
+    ids: List[Optional[str]] = field(default_factory=list)
+    errors: Dict[int, List[str]] = field(default_factory=dict)
+    written: Set[str] = field(default_factory=set)
+
+    @property
+    def inserted(self) -> int:
+        return len(self.written)
+
+    def as_features(self) -> List[dict]:
+        """Per feature ``{"id": ..., "errors": [...]}`` summary"""
+        return [
+            {
+                "id": _id if _id in self.written else None,
+                "errors": self.errors.get(i, []),
+            }
+            for i, _id in enumerate(self.ids)
+        ]
+
+
+def features_to_frame(features: Iterable[dict]) -> pd.DataFrame:
+    """
+    Flatten GeoJSON features into one row per feature with the properties as
+    columns and ``longitude`` / ``latitude`` taken from point geometries.
+    """
+    records = []
+    for feature in features:
+        properties = dict(feature.get("properties") or {})
+        if feature.get("id") is not None:
+            properties["id"] = feature["id"]
+        geometry = feature.get("geometry") or {}
+        coordinates = geometry.get("coordinates") if geometry.get("type") == "Point" else None
+        if coordinates and len(coordinates) >= 2:
+            properties["longitude"], properties["latitude"] = coordinates[:2]
+        records.append(properties)
+    return pd.DataFrame.from_records(records)
+
+
+def _is_missing(value) -> bool:
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+
+_INVALID = object()
+
+
+def _parse_json(value):
+    """JSON columns given as text, e.g. read from CSV, hold encoded documents"""
+    if not isinstance(value, str):
+        return value
+    try:
+        return json.loads(value)
+    except ValueError:
+        return _INVALID
+
+
+def _add_errors(errors: Dict[int, List[str]], mask, message: str):
+    for i in np.flatnonzero(np.asarray(mask)):
+        errors.setdefault(int(i), []).append(message)
+
+
+def validate_observations(df: pd.DataFrame):
+    """
+    Check and coerce all rows of an observation frame column by column.
+
+    Returns the coerced frame with defaults filled in (``id``, ``version``,
+    ``change_date``) and a dict of row position -> error messages. Strings
+    in JSON columns are parsed as JSON documents.
+    """
+    df = df.reset_index(drop=True).copy()
+    errors: Dict[int, List[str]] = {}
+    n = len(df)
+
+    unknown = set(df.columns) - set(COLUMNS) - {"longitude", "latitude"}
+    for name in sorted(unknown):
+        _add_errors(errors, df[name].notna(), f"unknown property '{name}'")
+    df = df.drop(columns=list(unknown))
+
+    for name in COLUMNS + ["longitude", "latitude"]:
+        if name not in df:
+            df[name] = None
+    for name in REQUIRED:
+        if name != "location":
+            _add_errors(errors, df[name].isna(), f"missing '{name}'")
+
+    for name in DATETIME_COLUMNS:
+        parsed = pd.to_datetime(df[name], utc=True, errors="coerce", format="ISO8601")
+        _add_errors(errors, df[name].notna() & parsed.isna(), f"invalid datetime '{name}'")
+        df[name] = parsed
+    for name in FLOAT_COLUMNS + ["longitude", "latitude"]:
+        parsed = pd.to_numeric(df[name], errors="coerce")
+        _add_errors(errors, df[name].notna() & parsed.isna(), f"invalid number '{name}'")
+        df[name] = parsed
+    for name in INTEGER_COLUMNS:
+        parsed = pd.to_numeric(df[name], errors="coerce")
+        invalid = df[name].notna() & (parsed.isna() | (parsed % 1 != 0))
+        _add_errors(errors, invalid, f"invalid integer '{name}'")
+        df[name] = parsed.where(~invalid).astype("Int64")
+
+    has_point = df["longitude"].notna() & df["latitude"].notna()
+    _add_errors(
+        errors,
+        has_point & ~(df["longitude"].between(-180, 180) & df["latitude"].between(-90, 90)),
+        "coordinates out of range",
+    )
+    _add_errors(errors, ~has_point & df["location"].isna(), "missing point geometry")
+    df["location"] = df["location"].where(
+        ~has_point,
+        "SRID=4326;POINT("
+        + df["longitude"].astype(str)
+        + " "
+        + df["latitude"].astype(str)
+        + ")",
+    )
+    missing_id = df["id"].isna()
+    df.loc[missing_id, "id"] = uuid7_batch(int(missing_id.sum()))
+    df["id"] = df["id"].astype(str)
+    _add_errors(errors, df["id"].duplicated(keep=False), "duplicate id")
+    df["version"] = df["version"].fillna(1)
+    df["change_date"] = df["change_date"].fillna(pd.Timestamp(datetime.now(timezone.utc)))
+
+    for name in JSON_COLUMNS:
+        parsed = df[name].map(_parse_json)
+        _add_errors(errors, parsed.map(lambda v: v is _INVALID), f"invalid JSON '{name}'")
+        df[name] = parsed.map(
+            lambda v: None if _is_missing(v) or v is _INVALID else json.dumps(v)
+        )
+
+    assert len(df) == n
+    return df[COLUMNS], errors
+
+
+def _staging_csv(df: pd.DataFrame, rows: np.ndarray) -> io.StringIO:
+    out = df.copy()
+    for name in DATETIME_COLUMNS:
+        out[name] = out[name].map(lambda v: None if pd.isna(v) else v.isoformat())
+    out["_row"] = rows
+    buffer = io.StringIO()
+    out.to_csv(buffer, index=False, header=False, na_rep="")
+    buffer.seek(0)
+    return buffer
+
+
+def _reference_checks() -> List[str]:
+    """Anti joins finding staged rows with unknown foreign keys"""
+    checks = []
+    for fk in observation.foreign_keys:
+        column = fk.parent.name
+        target = fk.column
+        checks.append(
+            f"SELECT s._row, 'unknown {column}' FROM _observation_staging AS s "
+            f"WHERE s.{column} IS NOT NULL AND NOT EXISTS ("
+            f'SELECT 1 FROM "{target.table.schema}"."{target.table.name}" AS t '
+            f"WHERE t.{target.name} = s.{column})"
+        )
+    return checks
+
+
+def copy_observations(
+    conn,
+    df: pd.DataFrame,
+    errors: Optional[Dict[int, List[str]]] = None,
+    on_conflict: str = "error",
+    all_or_nothing: bool = False,
+) -> BulkResult:
+    """
+    Write validated observations (see ``validate_observations``) with COPY
+    into a temporary staging table and a single ``INSERT ... SELECT`` into
+    ``cdm.observation``.
+
+    ``conn`` must be a SQLAlchemy connection inside a transaction. Rows with
+    validation errors, unknown foreign keys or, unless ``on_conflict`` is
+    ``"update"`` (upsert) or ``"skip"``, an existing id are not written and
+    are reported in the result. With ``all_or_nothing`` nothing is written
+    when any row has an error.
+    """
+    errors = {k: list(v) for k, v in (errors or {}).items()}
+    result = BulkResult(ids=list(df["id"]), errors=errors)
+    rows = np.arange(len(df))
+    valid = np.array([i not in errors for i in rows], dtype=bool)
+    if not valid.any() or (all_or_nothing and not valid.all()):
+        return result
+
+    cursor = conn.connection.cursor()
+    columns = ", ".join(f'"{name}"' for name in COLUMNS)
+    cursor.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS _observation_staging "
+        "(LIKE cdm.observation INCLUDING DEFAULTS) ON COMMIT DROP"
+    )
+    cursor.execute(
+        "ALTER TABLE _observation_staging ADD COLUMN IF NOT EXISTS _row integer"
+    )
+    cursor.execute("TRUNCATE _observation_staging")
+    cursor.copy_expert(
+        f"COPY _observation_staging ({columns}, _row) FROM STDIN WITH (FORMAT csv)",
+        _staging_csv(df[valid], rows[valid]),
+    )
+
+    checks = _reference_checks()
+    if on_conflict == "error":
+        checks.append(
+            "SELECT s._row, 'id already exists' FROM _observation_staging AS s "
+            "JOIN cdm.observation AS o ON o.id = s.id"
+        )
+    cursor.execute(" UNION ALL ".join(checks))
+    for row, message in cursor.fetchall():
+        errors.setdefault(int(row), []).append(message)
+    if errors and all_or_nothing:
+        cursor.execute("TRUNCATE _observation_staging")
+        return result
+
+    conflict = ""
+    if on_conflict == "update":
+        assignments = ", ".join(upsert_assignments(COLUMNS, is_enabled(conn)))
+        conflict = f"ON CONFLICT (id) DO UPDATE SET {assignments}"
+    elif on_conflict == "skip":
+        conflict = "ON CONFLICT (id) DO NOTHING"
+    cursor.execute(
+        f"INSERT INTO cdm.observation ({columns}) "
+        f"SELECT {columns} FROM _observation_staging "
+        f"WHERE NOT (_row = ANY(%s)) {conflict} RETURNING id",
+        (sorted(errors),),
+    )
+    result.written = {row[0] for row in cursor.fetchall()}
+    for i in rows[valid]:
+        if i not in errors and result.ids[i] not in result.written:
+            errors[int(i)] = ["id already exists"]
+    cursor.execute("TRUNCATE _observation_staging")
+    return result
+
+
+def write_features(conn, features: Iterable[dict], **options) -> BulkResult:
+    """Validate GeoJSON observation features and write them in one go"""
+    df, errors = validate_observations(features_to_frame(features))
+    return copy_observations(conn, df, errors, **options)
@@ -0,0 +1,277 @@
+"""LISTEN / NOTIFY change feed of inserted and updated observations"""
+import asyncio
+import json
+import select as _select
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from opencdms.utils.db import SKIP_MAINTENANCE_SQL, install_change_date_index
+
+CHANNEL = "cdm_observation_changes"
+
+# Changes of one statement are aggregated per host and property, and sent in
+# notifications of at most this many entries to stay well under the 8000
+# byte payload limit. Notifications are only delivered on commit, so those of
+# one transaction arrive together and are merged again by ``coalesce``.
+_ENTRIES_PER_NOTIFICATION = 40
+
+INSTALL_SQL = f"""
+CREATE OR REPLACE FUNCTION cdm.notify_observation_changes() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    batch json;
+BEGIN
+    {SKIP_MAINTENANCE_SQL}
+    FOR batch IN
+        SELECT json_build_object(
+            'w', max(watermark),
+            'c', json_agg(json_build_array(
+                host_id, observed_property_id, start_epoch, end_epoch, n
+            ))
+        )
+        FROM (
+            SELECT
+                host_id,
+                observed_property_id,
+                extract(epoch FROM min(phenomenon_end)) AS start_epoch,
+                extract(epoch FROM max(phenomenon_end)) AS end_epoch,
+                count(*) AS n,
+                extract(epoch FROM max(change_date)) AS watermark,
+                (row_number() OVER () - 1) / {_ENTRIES_PER_NOTIFICATION} AS chunk
+            FROM changed_rows
+            GROUP BY host_id, observed_property_id
+        ) AS changes
+        GROUP BY chunk
+    LOOP
+        PERFORM pg_notify('{CHANNEL}', batch::text);
+    END LOOP;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS observation_notify_insert ON cdm.observation;
+CREATE TRIGGER observation_notify_insert
+    AFTER INSERT ON cdm.observation
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION cdm.notify_observation_changes();
+
+DROP TRIGGER IF EXISTS observation_notify_update ON cdm.observation;
+CREATE TRIGGER observation_notify_update
+    AFTER UPDATE ON cdm.observation
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION cdm.notify_observation_changes();
+"""
+
+UNINSTALL_SQL = """
+DROP TRIGGER IF EXISTS observation_notify_insert ON cdm.observation;
+DROP TRIGGER IF EXISTS observation_notify_update ON cdm.observation;
+DROP FUNCTION IF EXISTS cdm.notify_observation_changes();
+"""
+
+# Found through the ``change_date`` index (see ``install_indexes``)
+_REPLAY_SQL = text(
+    """
+    SELECT
+        host_id,
+        observed_property_id,
+        extract(epoch FROM min(phenomenon_end)),
+        extract(epoch FROM max(phenomenon_end)),
+        count(*),
+        extract(epoch FROM max(change_date))
+    FROM cdm.observation
+    WHERE change_date > to_timestamp(:since)
+    GROUP BY host_id, observed_property_id
+    """
+)
+
+
+@dataclass()
+class ChangeEvent:
+    """Observations of one host and property inserted or updated together"""
+
+    host_id: Optional[str]
+    observed_property_id: Optional[int]
+    start: Optional[datetime]
+    end: Optional[datetime]
+    count: int
+    watermark: Optional[float] = None
+
+
+def install_indexes(engine):
+    """
+    Create the ``change_date`` index of ``cdm.observation`` that ``replay``
+    uses, concurrently. Without it each replay scans the table.
+    """
+    install_change_date_index(engine)
+
+
+def install(conn):
+    """Create the trigger publishing changes on ``cdm.observation``"""
+    conn.execute(text(INSTALL_SQL))
+
+
+def uninstall(conn):
+    conn.execute(text(UNINSTALL_SQL))
+
+
+def _timestamp(epoch) -> Optional[datetime]:
+    if epoch is None:
+        return None
+    return datetime.fromtimestamp(float(epoch), tz=timezone.utc)
+
+
+def parse_notification(payload: str) -> List[ChangeEvent]:
+    """Decode the compact payload sent by the trigger"""
+    data = json.loads(payload)
+    return [
+        ChangeEvent(
+            host_id=host_id,
+            observed_property_id=property_id,
+            start=_timestamp(start),
+            end=_timestamp(end),
+            count=count,
+            watermark=data.get("w"),
+        )
+        for host_id, property_id, start, end, count in data.get("c") or []
+    ]
+
+
+def _extreme(function, *values):
+    values = [v for v in values if v is not None]
+    return function(values) if values else None
+
+
+def coalesce(events: List[ChangeEvent]) -> List[ChangeEvent]:
+    """Merge events of the same host and property into one"""
+    merged = {}
+    for event in events:
+        key = (event.host_id, event.observed_property_id)
+        current = merged.get(key)
+        if current is None:
+            merged[key] = ChangeEvent(**vars(event))
+            continue
+        current.start = _extreme(min, current.start, event.start)
+        current.end = _extreme(max, current.end, event.end)
+        current.watermark = _extreme(max, current.watermark, event.watermark)
+        current.count += event.count
+    return list(merged.values())
+
+
+def replay(conn, since: float) -> Tuple[List[ChangeEvent], float]:
+    """
+    Poll based fallback: changes with a ``change_date`` after the ``since``
+    watermark (epoch seconds), and the new watermark.
+    """
+    events = []
+    watermark = since
+    for host_id, property_id, start, end, count, changed in conn.execute(
+        _REPLAY_SQL, {"since": since}
+    ):
+        events.append(
+            ChangeEvent(
+                host_id, property_id, _timestamp(start), _timestamp(end), count,
+                float(changed) if changed is not None else None,
+            )
+        )
+        if changed is not None:
+            watermark = max(watermark, float(changed))
+    return events, watermark
+
+
+def _listen_connection(engine: Engine):
+    raw = engine.raw_connection()
+    # The connection is kept LISTENing, never hand it back to the pool
+    raw.detach()
+    dbapi_connection = raw.connection
+    dbapi_connection.autocommit = True
+    with dbapi_connection.cursor() as cursor:
+        cursor.execute(f"LISTEN {CHANNEL}")
+    return dbapi_connection
+
+
+def _drain(dbapi_connection) -> List[ChangeEvent]:
+    dbapi_connection.poll()
+    events = []
+    while dbapi_connection.notifies:
+        notify = dbapi_connection.notifies.pop(0)
+        events.extend(parse_notification(notify.payload))
+    return events
+
+
+def subscribe(
+    engine: Engine,
+    since: Optional[float] = None,
+    batch_interval: float = 0.1,
+    timeout: Optional[float] = None,
+) -> Iterator[List[ChangeEvent]]:
+    """
+    Yield batches of change events as notifications arrive, grouping those
+    received within ``batch_interval`` seconds. When ``since`` is given,
+    changes made after that watermark are replayed first. If ``timeout`` is
+    set an empty batch is yielded after that many idle seconds.
+    """
+    dbapi_connection = _listen_connection(engine)
+    try:
+        if since is not None:
+            # LISTEN is already active, so nothing falls between replay and feed
+            with engine.connect() as conn:
+                events, _ = replay(conn, since)
+            if events:
+                yield events
+        while True:
+            ready, _, _ = _select.select([dbapi_connection], [], [], timeout)
+            if not ready:
+                yield []
+                continue
+            events = _drain(dbapi_connection)
+            deadline = time.monotonic() + batch_interval
+            remaining = batch_interval
+            while remaining > 0:
+                if _select.select([dbapi_connection], [], [], remaining)[0]:
+                    events.extend(_drain(dbapi_connection))
+                remaining = deadline - time.monotonic()
+            if events:
+                yield coalesce(events)
+    finally:
+        dbapi_connection.close()
+
+
+async def asubscribe(
+    engine: Engine,
+    since: Optional[float] = None,
+    batch_interval: float = 0.1,
+) -> AsyncIterator[List[ChangeEvent]]:
+    """asyncio version of ``subscribe`` reading notifications from the loop"""
+    loop = asyncio.get_running_loop()
+    dbapi_connection = _listen_connection(engine)
+    queue: asyncio.Queue = asyncio.Queue()
+
+    def _on_readable():
+        for event in _drain(dbapi_connection):
+            queue.put_nowait(event)
+
+    loop.add_reader(dbapi_connection.fileno(), _on_readable)
+    try:
+        if since is not None:
+            events, _ = await loop.run_in_executor(None, _replay_with, engine, since)
+            if events:
+                yield events
+        while True:
+            events = [await queue.get()]
+            await asyncio.sleep(batch_interval)
+            while not queue.empty():
+                events.append(queue.get_nowait())
+            yield coalesce(events)
+    finally:
+        loop.remove_reader(dbapi_connection.fileno())
+        dbapi_connection.close()
+
+
+def _replay_with(engine: Engine, since: float):
+    with engine.connect() as conn:
+        return replay(conn, since)
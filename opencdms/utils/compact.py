@@ -0,0 +1,333 @@
+"""
+Optional compact storage of ``observation.result_quality`` and
+``observation.parameter``.
+
+QC documents of the shape written by ``opencdms.utils.qc`` are kept as
+smallint bitmasks (``qc_flags`` / ``qc_checked``) and parameter documents
+are deduplicated into ``cdm.parameter_set``. A trigger compacts rows on
+write, and ``cdm.observation_compat`` shows the JSON columns as before.
+"""
+import re
+import time
+from typing import Dict, Iterable, List
+
+from sqlalchemy import Column, MetaData, Table, text
+from sqlalchemy.engine import Engine
+
+from opencdms.provider.opencdmsdb import observation
+from opencdms.utils.db import maintenance
+from opencdms.utils.qc import CHECKS
+
+COMPACT_COLUMNS = ["qc_flags", "qc_checked", "parameter_id"]
+
+DEFAULT_BATCH_SIZE = 20000
+
+# Counts the compact columns present, works with any DB-API cursor too
+ENABLED_SQL = (
+    "SELECT count(*) FROM information_schema.columns "
+    "WHERE table_schema = 'cdm' AND table_name = 'observation' "
+    "AND column_name IN ({})".format(", ".join(f"'{n}'" for n in COMPACT_COLUMNS))
+)
+
+_CHECK_VALUES = ", ".join(f"('{name}', {bit})" for name, bit in CHECKS.items())
+
+# Expressions rebuilding the JSON columns of a row ``o``
+READ_EXPRESSIONS = {
+    "result_quality": (
+        "coalesce(o.result_quality, cdm.qc_quality_json(o.qc_flags, o.qc_checked))"
+    ),
+    "parameter": (
+        "coalesce(o.parameter, "
+        "(SELECT p.parameter FROM cdm.parameter_set AS p WHERE p.id = o.parameter_id))"
+    ),
+}
+
+# The row of ``READ_EXPRESSIONS``
+_ROW_ALIAS = re.compile(r"\bo\.")
+
+ENABLE_SQL = f"""
+CREATE TABLE IF NOT EXISTS cdm.parameter_set (
+    id serial PRIMARY KEY,
+    parameter jsonb NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS parameter_set_md5
+    ON cdm.parameter_set (md5(CAST(parameter AS text)));
+
+ALTER TABLE cdm.observation
+    ADD COLUMN IF NOT EXISTS qc_flags smallint,
+    ADD COLUMN IF NOT EXISTS qc_checked smallint,
+    ADD COLUMN IF NOT EXISTS parameter_id integer REFERENCES cdm.parameter_set (id);
+
+CREATE OR REPLACE FUNCTION cdm.qc_quality_json(flags smallint, checked smallint)
+RETURNS jsonb LANGUAGE sql IMMUTABLE STRICT AS $$
+    SELECT jsonb_build_object(
+        'qc_flags', flags,
+        'qc_checked', checked,
+        'qc_failed', to_jsonb(ARRAY(
+            SELECT c.name FROM (VALUES {_CHECK_VALUES}) AS c(name, bit)
+            WHERE flags & c.bit <> 0
+            ORDER BY c.bit
+        ))
+    )
+$$;
+
+CREATE OR REPLACE FUNCTION cdm.qc_compactable(quality jsonb)
+RETURNS boolean LANGUAGE sql IMMUTABLE STRICT AS $$
+    SELECT CASE
+        WHEN coalesce(quality->>'qc_flags', '') !~ '^[0-9]{{1,4}}$'
+          OR coalesce(quality->>'qc_checked', '') !~ '^[0-9]{{1,4}}$'
+        THEN false
+        ELSE quality = cdm.qc_quality_json(
+            CAST(quality->>'qc_flags' AS smallint),
+            CAST(quality->>'qc_checked' AS smallint)
+        )
+    END
+$$;
+
+CREATE OR REPLACE FUNCTION cdm.compact_observation() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    found_id integer;
+BEGIN
+    -- NULL documents leave the compact columns as they are, so clearing
+    -- compacted values means setting those columns too
+    IF NEW.result_quality IS NOT NULL THEN
+        IF cdm.qc_compactable(NEW.result_quality) THEN
+            NEW.qc_flags := CAST(NEW.result_quality->>'qc_flags' AS smallint);
+            NEW.qc_checked := CAST(NEW.result_quality->>'qc_checked' AS smallint);
+            NEW.result_quality := NULL;
+        ELSE
+            NEW.qc_flags := NULL;
+            NEW.qc_checked := NULL;
+        END IF;
+    END IF;
+    IF NEW.parameter IS NOT NULL THEN
+        SELECT id INTO found_id FROM cdm.parameter_set
+        WHERE md5(CAST(parameter AS text)) = md5(CAST(NEW.parameter AS text));
+        IF found_id IS NULL THEN
+            INSERT INTO cdm.parameter_set (parameter) VALUES (NEW.parameter)
+            ON CONFLICT DO NOTHING
+            RETURNING id INTO found_id;
+        END IF;
+        IF found_id IS NULL THEN
+            -- inserted concurrently
+            SELECT id INTO found_id FROM cdm.parameter_set
+            WHERE md5(CAST(parameter AS text)) = md5(CAST(NEW.parameter AS text));
+        END IF;
+        NEW.parameter_id := found_id;
+        NEW.parameter := NULL;
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS observation_compact ON cdm.observation;
+CREATE TRIGGER observation_compact
+    BEFORE INSERT OR UPDATE ON cdm.observation
+    FOR EACH ROW EXECUTE FUNCTION cdm.compact_observation();
+"""
+
+_VIEW_SQL = """
+CREATE OR REPLACE VIEW cdm.observation_compat AS
+SELECT {columns}
+FROM cdm.observation AS o
+"""
+
+DISABLE_SQL = """
+DROP VIEW IF EXISTS cdm.observation_compat;
+DROP TRIGGER IF EXISTS observation_compact ON cdm.observation;
+DROP FUNCTION IF EXISTS cdm.compact_observation();
+ALTER TABLE cdm.observation
+    DROP COLUMN IF EXISTS qc_flags,
+    DROP COLUMN IF EXISTS qc_checked,
+    DROP COLUMN IF EXISTS parameter_id;
+DROP TABLE IF EXISTS cdm.parameter_set;
+DROP FUNCTION IF EXISTS cdm.qc_compactable(jsonb);
+DROP FUNCTION IF EXISTS cdm.qc_quality_json(smallint, smallint);
+"""
+
+# The view, for SQLAlchemy queries reading JSON columns in compact mode
+observation_compat = Table(
+    "observation_compat",
+    MetaData(),
+    *[Column(c.name, c.type, primary_key=c.primary_key) for c in observation.c],
+    schema="cdm",
+)
+
+
+def view_sql() -> str:
+    """The compatibility view, with the columns of ``cdm.observation``"""
+    columns = ",\n    ".join(
+        f"{READ_EXPRESSIONS[c.name]} AS {c.name}"
+        if c.name in READ_EXPRESSIONS
+        else f"o.{c.name}"
+        for c in observation.c
+    )
+    return _VIEW_SQL.format(columns=columns)
+
+
+def is_enabled(conn) -> bool:
+    """Whether ``cdm.observation`` has the compact columns"""
+    return conn.execute(text(ENABLED_SQL)).scalar() == len(COMPACT_COLUMNS)
+
+
+def source_table(conn):
+    """The compatibility view when compact storage is enabled, else the table"""
+    return observation_compat if is_enabled(conn) else observation
+
+
+def compact_assignments(columns: Iterable[str]) -> Dict[str, str]:
+    """
+    ``ON CONFLICT DO UPDATE`` values, by column, replacing ``EXCLUDED."name"``
+    in an upsert inserting ``columns`` into a compacted ``cdm.observation``.
+
+    Compact columns are carried over only when the insert supplies them, as
+    they are NULL in ``EXCLUDED`` otherwise and would clear the stored
+    values. Inserts of the mapped columns only instead assign the documents
+    rebuilt from what the trigger compacted into ``EXCLUDED``, which the
+    update trigger compacts again; NULL documents keep the stored values.
+    """
+    columns = list(columns)
+    if any(name in columns for name in COMPACT_COLUMNS):
+        return {
+            name: f'EXCLUDED."{name}"' for name in COMPACT_COLUMNS if name in columns
+        }
+    return {
+        name: _ROW_ALIAS.sub("EXCLUDED.", expression)
+        for name, expression in READ_EXPRESSIONS.items()
+        if name in columns
+    }
+
+
+def upsert_assignments(columns: Iterable[str], compacted: bool) -> List[str]:
+    """
+    ``SET`` list of ``ON CONFLICT (id) DO UPDATE`` for an upsert of
+    ``columns`` into ``cdm.observation``, with compact storage enabled or not
+    """
+    columns = list(columns)
+    values = {name: f'EXCLUDED."{name}"' for name in columns if name != "id"}
+    if compacted:
+        values.update(compact_assignments(columns))
+    return [f'"{name}" = {value}' for name, value in values.items()]
+
+
+# Visits the rows after ``:last_id`` in primary key index order and applies
+# ``{assignments}`` to those matching ``{condition}``. Returns the rows updated
+# and the last id visited, in the server's collation.
+_BACKFILL_SQL = """
+WITH batch AS (
+    SELECT id FROM cdm.observation
+    WHERE id > :last_id
+    ORDER BY id
+    LIMIT :batch_size
+),
+updated AS (
+    UPDATE cdm.observation AS o
+    SET {assignments}
+    FROM batch
+    WHERE o.id = batch.id AND ({condition})
+    RETURNING 1
+)
+SELECT (SELECT count(*) FROM updated), (SELECT max(id) FROM batch)
+"""
+
+# Assigning the documents to themselves lets the trigger compact them
+_COMPACT_SQL = _BACKFILL_SQL.format(
+    assignments="result_quality = o.result_quality, parameter = o.parameter",
+    condition="o.result_quality IS NOT NULL OR o.parameter IS NOT NULL",
+)
+
+_EXPAND_SQL = _BACKFILL_SQL.format(
+    assignments=f"""result_quality = {READ_EXPRESSIONS["result_quality"]},
+        parameter = {READ_EXPRESSIONS["parameter"]},
+        qc_flags = NULL, qc_checked = NULL, parameter_id = NULL""",
+    condition="o.qc_flags IS NOT NULL OR o.parameter_id IS NOT NULL",
+)
+
+
+def _backfill(engine: Engine, sql: str, batch_size: int) -> int:
+    """
+    Run a backfill statement over the whole table, one short maintenance
+    transaction per batch, and return the number of rows updated
+    """
+    updated = 0
+    last_id = ""
+    statement = text(sql)
+    while True:
+        with engine.begin() as conn:
+            maintenance(conn)
+            count, last_id = conn.execute(
+                statement, {"last_id": last_id, "batch_size": batch_size}
+            ).one()
+        if last_id is None:
+            return updated
+        updated += count
+
+
+def enable(engine: Engine, batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """
+    Add the compact columns, trigger and view, then compact existing rows in
+    batches of ``batch_size``, each its own short transaction. Returns the
+    number of rows compacted. Safe to rerun, e.g. after an interruption.
+    """
+    with engine.begin() as conn:
+        conn.execute(text(ENABLE_SQL))
+        conn.execute(text(view_sql()))
+    return _backfill(engine, _COMPACT_SQL, batch_size)
+
+
+def disable(engine: Engine, batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """Write the JSON documents back in batches and drop the compact storage"""
+    with engine.begin() as conn:
+        if not is_enabled(conn):
+            return 0
+        conn.execute(
+            text("DROP TRIGGER IF EXISTS observation_compact ON cdm.observation")
+        )
+    expanded = _backfill(engine, _EXPAND_SQL, batch_size)
+    with engine.begin() as conn:
+        conn.execute(text(DISABLE_SQL))
+    return expanded
+
+
+def storage_report(conn, repeat: int = 3) -> Dict[str, float]:
+    """
+    Sizes of ``cdm.observation`` in bytes, the average stored size of the
+    quality and parameter columns, and the best of ``repeat`` timings of a
+    full scan counting spike flagged observations.
+    """
+    report = dict(
+        conn.execute(
+            text(
+                """
+                SELECT
+                    pg_table_size('cdm.observation') AS table_bytes,
+                    pg_indexes_size('cdm.observation') AS index_bytes,
+                    pg_total_relation_size('cdm.observation') AS total_bytes
+                """
+            )
+        ).one()._mapping
+    )
+    compact = is_enabled(conn)
+    stored = ["result_quality", "parameter"]
+    if compact:
+        stored += COMPACT_COLUMNS
+        flagged = f"qc_flags & {CHECKS['spike']} <> 0"
+    else:
+        flagged = (
+            f"CAST(result_quality->>'qc_flags' AS integer) & {CHECKS['spike']} <> 0"
+        )
+    size = " + ".join(f"coalesce(pg_column_size({name}), 0)" for name in stored)
+    report["avg_document_bytes"] = float(
+        conn.execute(text(f"SELECT avg({size}) FROM cdm.observation")).scalar() or 0
+    )
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        conn.execute(
+            text(f"SELECT count(*) FROM cdm.observation WHERE {flagged}")
+        ).scalar()
+        timings.append(time.perf_counter() - started)
+    report["flag_scan_seconds"] = min(timings)
+    report["compact"] = compact
+    return report
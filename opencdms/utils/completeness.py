@@ -0,0 +1,242 @@
+"""Data completeness and gap reports computed inside the database"""
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Union
+
+from sqlalchemy import text
+
+Frequency = Union[timedelta, Dict[int, timedelta]]
+
+# Observations in the window, optionally restricted to hosts and properties
+_OBSERVATIONS = """
+    obs AS (
+        SELECT host_id, observed_property_id, phenomenon_end
+        FROM cdm.observation
+        WHERE phenomenon_end >= CAST(:start AS timestamptz)
+          AND phenomenon_end < CAST(:end AS timestamptz)
+          AND (CAST(:host_ids AS text[]) IS NULL
+               OR host_id = ANY(CAST(:host_ids AS text[])))
+          AND (CAST(:property_ids AS integer[]) IS NULL
+               OR observed_property_id = ANY(CAST(:property_ids AS integer[])))
+    )"""
+
+# Nominal frequency of each property in seconds
+_FREQUENCIES = """
+    freq AS (
+        SELECT *
+        FROM unnest(
+            CAST(:freq_properties AS integer[]),
+            CAST(:freq_seconds AS double precision[])
+        ) AS f(observed_property_id, seconds)
+    )"""
+
+# Host / property pairs that are expected to report, with their time step
+_PAIRS = """
+    pairs AS (
+        SELECT h.host_id, p.observed_property_id
+        FROM unnest(CAST(:host_ids AS text[])) AS h(host_id)
+        CROSS JOIN unnest(CAST(:property_ids AS integer[]))
+            AS p(observed_property_id)
+        WHERE :explicit_pairs
+        UNION
+        SELECT DISTINCT host_id, observed_property_id
+        FROM obs
+        WHERE NOT :explicit_pairs
+    ),
+    pairs_step AS (
+        SELECT
+            pairs.host_id,
+            pairs.observed_property_id,
+            make_interval(
+                secs => COALESCE(freq.seconds, :default_seconds)
+            ) AS step
+        FROM pairs
+        LEFT JOIN freq USING (observed_property_id)
+        WHERE COALESCE(freq.seconds, :default_seconds) IS NOT NULL
+    )"""
+
+_COMPLETENESS = f"""
+WITH {_OBSERVATIONS},{_FREQUENCIES},{_PAIRS},
+    slots AS (
+        SELECT ps.host_id, ps.observed_property_id, s.slot
+        FROM pairs_step AS ps
+        CROSS JOIN LATERAL generate_series(
+            CAST(:start AS timestamptz),
+            CAST(:end AS timestamptz) - ps.step,
+            ps.step
+        ) AS s(slot)
+    ),
+    observed AS (
+        SELECT DISTINCT
+            obs.host_id,
+            obs.observed_property_id,
+            CAST(:start AS timestamptz) + floor(
+                extract(epoch FROM obs.phenomenon_end - CAST(:start AS timestamptz))
+                / extract(epoch FROM ps.step)
+            ) * ps.step AS slot
+        FROM obs
+        JOIN pairs_step AS ps USING (host_id, observed_property_id)
+    )
+SELECT
+    slots.host_id,
+    slots.observed_property_id,
+    count(*) AS expected,
+    count(observed.slot) AS observed,
+    count(*) - count(observed.slot) AS missing,
+    round(100.0 * count(observed.slot) / count(*), 2) AS completeness
+FROM slots
+LEFT JOIN observed USING (host_id, observed_property_id, slot)
+GROUP BY slots.host_id, slots.observed_property_id
+ORDER BY slots.host_id, slots.observed_property_id
+"""
+
+# Number of time steps in an interval
+_STEPS = "extract(epoch FROM {}) / extract(epoch FROM ps.step)"
+
+# Slots missing in each gap. Between observations and after the last one
+# the slots are strictly inside the gap. From the window start they include
+# the slot at ``:start``, as the slots counted by ``completeness`` do.
+_GAPS = f"""
+WITH {_OBSERVATIONS},{_FREQUENCIES},{_PAIRS},
+    ordered AS (
+        SELECT
+            obs.host_id,
+            obs.observed_property_id,
+            obs.phenomenon_end,
+            lag(obs.phenomenon_end) OVER (
+                PARTITION BY obs.host_id, obs.observed_property_id
+                ORDER BY obs.phenomenon_end
+            ) AS previous_end
+        FROM obs
+    ),
+    gaps AS (
+        -- between consecutive observations
+        SELECT
+            o.host_id,
+            o.observed_property_id,
+            o.previous_end AS gap_start,
+            o.phenomenon_end AS gap_end,
+            CAST(ceil({_STEPS.format("o.phenomenon_end - o.previous_end")})
+                 AS integer) - 1 AS missing
+        FROM ordered AS o
+        JOIN pairs_step AS ps USING (host_id, observed_property_id)
+        WHERE o.phenomenon_end - o.previous_end > ps.step
+        UNION ALL
+        -- from the window start to the first observation
+        SELECT
+            o.host_id,
+            o.observed_property_id,
+            CAST(:start AS timestamptz),
+            o.phenomenon_end,
+            CAST(floor({_STEPS.format("o.phenomenon_end - CAST(:start AS timestamptz)")})
+                 AS integer)
+        FROM ordered AS o
+        JOIN pairs_step AS ps USING (host_id, observed_property_id)
+        WHERE o.previous_end IS NULL
+          AND o.phenomenon_end - CAST(:start AS timestamptz) >= ps.step
+        UNION ALL
+        -- from the last observation to the window end
+        SELECT
+            o.host_id,
+            o.observed_property_id,
+            max(o.phenomenon_end),
+            CAST(:end AS timestamptz),
+            CAST(ceil({_STEPS.format("CAST(:end AS timestamptz) - max(o.phenomenon_end)")})
+                 AS integer) - 1
+        FROM obs AS o
+        JOIN pairs_step AS ps USING (host_id, observed_property_id)
+        GROUP BY o.host_id, o.observed_property_id, ps.step
+        HAVING CAST(:end AS timestamptz) - max(o.phenomenon_end) > ps.step
+        UNION ALL
+        -- expected pairs without a single observation in the window
+        SELECT
+            ps.host_id,
+            ps.observed_property_id,
+            CAST(:start AS timestamptz),
+            CAST(:end AS timestamptz),
+            CAST(floor({_STEPS.format("CAST(:end AS timestamptz) - CAST(:start AS timestamptz)")})
+                 AS integer)
+        FROM pairs_step AS ps
+        WHERE CAST(:end AS timestamptz) - CAST(:start AS timestamptz) >= ps.step
+          AND NOT EXISTS (
+            SELECT 1 FROM obs
+            WHERE obs.host_id = ps.host_id
+              AND obs.observed_property_id = ps.observed_property_id
+        )
+    )
+SELECT
+    host_id,
+    observed_property_id,
+    gap_start,
+    gap_end,
+    gap_end - gap_start AS duration,
+    missing
+FROM gaps
+ORDER BY host_id, observed_property_id, gap_start
+"""
+
+
+def _params(
+    start: datetime,
+    end: datetime,
+    frequency: Frequency,
+    host_ids: Optional[Iterable[str]],
+    property_ids: Optional[Iterable[int]],
+) -> dict:
+    if isinstance(frequency, timedelta):
+        frequencies, default = {}, frequency.total_seconds()
+    else:
+        frequencies, default = dict(frequency), None
+    host_ids = list(host_ids) if host_ids is not None else None
+    if property_ids is not None:
+        property_ids = list(property_ids)
+    elif frequencies:
+        property_ids = list(frequencies)
+    return {
+        "start": start,
+        "end": end,
+        "host_ids": host_ids,
+        "property_ids": property_ids,
+        "explicit_pairs": host_ids is not None and property_ids is not None,
+        "freq_properties": list(frequencies),
+        "freq_seconds": [f.total_seconds() for f in frequencies.values()],
+        "default_seconds": default,
+    }
+
+
+def completeness(
+    conn,
+    start: datetime,
+    end: datetime,
+    frequency: Frequency,
+    host_ids: Optional[Iterable[str]] = None,
+    property_ids: Optional[Iterable[int]] = None,
+) -> List:
+    """
+    Return expected, observed and missing time slots and the completeness
+    percentage per host and observed property between ``start`` and ``end``.
+
+    ``frequency`` is the nominal reporting interval, either one for every
+    property or a mapping of observed_property id to interval. When both
+    ``host_ids`` and ``property_ids`` are given every combination is
+    reported, including those with no data at all; otherwise only pairs with
+    at least one observation in the window are.
+    """
+    params = _params(start, end, frequency, host_ids, property_ids)
+    return conn.execute(text(_COMPLETENESS), params).fetchall()
+
+
+def gaps(
+    conn,
+    start: datetime,
+    end: datetime,
+    frequency: Frequency,
+    host_ids: Optional[Iterable[str]] = None,
+    property_ids: Optional[Iterable[int]] = None,
+) -> List:
+    """
+    Return intervals longer than the nominal frequency without observations,
+    per host and observed property, with the number of missing reports in
+    each. Arguments are as for ``completeness``.
+    """
+    params = _params(start, end, frequency, host_ids, property_ids)
+    return conn.execute(text(_GAPS), params).fetchall()
@@ -1,7 +1,21 @@
 from opencdms.config import config
-from sqlalchemy import create_engine, func
+from sqlalchemy import create_engine, func, text
 from sqlalchemy.orm import sessionmaker, Query
 
+from opencdms.utils.limits import install
+
+# Transaction setting marking maintenance rewrites of rows (backfills) that
+# leave observations unchanged. The triggers keeping the change feed, latest
+# observations, feature closure and tile changes current skip such statements.
+MAINTENANCE_SETTING = "opencdms.maintenance"
+
+# First statement of those triggers
+SKIP_MAINTENANCE_SQL = (
+    f"IF current_setting('{MAINTENANCE_SETTING}', true) = 'on' THEN\n"
+    "        RETURN NULL;\n"
+    "    END IF;"
+)
+
 
 def get_connection_string(
     engine: str,
@@ -28,13 +42,52 @@ def get_cdm_connection_string() -> str:
 
 
 def cdm_session():
+    """
+    Session on the CDM database. Transactions inside an ``operation`` of
+    ``opencdms.utils.limits`` use its statement timeout and deadline.
+    """
     DB_URL = get_cdm_connection_string()
-    db_engine = create_engine(DB_URL)
+    db_engine = install(create_engine(DB_URL))
     SessionLocal = sessionmaker(bind=db_engine)
     session = SessionLocal()
     return session
 
 
+def maintenance(conn):
+    """Mark the current transaction of ``conn`` as maintenance"""
+    conn.execute(
+        text("SELECT set_config(:name, 'on', true)"), {"name": MAINTENANCE_SETTING}
+    )
+
+
+# Observations changed after a watermark, polled by tile caches and the
+# change feed replay, built by ``install_change_date_index``
+CHANGE_DATE_INDEX = "observation_change_date ON cdm.observation (change_date)"
+
+
+def create_index_concurrently(engine, name: str, definition: str):
+    """
+    Run ``CREATE INDEX CONCURRENTLY IF NOT EXISTS <definition>`` outside of
+    any transaction, so the table stays writable while the index is built.
+    An invalid index ``name`` (schema qualified) left behind by an
+    interrupted build is dropped first.
+    """
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        valid = conn.execute(
+            text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+            {"name": name},
+        ).scalar()
+        if valid is False:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {definition}"))
+
+
+def install_change_date_index(engine):
+    """Create the ``change_date`` index of ``cdm.observation``, concurrently"""
+    create_index_concurrently(engine, "cdm.observation_change_date", CHANGE_DATE_INDEX)
+
+
 def get_count(q: Query):
     """
     Return the number of rows that matches a query
@@ -44,3 +97,22 @@ def get_count(q: Query):
     ).order_by(None)
     count = q.session.execute(count_q).scalar()
     return count
+
+
+def get_cdm_replica_connection_strings() -> list:
+    """Connection strings of the read replicas in ``CDM_DB_REPLICAS``"""
+    replicas = []
+    for replica in filter(None, config.CDM_DB_REPLICAS.split(",")):
+        host, _, port = replica.strip().partition(":")
+        replicas.append(
+            get_connection_string(
+                engine=config.CDM_DB_ENGINE,
+                driver=config.CDM_DB_DRIVER,
+                user=config.CDM_DB_USER,
+                password=config.CDM_DB_PASS,
+                host=host,
+                port=port or config.CDM_DB_PORT,
+                db_name=config.CDM_DB_NAME,
+            )
+        )
+    return replicas
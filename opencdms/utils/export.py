@@ -0,0 +1,193 @@
+"""Streaming CSV and newline delimited GeoJSON export of observations"""
+import csv
+import io
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from itertools import chain
+from typing import IO, Iterator, Optional, Union
+
+from geoalchemy2 import Geometry
+from sqlalchemy import cast, func
+
+from opencdms.provider.opencdmsdb import observation
+from opencdms.utils.archive import iter_archive_rows
+from opencdms.utils.compact import source_table
+from opencdms.utils.query import observation_query
+from opencdms.utils.units import (
+    canonical_columns,
+    canonical_records,
+    canonical_units,
+    join_units,
+)
+
+# Rows fetched from the server side cursor at a time
+DEFAULT_BATCH_SIZE = 10000
+
+PROPERTY_COLUMNS = [c for c in observation.c if c.name != "location"]
+
+
+def _property_columns(table, canonical: bool = False):
+    columns = table.c
+    if canonical:
+        columns = {c.name: c for c in canonical_columns(table)}
+    return [columns[c.name] for c in PROPERTY_COLUMNS]
+
+
+def _query(table, columns, canonical: bool, **filters):
+    query = observation_query(columns=columns, table=table, **filters)
+    if canonical:
+        query = query.select_from(join_units(table))
+    return query
+
+
+def _archived(conn, archive_path, batch_size: int, canonical: bool, **filters):
+    """Batches of archived rows, in canonical units when ``canonical``"""
+    batches = iter_archive_rows(archive_path, batch_size, conn, **filters)
+    if not canonical:
+        yield from batches
+        return
+    names = [c.name for c in PROPERTY_COLUMNS] + ["longitude", "latitude"]
+    units = canonical_units(conn)
+    for rows in batches:
+        yield canonical_records(rows, names, units)
+
+
+def _stream(conn, query, batch_size: int):
+    result = conn.execution_options(
+        stream_results=True, max_row_buffer=batch_size
+    ).execute(query)
+    yield from result.partitions(batch_size)
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _csv_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=_json_default)
+    return value
+
+
+def iter_csv(
+    conn,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    archive_path: Optional[str] = None,
+    canonical: bool = False,
+    **filters,
+) -> Iterator[str]:
+    """
+    Yield CSV text for observations matching ``filters`` (see
+    ``observation_query``), one chunk per batch read from a server side
+    cursor, with location split into longitude and latitude columns.
+    ``canonical`` gives values in the canonical units of their observed
+    property (see ``opencdms.utils.units``).
+
+    Archived observations in the window (see ``opencdms.utils.archive``,
+    ``archive_path`` defaults to ``CDM_ARCHIVE_PATH``) come first, except
+    those still in the database.
+    """
+    table = source_table(conn)
+    location = cast(table.c.location, Geometry)
+    columns = _property_columns(table, canonical) + [
+        func.ST_X(location).label("longitude"),
+        func.ST_Y(location).label("latitude"),
+    ]
+    query = _query(table, columns, canonical, **filters)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([c.name for c in columns])
+    yield buffer.getvalue()
+    for rows in chain(
+        _archived(conn, archive_path, batch_size, canonical, **filters),
+        _stream(conn, query, batch_size),
+    ):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([_csv_value(v) for v in row] for row in rows)
+        yield buffer.getvalue()
+
+
+def iter_geojsonseq(
+    conn,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    archive_path: Optional[str] = None,
+    canonical: bool = False,
+    **filters,
+) -> Iterator[str]:
+    """
+    Yield newline delimited GeoJSON features for observations matching
+    ``filters``, archived ones not in the database first. Geometries are
+    encoded by PostGIS and embedded as is.
+    """
+    table = source_table(conn)
+    columns = _property_columns(table, canonical) + [
+        func.ST_AsGeoJSON(table.c.location).label("geometry")
+    ]
+    query = _query(table, columns, canonical, **filters)
+    names = [c.name for c in PROPERTY_COLUMNS]
+    for rows in _archived(conn, archive_path, batch_size, canonical, **filters):
+        yield "".join(_archived_feature(names, row) for row in rows)
+    for rows in _stream(conn, query, batch_size):
+        lines = []
+        for row in rows:
+            properties = json.dumps(
+                dict(zip(names, row[:-1])), default=_json_default
+            )
+            lines.append(
+                '{"type":"Feature","id":%s,"geometry":%s,"properties":%s}\n'
+                % (json.dumps(row.id), row.geometry or "null", properties)
+            )
+        yield "".join(lines)
+
+
+def _archived_feature(names, row) -> str:
+    """GeoJSON line of an archived row, which has longitude and latitude"""
+    longitude, latitude = row[-2:]
+    geometry = (
+        '{"type":"Point","coordinates":[%r,%r]}' % (longitude, latitude)
+        if longitude is not None and latitude is not None
+        else "null"
+    )
+    properties = json.dumps(dict(zip(names, row[:-2])), default=_json_default)
+    return '{"type":"Feature","id":%s,"geometry":%s,"properties":%s}\n' % (
+        json.dumps(row[0]),
+        geometry,
+        properties,
+    )
+
+
+FORMATS = {
+    "csv": iter_csv,
+    "geojson": iter_geojsonseq,
+}
+
+
+def export(
+    conn,
+    output: Union[str, IO[str]],
+    format: str = "csv",
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    canonical: bool = False,
+    **filters,
+) -> None:
+    """
+    Write observations to a path or text file object as they are read, in
+    the canonical units of their observed property when ``canonical``
+    """
+    chunks = FORMATS[format](
+        conn, batch_size=batch_size, canonical=canonical, **filters
+    )
+    if isinstance(output, str):
+        with open(output, "w", newline="", encoding="utf-8") as stream:
+            stream.writelines(chunks)
+    else:
+        output.writelines(chunks)
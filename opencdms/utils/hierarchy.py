@@ -0,0 +1,196 @@
+"""
+Closure table of the feature hierarchy (``cdm.feature.parent_id``).
+
+``cdm.feature_closure`` holds one row per (ancestor, descendant) pair,
+including each feature with itself at depth 0, so all features under or
+above a feature are one indexed lookup and observations can be filtered by
+"any feature under X" with a semi-join instead of recursion.
+"""
+from typing import Iterable, List, Optional, Union
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, select, text
+
+from opencdms.provider.opencdmsdb import observation
+from opencdms.utils.db import SKIP_MAINTENANCE_SQL, create_index_concurrently
+
+# Deeper chains are taken to be cycles
+MAX_DEPTH = 1000
+
+# Store all ancestors of the features in ``{source}`` (an ``s`` with an
+# ``id`` column), walked up ``cdm.feature`` so the insertion order of parents and
+# children does not matter, and count the features found above themselves
+_WALK_UP = f"""
+    WITH RECURSIVE up (descendant_id, ancestor_id, depth) AS (
+        SELECT s.id, s.id, 0 FROM {{source}}
+        UNION ALL
+        SELECT up.descendant_id, f.parent_id, up.depth + 1
+        FROM up JOIN cdm.feature AS f ON f.id = up.ancestor_id
+        WHERE f.parent_id IS NOT NULL
+          AND (up.depth = 0 OR up.ancestor_id <> up.descendant_id)
+          AND up.depth < {MAX_DEPTH}
+    ),
+    saved AS (
+        INSERT INTO cdm.feature_closure (ancestor_id, descendant_id, depth)
+        SELECT ancestor_id, descendant_id, min(depth) FROM up
+        WHERE up.depth = 0 OR up.ancestor_id <> up.descendant_id
+        GROUP BY ancestor_id, descendant_id
+        ON CONFLICT (ancestor_id, descendant_id) DO UPDATE SET depth = EXCLUDED.depth
+    )
+    SELECT count(*) {{into}} FROM up
+    WHERE (up.depth > 0 AND up.ancestor_id = up.descendant_id)
+       OR up.depth >= {MAX_DEPTH}
+"""
+
+# Observations of the features found in the closure, built by
+# ``install_indexes`` without blocking writes
+OBSERVATION_INDEX = (
+    "observation_feature_of_interest ON cdm.observation (feature_of_interest_id)"
+)
+
+INSTALL_SQL = f"""
+CREATE TABLE IF NOT EXISTS cdm.feature_closure (
+    ancestor_id text NOT NULL REFERENCES cdm.feature (id) ON DELETE CASCADE,
+    descendant_id text NOT NULL REFERENCES cdm.feature (id) ON DELETE CASCADE,
+    depth integer NOT NULL,
+    PRIMARY KEY (ancestor_id, descendant_id)
+);
+CREATE INDEX IF NOT EXISTS feature_closure_descendant
+    ON cdm.feature_closure (descendant_id, depth);
+
+CREATE OR REPLACE FUNCTION cdm.refresh_feature_closure() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    moved text[];
+    cycles bigint;
+BEGIN
+    {SKIP_MAINTENANCE_SQL}
+    IF TG_OP = 'INSERT' THEN
+        {_WALK_UP.format(source="new_rows AS s", into="INTO cycles")};
+    ELSE
+        -- Moved features and everything below them get their ancestors again
+        SELECT array_agg(DISTINCT c.descendant_id) INTO moved
+        FROM new_rows AS n
+        JOIN old_rows AS o ON o.id = n.id
+        JOIN cdm.feature_closure AS c ON c.ancestor_id = n.id
+        WHERE n.parent_id IS DISTINCT FROM o.parent_id;
+        IF moved IS NULL THEN
+            RETURN NULL;
+        END IF;
+        DELETE FROM cdm.feature_closure
+        WHERE descendant_id = ANY (moved) AND depth > 0;
+        {_WALK_UP.format(source="unnest(moved) AS s (id)", into="INTO cycles")};
+    END IF;
+    IF cycles > 0 THEN
+        RAISE EXCEPTION 'cdm.feature parent_id forms a cycle';
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS feature_closure_insert ON cdm.feature;
+CREATE TRIGGER feature_closure_insert
+    AFTER INSERT ON cdm.feature
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION cdm.refresh_feature_closure();
+
+DROP TRIGGER IF EXISTS feature_closure_update ON cdm.feature;
+CREATE TRIGGER feature_closure_update
+    AFTER UPDATE ON cdm.feature
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION cdm.refresh_feature_closure();
+"""
+
+UNINSTALL_SQL = """
+DROP TRIGGER IF EXISTS feature_closure_insert ON cdm.feature;
+DROP TRIGGER IF EXISTS feature_closure_update ON cdm.feature;
+DROP FUNCTION IF EXISTS cdm.refresh_feature_closure();
+DROP TABLE IF EXISTS cdm.feature_closure;
+"""
+
+# For SQLAlchemy queries, the table is created by ``install``
+feature_closure = Table(
+    "feature_closure",
+    MetaData(),
+    Column("ancestor_id", String, primary_key=True),
+    Column("descendant_id", String, primary_key=True),
+    Column("depth", Integer),
+    schema="cdm",
+)
+
+
+def install_indexes(engine):
+    """Create the ``cdm.observation`` index of closure queries, concurrently"""
+    create_index_concurrently(
+        engine, "cdm.observation_feature_of_interest", OBSERVATION_INDEX
+    )
+
+
+def install(conn, backfill: bool = True):
+    """Create the closure table and its triggers, filling it from features"""
+    conn.execute(text(INSTALL_SQL))
+    if backfill:
+        rebuild(conn)
+
+
+def uninstall(conn):
+    conn.execute(text(UNINSTALL_SQL))
+
+
+def rebuild(conn):
+    """Recompute the closure table from ``cdm.feature``"""
+    conn.execute(text("TRUNCATE cdm.feature_closure"))
+    cycles = conn.execute(
+        text(_WALK_UP.format(source="cdm.feature AS s", into=""))
+    ).scalar()
+    if cycles:
+        raise ValueError("cdm.feature parent_id forms a cycle")
+
+
+def _ids(feature_ids: Union[str, Iterable[str]]) -> List[str]:
+    return [feature_ids] if isinstance(feature_ids, str) else list(feature_ids)
+
+
+def descendants_query(
+    feature_ids: Union[str, Iterable[str]],
+    include_self: bool = True,
+    max_depth: Optional[int] = None,
+):
+    """Ids of the features under ``feature_ids``, one or many"""
+    c = feature_closure.c
+    q = select(c.descendant_id).where(c.ancestor_id.in_(_ids(feature_ids)))
+    if not include_self:
+        q = q.where(c.depth > 0)
+    if max_depth is not None:
+        q = q.where(c.depth <= max_depth)
+    return q
+
+
+def ancestors_query(feature_id: str, include_self: bool = False):
+    """Ids of the features above ``feature_id``, nearest first"""
+    c = feature_closure.c
+    q = select(c.ancestor_id).where(c.descendant_id == feature_id).order_by(c.depth)
+    if not include_self:
+        q = q.where(c.depth > 0)
+    return q
+
+
+def descendants(conn, feature_ids, include_self: bool = True, max_depth=None) -> List[str]:
+    return conn.execute(
+        descendants_query(feature_ids, include_self, max_depth)
+    ).scalars().all()
+
+
+def ancestors(conn, feature_id: str, include_self: bool = False) -> List[str]:
+    return conn.execute(ancestors_query(feature_id, include_self)).scalars().all()
+
+
+def under_features(
+    feature_ids: Union[str, Iterable[str]],
+    column=observation.c.feature_of_interest_id,
+    max_depth: Optional[int] = None,
+):
+    """
+    Condition on ``column`` (default ``feature_of_interest_id``): the
+    feature is one of ``feature_ids`` or anywhere under them.
+    """
+    return column.in_(descendants_query(feature_ids, max_depth=max_depth))
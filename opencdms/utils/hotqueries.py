@@ -0,0 +1,285 @@
+"""
+Registry of named hot queries: shapes the API runs many times a second.
+
+Each query is built once as a lambda statement, so SQLAlchemy skips
+rebuilding it and reuses the compiled form from its compiled cache. On
+PostgreSQL it also runs as a server side prepared statement, created once
+per pooled connection, so the server stops parsing and planning it on every
+call. List parameters bind as arrays (``= ANY(...)``) to keep one shape
+whatever their length.
+
+Queries reading compacted columns register a variant over the
+``cdm.observation_compat`` view, run instead when compact storage is
+enabled. That is checked once per pooled connection, so dispose of the
+engine's pool after enabling or disabling it.
+"""
+import re
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import (
+    Integer,
+    String,
+    any_,
+    bindparam,
+    inspect,
+    lambda_stmt,
+    select,
+)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.engine import Engine
+
+from opencdms.provider.opencdmsdb import observation
+from opencdms.utils.compact import is_enabled, observation_compat
+
+# Key in the DBAPI connection ``info`` of the statements prepared on it
+_PREPARED_KEY = "opencdms_prepared"
+
+# Key in the DBAPI connection ``info`` of whether compact storage is enabled
+_COMPACT_KEY = "opencdms_compact"
+
+_PARAMETER = re.compile(r"%\((\w+)\)s")
+
+
+@dataclass()
+class HotQuery:
+    """A named query shape and its PostgreSQL ``PREPARE`` form"""
+
+    name: str
+    build: Callable
+    statement: object = None
+    prepare_sql: str = ""
+    parameters: Tuple[str, ...] = ()
+    # Variant run when compact storage is enabled
+    compat: Optional["HotQuery"] = None
+
+    def __post_init__(self):
+        self.statement = lambda_stmt(self.build)
+        compiled = self.build().compile(dialect=postgresql.dialect())
+        names = []
+
+        def number(match):
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return f"${names.index(match.group(1)) + 1}"
+
+        sql = _PARAMETER.sub(number, compiled.string).replace("%%", "%")
+        self.prepare_sql = f"PREPARE {self.prepared_name} AS {sql}"
+        self.parameters = tuple(names)
+
+    @property
+    def prepared_name(self) -> str:
+        return f"opencdms_{self.name}"
+
+    def execute_sql(self) -> str:
+        arguments = ", ".join(f"%({name})s" for name in self.parameters)
+        return f"EXECUTE {self.prepared_name} ({arguments})"
+
+
+@dataclass()
+class HotQueryRegistry:
+    """Named hot queries, see ``register`` and ``execute``"""
+
+    queries: Dict[str, HotQuery] = field(default_factory=dict)
+    # Server side prepared statements on PostgreSQL
+    prepare: bool = True
+
+    def register(
+        self, name: str, build: Callable, compat: Optional[Callable] = None
+    ) -> HotQuery:
+        """
+        Register ``build``, a function without arguments returning the
+        statement with named ``bindparam`` parameters, and optionally
+        ``compat``, the same statement run when compact storage is enabled.
+        """
+        if name in self.queries:
+            raise ValueError(f"Hot query {name} is already registered")
+        if not re.fullmatch(r"\w+", name):
+            raise ValueError(f"Invalid hot query name: {name}")
+        query = self.queries[name] = HotQuery(name, build)
+        if compat is not None:
+            query.compat = HotQuery(f"{name}_compat", compat)
+        return query
+
+    def __getitem__(self, name: str) -> HotQuery:
+        try:
+            return self.queries[name]
+        except KeyError:
+            raise KeyError(f"Unknown hot query: {name}")
+
+    def resolve(self, conn, name: str) -> HotQuery:
+        """Query ``name``, or its variant when ``conn`` has compact storage"""
+        query = self[name]
+        if query.compat is None or conn.dialect.name != "postgresql":
+            return query
+        if _COMPACT_KEY not in conn.info:
+            conn.info[_COMPACT_KEY] = is_enabled(conn)
+        return query.compat if conn.info[_COMPACT_KEY] else query
+
+    def execute(self, conn, name: str, **params):
+        """Run hot query ``name`` on ``conn`` with its named parameters"""
+        query = self.resolve(conn, name)
+        missing = set(query.parameters) - set(params)
+        if missing:
+            raise TypeError(f"{name} missing parameters: {', '.join(sorted(missing))}")
+        if not self.prepare or conn.dialect.name != "postgresql":
+            return conn.execute(query.statement, params)
+        prepared = conn.info.setdefault(_PREPARED_KEY, set())
+        if query.name not in prepared:
+            conn.exec_driver_sql(query.prepare_sql)
+            prepared.add(query.name)
+        return conn.exec_driver_sql(
+            query.execute_sql(), {p: params[p] for p in query.parameters}
+        )
+
+
+def _latest_observation(table):
+    def build():
+        c = table.c
+        return (
+            select(
+                c.host_id,
+                c.observed_property_id,
+                c.id,
+                c.phenomenon_end,
+                c.result_value,
+                c.result_quality,
+            )
+            .where(
+                c.host_id == any_(bindparam("host_ids", type_=ARRAY(String))),
+                c.observed_property_id
+                == any_(bindparam("observed_property_ids", type_=ARRAY(Integer))),
+            )
+            .distinct(c.host_id, c.observed_property_id)
+            .order_by(c.host_id, c.observed_property_id, c.phenomenon_end.desc())
+        )
+
+    return build
+
+
+def _observation_window(table):
+    def build():
+        c = table.c
+        return (
+            select(c.id, c.phenomenon_end, c.result_value, c.result_quality)
+            .where(
+                c.host_id == bindparam("host_id"),
+                c.observed_property_id == bindparam("observed_property_id"),
+                c.phenomenon_end >= bindparam("start"),
+                c.phenomenon_end < bindparam("end"),
+            )
+            .order_by(c.phenomenon_end)
+        )
+
+    return build
+
+
+def _observation_by_id(table):
+    def build():
+        c = table.c
+        return select(
+            c.id,
+            c.host_id,
+            c.observed_property_id,
+            c.phenomenon_end,
+            c.result_value,
+            c.result_quality,
+        ).where(c.id == bindparam("id"))
+
+    return build
+
+
+registry = HotQueryRegistry()
+registry.register(
+    "latest_observation",
+    _latest_observation(observation),
+    _latest_observation(observation_compat),
+)
+registry.register(
+    "observation_window",
+    _observation_window(observation),
+    _observation_window(observation_compat),
+)
+registry.register(
+    "observation_by_id",
+    _observation_by_id(observation),
+    _observation_by_id(observation_compat),
+)
+
+
+def execute(conn, name: str, **params):
+    """Run a query of the default registry"""
+    return registry.execute(conn, name, **params)
+
+
+def benchmark_params(conn) -> Optional[Dict[str, dict]]:
+    """Parameters for the default hot queries from an existing observation"""
+    row = conn.execute(
+        select(
+            observation.c.id,
+            observation.c.host_id,
+            observation.c.observed_property_id,
+            observation.c.phenomenon_end,
+        ).limit(1)
+    ).first()
+    if row is None:
+        return None
+    params = {
+        "latest_observation": {
+            "host_ids": [row.host_id],
+            "observed_property_ids": [row.observed_property_id],
+        },
+        "observation_window": {
+            "host_id": row.host_id,
+            "observed_property_id": row.observed_property_id,
+            "start": datetime(1900, 1, 1, tzinfo=timezone.utc),
+            "end": row.phenomenon_end,
+        },
+        "observation_by_id": {"id": row.id},
+    }
+    if "current_conditions" in registry.queries and inspect(conn).has_table(
+        "latest_observation", schema="cdm"
+    ):
+        params["current_conditions"] = {
+            "observed_property_ids": [row.observed_property_id]
+        }
+    return params
+
+
+def benchmark(
+    engine: Engine,
+    params: Dict[str, dict],
+    calls: int = 1000,
+    hot: Optional[HotQueryRegistry] = None,
+) -> Dict[str, Dict[str, float]]:
+    """
+    Microseconds per call of each query, run ``calls`` times on one pooled
+    connection in three ways: built and compiled from scratch ("uncached"),
+    as a cached lambda statement ("cached") and as a prepared statement
+    ("prepared"). The first difference is the compile saving, the second
+    the parse and plan saving.
+    """
+    hot = hot or registry
+    prepared = HotQueryRegistry(hot.queries, prepare=True)
+    results = {}
+    with engine.connect() as conn:
+        uncached = conn.execution_options(compiled_cache=None)
+        for name, query_params in params.items():
+            query = hot.resolve(conn, name)
+            timings = {}
+            runs: List[Tuple[str, Callable]] = [
+                ("uncached", lambda: uncached.execute(query.build(), query_params)),
+                ("cached", lambda: conn.execute(query.statement, query_params)),
+                ("prepared", lambda: prepared.execute(conn, name, **query_params)),
+            ]
+            for mode, run in runs:
+                run().fetchall()  # warm up: caches, prepare
+                started = time.perf_counter()
+                for _ in range(calls):
+                    run().fetchall()
+                timings[mode] = (time.perf_counter() - started) / calls * 1e6
+            results[name] = timings
+    return results
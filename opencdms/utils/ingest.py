@@ -0,0 +1,296 @@
+"""
+Multi-process ingest of observations: a reader, a pool of worker processes
+validating and transforming chunks, and a few writer processes copying them
+into ``cdm.observation``, linked by bounded queues so memory stays capped
+when the database falls behind.
+"""
+import json
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+import pandas as pd
+from sqlalchemy import create_engine
+
+from opencdms.utils.bulk import (
+    copy_observations,
+    features_to_frame,
+    validate_observations,
+)
+from opencdms.utils.db import get_cdm_connection_string
+
+DEFAULT_CHUNK_SIZE = 10000
+
+# Marks the end of a queue's input, one per consumer
+_DONE = None
+
+
+@dataclass()
+class StageStats:
+    """Work done by one stage, summed over its processes"""
+
+    chunks: int = 0
+    rows: int = 0
+    busy_seconds: float = 0.0
+
+
+@dataclass()
+class IngestResult:
+    """Totals, per stage statistics and sampled queue depths of a run"""
+
+    rows_read: int = 0
+    rows_written: int = 0
+    rows_rejected: int = 0
+    seconds: float = 0.0
+    stages: Dict[str, StageStats] = field(default_factory=dict)
+    # Sampled (elapsed seconds, parse queue depth, write queue depth)
+    queue_depths: List[tuple] = field(default_factory=list)
+    # First error messages of rejected rows, as (chunk, row, messages)
+    errors: List[tuple] = field(default_factory=list)
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows_written / self.seconds if self.seconds else 0.0
+
+
+def csv_chunks(
+    paths: Iterable[str], chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Iterator[pd.DataFrame]:
+    """Read CSV files with observation columns as raw (string) chunks"""
+    for path in paths:
+        yield from pd.read_csv(
+            path, chunksize=chunk_size, dtype=str, keep_default_na=False, na_values=[""]
+        )
+
+
+def feature_chunks(
+    features: Iterable[dict], chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Iterator[pd.DataFrame]:
+    """Group GeoJSON observation features into frames of ``chunk_size``"""
+    chunk = []
+    for feature in features:
+        chunk.append(feature)
+        if len(chunk) >= chunk_size:
+            yield features_to_frame(chunk)
+            chunk = []
+    if chunk:
+        yield features_to_frame(chunk)
+
+
+def geojsonseq_chunks(
+    paths: Iterable[str], chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Iterator[pd.DataFrame]:
+    """Read newline delimited GeoJSON files, as written by the export"""
+
+    def features():
+        for path in paths:
+            with open(path, encoding="utf-8") as stream:
+                for line in stream:
+                    if line.strip():
+                        yield json.loads(line)
+
+    return feature_chunks(features(), chunk_size)
+
+
+def _worker(inbox, outbox, events, transform):
+    while True:
+        item = inbox.get()
+        if item is _DONE:
+            return
+        number, df = item
+        try:
+            started = time.perf_counter()
+            if transform is not None:
+                df = transform(df)
+            df, errors = validate_observations(df)
+            busy = time.perf_counter() - started
+        except Exception:
+            events.put(("failed", "worker", traceback.format_exc()))
+            return
+        outbox.put((number, df, errors))
+        events.put(("worker", number, len(df), busy))
+
+
+def _writer(inbox, events, db_url, on_conflict):
+    engine = create_engine(db_url)
+    try:
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                return
+            number, df, errors = item
+            try:
+                started = time.perf_counter()
+                with engine.begin() as conn:
+                    result = copy_observations(
+                        conn, df, errors, on_conflict=on_conflict
+                    )
+                busy = time.perf_counter() - started
+            except Exception:
+                events.put(("failed", "writer", traceback.format_exc()))
+                return
+            rejected = {i: result.errors[i] for i in sorted(result.errors)[:10]}
+            events.put(("writer", number, result.inserted, busy, len(df), rejected))
+    finally:
+        engine.dispose()
+
+
+def _depth(q) -> int:
+    try:
+        return q.qsize()
+    except NotImplementedError:  # macOS
+        return -1
+
+
+class IngestError(RuntimeError):
+    """A worker or writer process failed, the run was stopped"""
+
+
+def ingest(
+    chunks: Iterable[pd.DataFrame],
+    workers: Optional[int] = None,
+    writers: int = 2,
+    queue_size: int = 4,
+    transform: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None,
+    on_conflict: str = "error",
+    db_url: Optional[str] = None,
+    sample_interval: float = 1.0,
+    progress: Optional[Callable[[IngestResult], None]] = None,
+) -> IngestResult:
+    """
+    Ingest raw observation chunks (see ``csv_chunks`` and ``feature_chunks``).
+
+    The calling process is the reader. ``workers`` processes (default: CPU
+    count) apply ``transform``, which must be picklable, and
+    ``validate_observations`` to each chunk; ``writers`` processes write
+    them with ``copy_observations``, one transaction per chunk. At most
+    ``queue_size`` chunks wait between stages, so the reader blocks when
+    the database falls behind. ``progress`` is called with the running
+    totals every ``sample_interval`` seconds.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    db_url = db_url or get_cdm_connection_string()
+    context = multiprocessing.get_context()
+    parse_queue = context.Queue(queue_size)
+    write_queue = context.Queue(queue_size)
+    events = context.Queue()
+
+    result = IngestResult(
+        stages={name: StageStats() for name in ("reader", "worker", "writer")}
+    )
+    processes = [
+        context.Process(
+            target=_worker, args=(parse_queue, write_queue, events, transform)
+        )
+        for _ in range(workers)
+    ] + [
+        context.Process(
+            target=_writer, args=(write_queue, events, db_url, on_conflict)
+        )
+        for _ in range(writers)
+    ]
+    for process in processes:
+        process.daemon = True
+        process.start()
+
+    started = time.perf_counter()
+    lock = threading.Lock()
+    failure = []
+    finished = threading.Event()
+
+    def handle(event):
+        kind = event[0]
+        if kind == "failed":
+            failure.append(f"{event[1]} failed:\n{event[2]}")
+            return
+        stats = result.stages[kind]
+        stats.chunks += 1
+        stats.busy_seconds += event[3]
+        if kind == "worker":
+            stats.rows += event[2]
+        else:
+            _, number, inserted, _, rows, rejected = event
+            stats.rows += inserted
+            result.rows_written += inserted
+            result.rows_rejected += rows - inserted
+            for row, messages in rejected.items():
+                if len(result.errors) < 100:
+                    result.errors.append((number, row, messages))
+
+    def monitor():
+        while not finished.wait(sample_interval):
+            with lock:
+                while True:
+                    try:
+                        handle(events.get_nowait())
+                    except queue.Empty:
+                        break
+                result.seconds = time.perf_counter() - started
+                result.queue_depths.append(
+                    (result.seconds, _depth(parse_queue), _depth(write_queue))
+                )
+                if progress is not None:
+                    progress(result)
+
+    thread = threading.Thread(target=monitor, daemon=True)
+    thread.start()
+
+    def put(q, item):
+        # Give up waiting on a full queue once a process has failed
+        while True:
+            try:
+                q.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                if failure:
+                    raise IngestError(failure[0])
+
+    def join(stage):
+        for process in stage:
+            while process.is_alive():
+                process.join(1.0)
+                if failure:
+                    raise IngestError(failure[0])
+
+    try:
+        reader = result.stages["reader"]
+        iterator = iter(chunks)
+        number = 0
+        while True:
+            read_started = time.perf_counter()
+            df = next(iterator, None)
+            if df is None:
+                break
+            with lock:
+                reader.busy_seconds += time.perf_counter() - read_started
+                reader.chunks += 1
+                reader.rows += len(df)
+                result.rows_read += len(df)
+            put(parse_queue, (number, df))
+            number += 1
+        for _ in range(workers):
+            put(parse_queue, _DONE)
+        join(processes[:workers])
+        for _ in range(writers):
+            put(write_queue, _DONE)
+        join(processes[workers:])
+    finally:
+        finished.set()
+        thread.join()
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    while True:
+        try:
+            handle(events.get(timeout=0.1))
+        except queue.Empty:
+            break
+    result.seconds = time.perf_counter() - started
+    if failure:
+        raise IngestError(failure[0])
+    return result
@@ -0,0 +1,271 @@
+"""
+Latest observation of every host and observed property, kept current by
+statement level triggers on ``cdm.observation``.
+
+Current conditions for the whole network then read one small table instead
+of a ``DISTINCT ON`` over all observations. The triggers see every write,
+including the bulk COPY and upsert paths, sync and the ORM.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Optional, Sequence
+
+import pandas as pd
+from geoalchemy2 import Geography, Geometry
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Float,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    any_,
+    bindparam,
+    cast,
+    func,
+    select,
+    text,
+)
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from opencdms.utils.db import SKIP_MAINTENANCE_SQL, create_index_concurrently
+from opencdms.utils.hotqueries import registry
+
+_COLUMNS = """
+    host_id, observed_property_id, observation_id, phenomenon_end,
+    result_value, result_uom, result_description, location, updated
+"""
+
+# The newest row per host and property of a set of observations ``o``
+_SELECT_LATEST = """
+    SELECT DISTINCT ON (o.host_id, o.observed_property_id)
+        o.host_id, o.observed_property_id, o.id, o.phenomenon_end,
+        CAST(o.result_value AS double precision), o.result_uom,
+        o.result_description, o.location, now()
+    FROM {source} AS o
+    WHERE o.host_id IS NOT NULL
+      AND o.observed_property_id IS NOT NULL
+      AND o.phenomenon_end IS NOT NULL
+    ORDER BY o.host_id, o.observed_property_id, o.phenomenon_end DESC, o.id DESC
+"""
+
+_UPSERT = f"""
+    INSERT INTO cdm.latest_observation AS l ({_COLUMNS})
+    {_SELECT_LATEST}
+    ON CONFLICT (host_id, observed_property_id) DO UPDATE SET
+        observation_id = EXCLUDED.observation_id,
+        phenomenon_end = EXCLUDED.phenomenon_end,
+        result_value = EXCLUDED.result_value,
+        result_uom = EXCLUDED.result_uom,
+        result_description = EXCLUDED.result_description,
+        location = EXCLUDED.location,
+        updated = EXCLUDED.updated
+    WHERE (EXCLUDED.phenomenon_end, EXCLUDED.observation_id)
+        >= (l.phenomenon_end, l.observation_id)
+"""
+
+# Finds the new latest row when the current one is updated or deleted,
+# built by ``install_indexes`` without blocking writes
+OBSERVATION_INDEX = (
+    "observation_host_property_end "
+    "ON cdm.observation (host_id, observed_property_id, phenomenon_end DESC)"
+)
+
+INSTALL_SQL = f"""
+CREATE TABLE IF NOT EXISTS cdm.latest_observation (
+    host_id text NOT NULL,
+    observed_property_id integer NOT NULL,
+    observation_id text NOT NULL,
+    phenomenon_end timestamptz NOT NULL,
+    result_value double precision,
+    result_uom text,
+    result_description text,
+    location geography(Point, 4326),
+    updated timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (host_id, observed_property_id)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS latest_observation_observation_id
+    ON cdm.latest_observation (observation_id);
+CREATE INDEX IF NOT EXISTS latest_observation_location
+    ON cdm.latest_observation USING gist (location);
+
+CREATE OR REPLACE FUNCTION cdm.refresh_latest_observation() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    {SKIP_MAINTENANCE_SQL}
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        -- Current rows that changed may no longer be the latest
+        DELETE FROM cdm.latest_observation AS l
+        USING old_rows AS o
+        WHERE l.observation_id = o.id;
+
+        INSERT INTO cdm.latest_observation ({_COLUMNS})
+        SELECT x.*
+        FROM (
+            SELECT DISTINCT o.host_id, o.observed_property_id
+            FROM old_rows AS o
+            WHERE NOT EXISTS (
+                SELECT 1 FROM cdm.latest_observation AS l
+                WHERE l.host_id = o.host_id
+                  AND l.observed_property_id = o.observed_property_id
+            )
+        ) AS missing
+        CROSS JOIN LATERAL (
+            SELECT
+                o.host_id, o.observed_property_id, o.id, o.phenomenon_end,
+                CAST(o.result_value AS double precision), o.result_uom,
+                o.result_description, o.location, now()
+            FROM cdm.observation AS o
+            WHERE o.host_id = missing.host_id
+              AND o.observed_property_id = missing.observed_property_id
+              AND o.phenomenon_end IS NOT NULL
+            ORDER BY o.phenomenon_end DESC, o.id DESC
+            LIMIT 1
+        ) AS x
+        ON CONFLICT DO NOTHING;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        {_UPSERT.format(source="new_rows")};
+    END IF;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS observation_latest_insert ON cdm.observation;
+CREATE TRIGGER observation_latest_insert
+    AFTER INSERT ON cdm.observation
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION cdm.refresh_latest_observation();
+
+DROP TRIGGER IF EXISTS observation_latest_update ON cdm.observation;
+CREATE TRIGGER observation_latest_update
+    AFTER UPDATE ON cdm.observation
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION cdm.refresh_latest_observation();
+
+DROP TRIGGER IF EXISTS observation_latest_delete ON cdm.observation;
+CREATE TRIGGER observation_latest_delete
+    AFTER DELETE ON cdm.observation
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION cdm.refresh_latest_observation();
+"""
+
+UNINSTALL_SQL = """
+DROP TRIGGER IF EXISTS observation_latest_insert ON cdm.observation;
+DROP TRIGGER IF EXISTS observation_latest_update ON cdm.observation;
+DROP TRIGGER IF EXISTS observation_latest_delete ON cdm.observation;
+DROP FUNCTION IF EXISTS cdm.refresh_latest_observation();
+DROP INDEX IF EXISTS cdm.observation_host_property_end;
+DROP TABLE IF EXISTS cdm.latest_observation;
+"""
+
+REBUILD_SQL = f"""
+TRUNCATE cdm.latest_observation;
+{_UPSERT.format(source="cdm.observation")};
+"""
+
+# For SQLAlchemy queries, the table is created by ``install``
+latest_observation = Table(
+    "latest_observation",
+    MetaData(),
+    Column("host_id", String, primary_key=True),
+    Column("observed_property_id", Integer, primary_key=True),
+    Column("observation_id", String),
+    Column("phenomenon_end", DateTime(timezone=True)),
+    Column("result_value", Float),
+    Column("result_uom", String),
+    Column("result_description", String),
+    Column("location", Geography(geometry_type="POINT", srid=4326, spatial_index=False)),
+    Column("updated", DateTime(timezone=True)),
+    schema="cdm",
+)
+
+
+def install_indexes(engine):
+    """
+    Create the index on ``cdm.observation`` the triggers use, concurrently,
+    before ``install``
+    """
+    create_index_concurrently(
+        engine, "cdm.observation_host_property_end", OBSERVATION_INDEX
+    )
+
+
+def install(conn, backfill: bool = True):
+    """Create the table and triggers, filling the table from observations"""
+    conn.execute(text(INSTALL_SQL))
+    if backfill:
+        rebuild(conn)
+
+
+def uninstall(conn):
+    conn.execute(text(UNINSTALL_SQL))
+
+
+def rebuild(conn):
+    """Recompute the table from ``cdm.observation`` (a full scan)"""
+    conn.execute(text(REBUILD_SQL))
+
+
+def current_conditions_query(
+    host_ids: Optional[Iterable[str]] = None,
+    observed_property_ids: Optional[Iterable[int]] = None,
+    bbox: Optional[Sequence[float]] = None,
+    max_age: Optional[timedelta] = None,
+    now: Optional[datetime] = None,
+):
+    """
+    Latest observations, optionally only of some hosts and properties,
+    inside a (minx, miny, maxx, maxy) box or no older than ``max_age``.
+    """
+    t = latest_observation.c
+    point = cast(t.location, Geometry)
+    q = select(
+        t.host_id,
+        t.observed_property_id,
+        t.observation_id,
+        t.phenomenon_end,
+        t.result_value,
+        t.result_uom,
+        t.result_description,
+        func.ST_X(point).label("longitude"),
+        func.ST_Y(point).label("latitude"),
+    ).order_by(t.host_id, t.observed_property_id)
+    if host_ids is not None:
+        q = q.where(t.host_id.in_(list(host_ids)))
+    if observed_property_ids is not None:
+        q = q.where(t.observed_property_id.in_(list(observed_property_ids)))
+    if bbox is not None:
+        envelope = cast(func.ST_MakeEnvelope(*bbox, 4326), Geography)
+        q = q.where(t.location.op("&&")(envelope))
+    if max_age is not None:
+        now = now or datetime.now(timezone.utc)
+        q = q.where(t.phenomenon_end >= now - max_age)
+    return q
+
+
+def current_conditions(conn, **filters) -> pd.DataFrame:
+    """Current conditions as a frame, ``filters`` as for the query"""
+    result = conn.execute(current_conditions_query(**filters))
+    return pd.DataFrame.from_records(result.fetchall(), columns=list(result.keys()))
+
+
+def _current_conditions():
+    t = latest_observation.c
+    return (
+        select(
+            t.host_id,
+            t.observed_property_id,
+            t.observation_id,
+            t.phenomenon_end,
+            t.result_value,
+        )
+        .where(
+            t.observed_property_id
+            == any_(bindparam("observed_property_ids", type_=ARRAY(Integer)))
+        )
+        .order_by(t.host_id, t.observed_property_id)
+    )
+
+
+registry.register("current_conditions", _current_conditions)
@@ -0,0 +1,246 @@
+"""
+Statement timeouts, client side deadlines and row limits for database work.
+
+Inside ``operation(...)``, transactions on engines passed to ``install`` set
+the ``statement_timeout`` configured for that operation, and a client side
+deadline cancels the operation's queries with ``pg_cancel_backend`` once it
+has run too long in total, which also covers work made of many short
+statements. A cancelled query surfaces as ``QueryTimeoutError``. Work
+outside an operation, such as batch jobs, runs without limits.
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.pool import NullPool
+
+from opencdms.config import config
+
+# SQLSTATE query_canceled, raised by statement_timeout and pg_cancel_backend
+QUERY_CANCELED = "57014"
+
+_current = contextvars.ContextVar("opencdms_operation", default=None)
+
+# Unpooled engines sending cancel requests, so a full pool cannot block them
+_cancel_engines = {}
+_cancel_lock = threading.Lock()
+
+
+class QueryTimeoutError(RuntimeError):
+    """A query was cancelled by its statement timeout or deadline"""
+
+
+class RowLimitError(RuntimeError):
+    """A query returned more rows than allowed for one request"""
+
+
+@dataclass(frozen=True)
+class Limits:
+    """
+    ``statement_timeout`` and ``deadline`` in seconds, for one statement and
+    for a whole operation; ``max_rows`` per request. None is unlimited.
+    """
+
+    statement_timeout: Optional[float] = None
+    deadline: Optional[float] = None
+    max_rows: Optional[int] = None
+
+
+def _operation_timeouts(value: str) -> Dict[str, float]:
+    timeouts = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, seconds = item.partition("=")
+        timeouts[name.strip()] = float(seconds)
+    return timeouts
+
+
+def limits_for(operation: str = "default") -> Limits:
+    """
+    Limits of an operation from ``OpenCDMSConfig``: its entry in
+    ``CDM_DB_OPERATION_TIMEOUTS`` or else ``CDM_DB_STATEMENT_TIMEOUT``, with
+    0 meaning no timeout, and ``CDM_DB_MAX_ROWS``.
+    """
+    timeouts = _operation_timeouts(config.CDM_DB_OPERATION_TIMEOUTS)
+    timeout = timeouts.get(operation, config.CDM_DB_STATEMENT_TIMEOUT) or None
+    return Limits(
+        statement_timeout=timeout,
+        deadline=timeout,
+        max_rows=config.CDM_DB_MAX_ROWS or None,
+    )
+
+
+class Operation:
+    """A running operation and the database backends it is using"""
+
+    def __init__(self, name: str, limits: Limits):
+        self.name = name
+        self.limits = limits
+        self.started = time.monotonic()
+        self.cancelled = False
+        self.backends = []
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def remaining(self) -> Optional[float]:
+        if self.limits.deadline is None:
+            return None
+        return self.limits.deadline - (time.monotonic() - self.started)
+
+    def statement_timeout_ms(self) -> int:
+        """Statement timeout for a new transaction, never past the deadline"""
+        timeouts = [
+            t for t in (self.limits.statement_timeout, self.remaining()) if t is not None
+        ]
+        if not timeouts:
+            return 0
+        return max(1, int(min(timeouts) * 1000))
+
+    def register(self, url, pid: int):
+        with self._lock:
+            self.backends.append((url, pid))
+            expired = self.cancelled
+        if expired:
+            _cancel(url, pid)
+
+    def start(self):
+        remaining = self.remaining()
+        if remaining is not None:
+            self._timer = threading.Timer(remaining, self.cancel)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def cancel(self):
+        """Cancel the queries running for this operation"""
+        with self._lock:
+            self.cancelled = True
+            backends = list(self.backends)
+        for url, pid in backends:
+            _cancel(url, pid)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+
+
+def _cancel(url, pid: int):
+    with _cancel_lock:
+        engine = _cancel_engines.get(url)
+        if engine is None:
+            engine = _cancel_engines[url] = create_engine(url, poolclass=NullPool)
+    try:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT pg_cancel_backend(:pid)"), {"pid": pid})
+    except DBAPIError:
+        # The server enforces statement_timeout as well
+        pass
+
+
+def current_operation() -> Optional[Operation]:
+    return _current.get()
+
+
+def _on_begin(conn):
+    if conn.dialect.name != "postgresql":
+        return
+    op = _current.get()
+    if op is None:
+        return
+    timeout = op.statement_timeout_ms()
+    track = op.limits.deadline is not None
+    if not timeout and not track:
+        return
+    # A raw cursor, the transaction SQLAlchemy is beginning is not usable
+    # from a begin event; psycopg2 opens it with this statement
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(
+            "SELECT set_config('statement_timeout', %s, true), pg_backend_pid()",
+            (str(timeout),),
+        )
+        pid = cursor.fetchone()[1]
+    finally:
+        cursor.close()
+    if track:
+        op.register(conn.engine.url, pid)
+
+
+def install(engine: Engine) -> Engine:
+    """
+    Apply the statement timeouts and deadlines of operations to
+    transactions of ``engine``
+    """
+    if not event.contains(engine, "begin", _on_begin):
+        event.listen(engine, "begin", _on_begin)
+    return engine
+
+
+def is_timeout(error: BaseException) -> bool:
+    return getattr(getattr(error, "orig", None), "pgcode", None) == QUERY_CANCELED
+
+
+@contextmanager
+def operation(name: str = "default", limits: Optional[Limits] = None) -> Iterator[Operation]:
+    """
+    Run database work as operation ``name`` with its ``limits`` (default
+    ``limits_for(name)``) on installed engines::
+
+        with operation("export"):
+            rows = fetch_limited(session, query)
+
+    Raises ``QueryTimeoutError`` when a query is cancelled.
+    """
+    op = Operation(name, limits or limits_for(name))
+    token = _current.set(op)
+    op.start()
+    try:
+        yield op
+    except DBAPIError as err:
+        if is_timeout(err):
+            reason = "deadline" if op.cancelled else "statement timeout"
+            raise QueryTimeoutError(
+                f"{name} cancelled by its {reason} "
+                f"({op.limits.deadline or op.limits.statement_timeout}s)"
+            ) from err
+        raise
+    finally:
+        op.stop()
+        _current.reset(token)
+
+
+def max_rows(value: Optional[int] = None) -> Optional[int]:
+    """``value``, or the limit of the current operation or configuration"""
+    if value is not None:
+        return value
+    op = _current.get()
+    limits = op.limits if op is not None else limits_for()
+    return limits.max_rows
+
+
+def clamp_limit(limit: Optional[int], maximum: Optional[int] = None) -> Optional[int]:
+    """A page size no larger than the row limit"""
+    maximum = max_rows(maximum)
+    if maximum is None:
+        return limit
+    return maximum if limit is None else min(int(limit), maximum)
+
+
+def fetch_limited(conn, statement, maximum: Optional[int] = None) -> List:
+    """
+    All rows of ``statement`` on a connection or session, read through a
+    server side cursor, raising ``RowLimitError`` past the row limit.
+    """
+    maximum = max_rows(maximum)
+    if maximum is None:
+        return conn.execute(statement).fetchall()
+    result = conn.execute(statement.execution_options(stream_results=True))
+    rows = result.fetchmany(maximum + 1)
+    result.close()
+    if len(rows) > maximum:
+        raise RowLimitError(f"Query returned more than {maximum} rows")
+    return rows
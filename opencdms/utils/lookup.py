@@ -0,0 +1,194 @@
+"""Process level cache of reference data used to resolve codes to ids"""
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from sqlalchemy import Table, func, select
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert
+from sqlalchemy.engine import Connectable
+
+from opencdms.provider.opencdmsdb import (
+    collection,
+    observation_type,
+    observed_property,
+    record_status,
+    source,
+    time_zone,
+)
+from opencdms.utils.ids import uuid7_batch
+
+# Reference tables and the column holding the external code for each one
+DIMENSIONS = {
+    "observed_property": (observed_property, "short_name"),
+    "observation_type": (observation_type, "name"),
+    "source": (source, "name"),
+    "collection": (collection, "name"),
+    "record_status": (record_status, "name"),
+    "time_zone": (time_zone, "abbreviation"),
+}
+
+
+class UnresolvedCodesError(KeyError):
+    """Raised when codes can not be mapped to ids"""
+
+    def __init__(self, dimension: str, codes: List[str]):
+        self.dimension = dimension
+        self.codes = codes
+        super().__init__(f"Unknown {dimension} code(s): {', '.join(map(str, codes))}")
+
+
+class DimensionCache:
+    """
+    Dictionaries of code -> id for the small reference tables used while
+    ingesting observations.
+
+    Each table is loaded on first use. Every ``max_age`` seconds a cheap
+    fingerprint of the table is compared with the one taken when it was
+    loaded and the table is reloaded if it changed.
+    """
+
+    def __init__(self, engine: Connectable, max_age: float = 60.0):
+        self.engine = engine
+        self.max_age = max_age
+        self._codes: Dict[str, Dict[str, object]] = {}
+        self._versions: Dict[str, str] = {}
+        self._checked: Dict[str, float] = {}
+        self._lock = threading.RLock()
+
+    def _table(self, dimension: str):
+        try:
+            return DIMENSIONS[dimension]
+        except KeyError:
+            raise ValueError(f"Unknown dimension: {dimension}") from None
+
+    def _version_query(self, dimension: str):
+        table, code = self._table(dimension)
+        return select(
+            func.md5(
+                func.coalesce(
+                    func.string_agg(
+                        func.concat(table.c.id, ":", table.c[code]),
+                        aggregate_order_by(",", table.c.id),
+                    ),
+                    "",
+                )
+            )
+        )
+
+    def _select(self, conn, dimension: str, codes: Optional[List[str]] = None):
+        """code -> id, the lowest id of codes found more than once"""
+        table, code = self._table(dimension)
+        q = select(table.c[code], table.c.id).order_by(table.c.id.desc())
+        if codes is not None:
+            q = q.where(table.c[code].in_(codes))
+        return {row[0]: row[1] for row in conn.execute(q)}
+
+    def _load(self, conn, dimension: str):
+        self._codes[dimension] = self._select(conn, dimension)
+        self._versions[dimension] = conn.execute(
+            self._version_query(dimension)
+        ).scalar()
+        self._checked[dimension] = time.monotonic()
+
+    def preload(self, dimensions: Optional[Iterable[str]] = None):
+        """Load the given reference tables, or all of them, in one go"""
+        with self._lock, self.engine.connect() as conn:
+            for dimension in dimensions or DIMENSIONS:
+                self._load(conn, dimension)
+        return self
+
+    def invalidate(self, dimension: Optional[str] = None):
+        """Forget one or every cached table so it is reloaded on next use"""
+        with self._lock:
+            for name in [dimension] if dimension else list(self._codes):
+                self._codes.pop(name, None)
+                self._versions.pop(name, None)
+                self._checked.pop(name, None)
+
+    def codes(self, dimension: str) -> Dict[str, object]:
+        """Return the code -> id mapping for a reference table"""
+        with self._lock:
+            if dimension not in self._codes:
+                with self.engine.connect() as conn:
+                    self._load(conn, dimension)
+            elif time.monotonic() - self._checked[dimension] > self.max_age:
+                with self.engine.connect() as conn:
+                    version = conn.execute(self._version_query(dimension)).scalar()
+                    if version != self._versions[dimension]:
+                        self._load(conn, dimension)
+                    else:
+                        self._checked[dimension] = time.monotonic()
+            return self._codes[dimension]
+
+    def resolve(
+        self, dimension: str, codes, create_missing: bool = False
+    ) -> np.ndarray:
+        """
+        Map an array of codes to ids.
+
+        Unknown codes are either inserted in a single batched statement when
+        ``create_missing`` is set, or reported together in an
+        ``UnresolvedCodesError``. ``None`` codes resolve to ``None``, empty
+        codes are looked up like any other.
+        """
+        codes = np.asarray(codes, dtype=object)
+        present = codes != None  # noqa: E711
+        unique, inverse = np.unique(codes[present].astype(str), return_inverse=True)
+        mapping = self.codes(dimension)
+        missing = [str(code) for code in unique if code not in mapping]
+        if missing:
+            if not create_missing:
+                raise UnresolvedCodesError(dimension, missing)
+            mapping = self.create(dimension, missing)
+
+        ids = np.array([mapping.get(code) for code in unique], dtype=object)
+        result = np.full(codes.shape, None, dtype=object)
+        result[present] = ids[inverse.ravel()]
+        return result
+
+    def create(self, dimension: str, codes: List[str]) -> Dict[str, object]:
+        """
+        Insert missing codes in one statement and return the new mapping.
+
+        Processes creating codes of a dimension take turns, through a
+        transaction level advisory lock, and only insert codes no other
+        process inserted meanwhile. Codes conflicting with a unique index
+        are skipped, the table is then selected again.
+        """
+        table, code = self._table(dimension)
+        with self._lock:
+            with self.engine.begin() as conn:
+                conn.execute(
+                    select(func.pg_advisory_xact_lock(
+                        func.hashtext(f"{table.schema}.{table.name}")
+                    ))
+                )
+                existing = self._select(conn, dimension, codes)
+                rows = [{code: value} for value in codes if value not in existing]
+                if _has_text_id(table):
+                    for row, _id in zip(rows, uuid7_batch(len(rows))):
+                        row["id"] = _id
+                if rows:
+                    conn.execute(insert(table).values(rows).on_conflict_do_nothing())
+                # Read back in the same transaction, codes skipped on conflict
+                # and created by others included
+                self._load(conn, dimension)
+            return self._codes[dimension]
+
+
+def _has_text_id(table: Table) -> bool:
+    return table.c.id.type.python_type is str
+
+
+_caches: Dict[str, DimensionCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_dimension_cache(engine: Connectable, max_age: float = 60.0) -> DimensionCache:
+    """Return the process wide cache for the database behind ``engine``"""
+    key = str(engine.url)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = DimensionCache(engine, max_age=max_age)
+        return _caches[key]
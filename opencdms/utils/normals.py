@@ -0,0 +1,415 @@
+"""
+Climate normals per host, observed property and month or day of year, and
+anomalies of observations against them.
+
+Series are reduced to daily means inside the database and streamed out in
+chunks, normals of many series are computed at once with NumPy in worker
+processes and stored in ``cdm.climate_normal``. An anomaly is then a join
+of an observation to its normal on the table's primary key.
+"""
+import math
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import (
+    Column,
+    Date,
+    DateTime,
+    Float,
+    Integer,
+    MetaData,
+    SmallInteger,
+    String,
+    Table,
+    and_,
+    case,
+    cast,
+    create_engine,
+    delete,
+    extract,
+    func,
+    insert,
+    select,
+    text,
+)
+
+from opencdms.provider.opencdmsdb import host, observation
+from opencdms.utils.db import get_cdm_connection_string
+
+PERIODS = ("month", "day")
+
+# WMO standard climatological normal
+DEFAULT_BASE = (1991, 2020)
+
+# Daily means needed for a monthly mean, the WMO rule allows ten missing
+MIN_DAYS_PER_MONTH = 20
+
+DEFAULT_HOSTS_PER_TASK = 20
+
+DEFAULT_CHUNK_SIZE = 50000
+
+INSTALL_SQL = """
+CREATE TABLE IF NOT EXISTS cdm.climate_normal (
+    host_id text NOT NULL REFERENCES cdm.host (id) ON DELETE CASCADE,
+    observed_property_id integer NOT NULL,
+    period text NOT NULL CHECK (period IN ('month', 'day')),
+    base_start smallint NOT NULL,
+    base_end smallint NOT NULL,
+    period_index smallint NOT NULL,
+    mean double precision NOT NULL,
+    std double precision,
+    years integer NOT NULL,
+    computed timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (
+        host_id, observed_property_id, period, base_start, base_end, period_index
+    )
+);
+"""
+
+UNINSTALL_SQL = """
+DROP TABLE IF EXISTS cdm.climate_normal;
+"""
+
+# For SQLAlchemy queries, the table is created by ``install``
+climate_normal = Table(
+    "climate_normal",
+    MetaData(),
+    Column("host_id", String, primary_key=True),
+    Column("observed_property_id", Integer, primary_key=True),
+    Column("period", String, primary_key=True),
+    Column("base_start", SmallInteger, primary_key=True),
+    Column("base_end", SmallInteger, primary_key=True),
+    Column("period_index", SmallInteger, primary_key=True),
+    Column("mean", Float),
+    Column("std", Float),
+    Column("years", Integer),
+    Column("computed", DateTime(timezone=True)),
+    schema="cdm",
+)
+
+
+@dataclass()
+class NormalsResult:
+    host_ids: List[str]
+    series: int = 0
+    normals: int = 0
+
+
+def install(conn):
+    conn.execute(text(INSTALL_SQL))
+
+
+def uninstall(conn):
+    conn.execute(text(UNINSTALL_SQL))
+
+
+def _check_period(period: str):
+    if period not in PERIODS:
+        raise ValueError(f"period must be one of {', '.join(PERIODS)}")
+
+
+def _index_of_day(period: str, day):
+    month = cast(extract("month", day), Integer)
+    if period == "month":
+        return month
+    # Day of a non leap year, 29 February counting as the 28th
+    day_of_month = cast(extract("day", day), Integer)
+    day_of_month = case(
+        (and_(month == 2, day_of_month == 29), 28), else_=day_of_month
+    )
+    return cast(extract("doy", func.make_date(2001, month, day_of_month)), Integer)
+
+
+def period_index(period: str, timestamp):
+    """
+    Index of the period of ``timestamp`` in UTC: the month (1-12) or the
+    day of year (1-365) of ``period``.
+    """
+    _check_period(period)
+    return _index_of_day(period, func.timezone("UTC", timestamp))
+
+
+def default_min_years(base: Tuple[int, int]) -> int:
+    """Years with data needed for a normal, 80% of the base period"""
+    return math.ceil(0.8 * (base[1] - base[0] + 1))
+
+
+def daily_means_query(
+    host_ids: Iterable[str],
+    period: str = "month",
+    base: Tuple[int, int] = DEFAULT_BASE,
+    observed_property_ids: Optional[Iterable[int]] = None,
+):
+    """
+    Daily means (UTC days) in the base period of some hosts, with the year
+    and period index of each day. For day of year normals the days sharing
+    an index, 28 and 29 February, are averaged into one value per year.
+    """
+    _check_period(period)
+    c = observation.c
+    daily = (
+        select(
+            c.host_id,
+            c.observed_property_id,
+            cast(func.timezone("UTC", c.phenomenon_end), Date).label("day"),
+            cast(c.result_value, Float).label("value"),
+        )
+        .where(
+            c.host_id.in_(list(host_ids)),
+            c.result_value.isnot(None),
+            c.phenomenon_end >= datetime(base[0], 1, 1, tzinfo=timezone.utc),
+            c.phenomenon_end < datetime(base[1] + 1, 1, 1, tzinfo=timezone.utc),
+        )
+    )
+    if observed_property_ids is not None:
+        daily = daily.where(c.observed_property_id.in_(list(observed_property_ids)))
+    d = daily.subquery("d")
+    means = select(
+        d.c.host_id,
+        d.c.observed_property_id,
+        cast(extract("year", d.c.day), Integer).label("year"),
+        _index_of_day(period, d.c.day).label("period_index"),
+        func.avg(d.c.value).label("value"),
+    ).group_by(d.c.host_id, d.c.observed_property_id, d.c.day)
+    if period == "day":
+        m = means.subquery("m")
+        means = select(
+            m.c.host_id,
+            m.c.observed_property_id,
+            m.c.year,
+            m.c.period_index,
+            func.avg(m.c.value).label("value"),
+        ).group_by(m.c.host_id, m.c.observed_property_id, m.c.year, m.c.period_index)
+    return means.execution_options(stream_results=True)
+
+
+def _grouped(keys: np.ndarray, values: np.ndarray):
+    """Keys with the mean, sample standard deviation and count of their values"""
+    unique, inverse = np.unique(keys, return_inverse=True)
+    count = np.bincount(inverse)
+    mean = np.bincount(inverse, weights=values) / count
+    squares = np.bincount(inverse, weights=(values - mean[inverse]) ** 2)
+    std = np.full(len(unique), np.nan)
+    several = count > 1
+    std[several] = np.sqrt(squares[several] / (count[several] - 1))
+    return unique, mean, std, count
+
+
+def compute_normals(
+    series: np.ndarray,
+    years: np.ndarray,
+    index: np.ndarray,
+    values: np.ndarray,
+    period: str = "month",
+    min_years: int = default_min_years(DEFAULT_BASE),
+    min_days: int = MIN_DAYS_PER_MONTH,
+):
+    """
+    Normals of many series at once from their daily means. ``series`` codes
+    each host and property, ``index`` is the period index of each day.
+
+    Monthly normals average the monthly means of months with ``min_days``
+    daily means, daily normals the daily means of each day of year, days
+    sharing an index in a year averaged first. Normals with fewer than
+    ``min_years`` distinct years are dropped. Returns arrays of the
+    series, period index, mean, standard deviation and years of each normal.
+    """
+    _check_period(period)
+    series = series.astype(np.int64)
+    index = index.astype(np.int64)
+    values = values.astype(float)
+    # One value per series, year and period index
+    keys = (series * 10000 + years.astype(np.int64)) * 367 + index
+    keys, values, _, days = _grouped(keys, values)
+    if period == "month":
+        keys, values = keys[days >= min_days], values[days >= min_days]
+    index = keys % 367
+    series = keys // 367 // 10000
+    keys, mean, std, count = _grouped(series * 367 + index, values)
+    enough = count >= min_years
+    keys = keys[enough]
+    return keys // 367, keys % 367, mean[enough], std[enough], count[enough]
+
+
+def _fetch_daily(conn, query, chunk_size: int):
+    """Stream the daily means into arrays, coding each host and property"""
+    codes = {}
+    series, years, index, values = [], [], [], []
+    result = conn.execute(query)
+    for rows in result.partitions(chunk_size):
+        for host_id, property_id, year, period_index_, value in rows:
+            key = (host_id, property_id)
+            series.append(codes.setdefault(key, len(codes)))
+            years.append(year)
+            index.append(period_index_)
+            values.append(value)
+    keys = list(codes)
+    return (
+        keys,
+        np.array(series, dtype=np.int64),
+        np.array(years, dtype=np.int64),
+        np.array(index, dtype=np.int64),
+        np.array(values, dtype=float),
+    )
+
+
+def normals_for_hosts(
+    host_ids: Sequence[str],
+    period: str = "month",
+    base: Tuple[int, int] = DEFAULT_BASE,
+    observed_property_ids: Optional[Iterable[int]] = None,
+    min_years: Optional[int] = None,
+    min_days: int = MIN_DAYS_PER_MONTH,
+    db_url: Optional[str] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> NormalsResult:
+    """Compute and replace the normals of some hosts"""
+    if observed_property_ids is not None:
+        observed_property_ids = list(observed_property_ids)
+    min_years = default_min_years(base) if min_years is None else min_years
+    engine = create_engine(db_url or get_cdm_connection_string())
+    try:
+        with engine.begin() as conn:
+            keys, series, years, index, values = _fetch_daily(
+                conn,
+                daily_means_query(host_ids, period, base, observed_property_ids),
+                chunk_size,
+            )
+            found, indexes, mean, std, count = compute_normals(
+                series, years, index, values, period, min_years, min_days
+            )
+            n = climate_normal.c
+            stale = delete(climate_normal).where(
+                n.host_id.in_(list(host_ids)),
+                n.period == period,
+                n.base_start == base[0],
+                n.base_end == base[1],
+            )
+            if observed_property_ids is not None:
+                stale = stale.where(n.observed_property_id.in_(observed_property_ids))
+            conn.execute(stale)
+            rows = [
+                {
+                    "host_id": keys[s][0],
+                    "observed_property_id": keys[s][1],
+                    "period": period,
+                    "base_start": base[0],
+                    "base_end": base[1],
+                    "period_index": int(i),
+                    "mean": float(m),
+                    "std": None if np.isnan(d) else float(d),
+                    "years": int(y),
+                }
+                for s, i, m, d, y in zip(found, indexes, mean, std, count)
+            ]
+            if rows:
+                conn.execute(insert(climate_normal), rows)
+    finally:
+        engine.dispose()
+    return NormalsResult(host_ids=list(host_ids), series=len(keys), normals=len(rows))
+
+
+def run_normals(
+    host_ids: Optional[Iterable[str]] = None,
+    period: str = "month",
+    base: Tuple[int, int] = DEFAULT_BASE,
+    observed_property_ids: Optional[Iterable[int]] = None,
+    min_years: Optional[int] = None,
+    min_days: int = MIN_DAYS_PER_MONTH,
+    workers: Optional[int] = None,
+    hosts_per_task: int = DEFAULT_HOSTS_PER_TASK,
+    db_url: Optional[str] = None,
+) -> List[NormalsResult]:
+    """
+    Compute normals for many hosts, all hosts by default, ``hosts_per_task``
+    hosts per task in a process pool
+    """
+    _check_period(period)
+    db_url = db_url or get_cdm_connection_string()
+    if host_ids is None:
+        engine = create_engine(db_url)
+        try:
+            with engine.connect() as conn:
+                host_ids = conn.execute(select(host.c.id).order_by(host.c.id)).scalars().all()
+        finally:
+            engine.dispose()
+    host_ids = list(host_ids)
+    if observed_property_ids is not None:
+        observed_property_ids = list(observed_property_ids)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(
+                normals_for_hosts,
+                host_ids[start:start + hosts_per_task],
+                period,
+                base,
+                observed_property_ids,
+                min_years,
+                min_days,
+                db_url,
+            )
+            for start in range(0, len(host_ids), hosts_per_task)
+        ]
+        return [future.result() for future in futures]
+
+
+def anomalies_query(
+    period: str = "month",
+    base: Tuple[int, int] = DEFAULT_BASE,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    host_ids: Optional[Iterable[str]] = None,
+    observed_property_ids: Optional[Iterable[int]] = None,
+):
+    """
+    Observations in a window with their normal, anomaly and standardized
+    anomaly. Observations without a normal are left out.
+    """
+    c = observation.c
+    n = climate_normal.c
+    value = cast(c.result_value, Float)
+    joined = observation.join(
+        climate_normal,
+        and_(
+            n.host_id == c.host_id,
+            n.observed_property_id == c.observed_property_id,
+            n.period == period,
+            n.base_start == base[0],
+            n.base_end == base[1],
+            n.period_index == period_index(period, c.phenomenon_end),
+        ),
+    )
+    q = (
+        select(
+            c.id,
+            c.host_id,
+            c.observed_property_id,
+            c.phenomenon_end,
+            value.label("result_value"),
+            n.mean.label("normal"),
+            (value - n.mean).label("anomaly"),
+            ((value - n.mean) / func.nullif(n.std, 0)).label("standardized_anomaly"),
+        )
+        .select_from(joined)
+        .where(c.result_value.isnot(None))
+        .order_by(c.host_id, c.observed_property_id, c.phenomenon_end)
+    )
+    if start is not None:
+        q = q.where(c.phenomenon_end >= start)
+    if end is not None:
+        q = q.where(c.phenomenon_end < end)
+    if host_ids is not None:
+        q = q.where(c.host_id.in_(list(host_ids)))
+    if observed_property_ids is not None:
+        q = q.where(c.observed_property_id.in_(list(observed_property_ids)))
+    return q
+
+
+def anomalies(conn, **filters) -> pd.DataFrame:
+    """Anomalies as a frame, ``filters`` as for the query"""
+    result = conn.execute(anomalies_query(**filters))
+    return pd.DataFrame.from_records(result.fetchall(), columns=list(result.keys()))
@@ -0,0 +1,182 @@
+"""
+Online migration of ``result_value`` and the elevation columns from numeric
+to double precision.
+
+``ALTER COLUMN ... TYPE`` would rewrite the table under an exclusive lock.
+Instead a shadow column is added and kept current by a trigger, existing
+rows are copied over in short batches, and the columns are swapped in a
+final transaction that only touches the catalog.
+
+The swap keeps the column comment, but the column moves to the end of its
+table. Everything in opencdms names its columns (COPY column lists, the
+compatibility view, the ORM), so only outside ``SELECT *`` or COPY without
+a column list see the new order.
+"""
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Sequence, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from opencdms.utils.compact import is_enabled, view_sql
+from opencdms.utils.db import maintenance
+
+# (table, column) pairs migrated, all in schema cdm
+COLUMNS = [
+    ("observation", "result_value"),
+    ("observation", "elevation"),
+    ("host", "elevation"),
+    ("observer", "elevation"),
+    ("feature", "elevation"),
+]
+
+DEFAULT_BATCH_SIZE = 20000
+
+_PREPARE_SQL = """
+ALTER TABLE cdm.{table} ADD COLUMN IF NOT EXISTS {shadow} double precision;
+
+CREATE OR REPLACE FUNCTION cdm.{function}() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.{shadow} := NEW.{column};
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS {function} ON cdm.{table};
+CREATE TRIGGER {function}
+    BEFORE INSERT OR UPDATE OF {column} ON cdm.{table}
+    FOR EACH ROW EXECUTE FUNCTION cdm.{function}();
+"""
+
+# Pages through the primary key index in its own order; the last id of the
+# page is returned by the server, whose collation defines that order
+_BACKFILL_SQL = """
+WITH batch AS (
+    SELECT id FROM cdm.{table}
+    WHERE id > :last_id
+    ORDER BY id
+    LIMIT :batch_size
+),
+copied AS (
+    UPDATE cdm.{table} AS t
+    SET {shadow} = t.{column}
+    FROM batch
+    WHERE t.id = batch.id
+    RETURNING 1
+)
+SELECT (SELECT count(*) FROM copied), (SELECT max(id) FROM batch)
+"""
+
+_SWAP_SQL = """
+DROP TRIGGER IF EXISTS {function} ON cdm.{table};
+DROP FUNCTION IF EXISTS cdm.{function}();
+DO $$
+BEGIN
+    EXECUTE format(
+        'COMMENT ON COLUMN cdm.{table}.{shadow} IS %L',
+        col_description('cdm.{table}'::regclass, (
+            SELECT attnum FROM pg_attribute
+            WHERE attrelid = 'cdm.{table}'::regclass AND attname = '{column}'
+        ))
+    );
+END;
+$$;
+ALTER TABLE cdm.{table} DROP COLUMN {column};
+ALTER TABLE cdm.{table} RENAME COLUMN {shadow} TO {column};
+"""
+
+
+@dataclass()
+class ColumnMigration:
+    """Progress of one column"""
+
+    table: str
+    column: str
+    rows: int = 0
+    seconds: float = 0.0
+    skipped: bool = False
+
+
+def _names(table: str, column: str) -> Tuple[str, str]:
+    return f"{column}_float8", f"{table}_{column}_float8_sync"
+
+
+def column_type(conn, table: str, column: str) -> Optional[str]:
+    return conn.execute(
+        text(
+            "SELECT data_type FROM information_schema.columns "
+            "WHERE table_schema = 'cdm' AND table_name = :table "
+            "AND column_name = :column"
+        ),
+        {"table": table, "column": column},
+    ).scalar()
+
+
+def migrate_column(
+    engine: Engine,
+    table: str,
+    column: str,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    pause: float = 0.0,
+    lock_timeout: str = "5s",
+) -> ColumnMigration:
+    """
+    Migrate one column. Each batch commits on its own and ``pause`` seconds
+    are left between batches for other writers and replicas to catch up.
+    The batches run as maintenance (``opencdms.utils.db.maintenance``), so
+    they do not feed the change feed or latest observation triggers.
+    Rerunning after an interruption starts the copy again but is otherwise
+    safe. The swap waits at most ``lock_timeout`` for its lock and fails
+    rather than queueing other queries behind it; just rerun.
+    """
+    result = ColumnMigration(table, column)
+    shadow, function = _names(table, column)
+    names = dict(table=table, column=column, shadow=shadow, function=function)
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        if column_type(conn, table, column) == "double precision":
+            result.skipped = True
+            return result
+        conn.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout}'"))
+        conn.execute(text(_PREPARE_SQL.format(**names)))
+
+    last_id = ""
+    backfill = text(_BACKFILL_SQL.format(**names))
+    while True:
+        with engine.begin() as conn:
+            maintenance(conn)
+            copied, last_id = conn.execute(
+                backfill, {"last_id": last_id, "batch_size": batch_size}
+            ).one()
+        if last_id is None:
+            break
+        result.rows += copied
+        if pause:
+            time.sleep(pause)
+
+    with engine.begin() as conn:
+        conn.execute(text(f"SET LOCAL lock_timeout = '{lock_timeout}'"))
+        # The compatibility view refers to the old column, rebuild it
+        compat = table == "observation" and is_enabled(conn)
+        if compat:
+            conn.execute(text("DROP VIEW IF EXISTS cdm.observation_compat"))
+        conn.execute(text(_SWAP_SQL.format(**names)))
+        if compat:
+            conn.execute(text(view_sql()))
+    result.seconds = time.perf_counter() - started
+    return result
+
+
+def migrate(
+    engine: Engine,
+    columns: Sequence[Tuple[str, str]] = COLUMNS,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    pause: float = 0.0,
+) -> List[ColumnMigration]:
+    """Migrate ``columns`` one after another, see ``migrate_column``"""
+    return [
+        migrate_column(engine, table, column, batch_size, pause)
+        for table, column in columns
+    ]
@@ -0,0 +1,344 @@
+"""Vectorised quality control of observations, written to ``result_quality``"""
+import operator
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from sqlalchemy import (
+    String,
+    and_,
+    cast,
+    column,
+    create_engine,
+    func,
+    select,
+    update,
+    values,
+)
+from sqlalchemy.dialects.postgresql import JSONB
+
+from opencdms.provider.opencdmsdb import observation
+from opencdms.utils.db import get_cdm_connection_string
+
+# Bits set in the QC flag mask when a check fails
+RANGE = 1
+STEP = 2
+SPIKE = 4
+PERSISTENCE = 8
+CONSISTENCY = 16
+
+CHECKS = {
+    "range": RANGE,
+    "step": STEP,
+    "spike": SPIKE,
+    "persistence": PERSISTENCE,
+    "consistency": CONSISTENCY,
+}
+
+_OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+@dataclass()
+class QCConfig:
+    """Thresholds for the checks run on one observed property"""
+
+    observed_property_id: int
+    min_value: Optional[float] = None
+    max_value: Optional[float] = None
+    max_step: Optional[float] = None
+    spike_threshold: Optional[float] = None
+    persistence_count: Optional[int] = None
+    persistence_tolerance: float = 0.0
+
+
+@dataclass()
+class ConsistencyRule:
+    """
+    Requires ``observed_property_id <op> other_property_id`` for coincident
+    observations of the same host, e.g. dew point <= air temperature.
+    """
+
+    observed_property_id: int
+    other_property_id: int
+    op: str = "<="
+
+
+@dataclass()
+class QCResult:
+    host_id: str
+    observations: int = 0
+    flagged: int = 0
+    counts: Dict[str, int] = field(default_factory=dict)
+
+
+def range_check(values: np.ndarray, min_value=None, max_value=None) -> np.ndarray:
+    """Flag values outside ``[min_value, max_value]``"""
+    failed = np.zeros(len(values), dtype=bool)
+    if min_value is not None:
+        failed |= values < min_value
+    if max_value is not None:
+        failed |= values > max_value
+    return failed
+
+
+def step_check(values: np.ndarray, max_step: float) -> np.ndarray:
+    """Flag values that differ from the previous one by more than ``max_step``"""
+    failed = np.zeros(len(values), dtype=bool)
+    if len(values) > 1:
+        failed[1:] = np.abs(np.diff(values)) > max_step
+    return failed
+
+
+def spike_check(values: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    Flag values that stand out from both neighbours, using the WMO spike test
+    ``|v - (prev + next) / 2| - |next - prev| / 2 > threshold``.
+    """
+    failed = np.zeros(len(values), dtype=bool)
+    if len(values) > 2:
+        prev, current, nxt = values[:-2], values[1:-1], values[2:]
+        spike = np.abs(current - (prev + nxt) / 2.0) - np.abs(nxt - prev) / 2.0
+        failed[1:-1] = spike > threshold
+    return failed
+
+
+def persistence_check(
+    values: np.ndarray, count: int, tolerance: float = 0.0
+) -> np.ndarray:
+    """Flag runs of at least ``count`` consecutive values that do not change"""
+    if not len(values):
+        return np.zeros(0, dtype=bool)
+    changed = np.ones(len(values), dtype=bool)
+    changed[1:] = np.abs(np.diff(values)) > tolerance
+    run = np.cumsum(changed) - 1
+    lengths = np.bincount(run)
+    return lengths[run] >= count
+
+
+def consistency_check(
+    times: np.ndarray,
+    values: np.ndarray,
+    other_times: np.ndarray,
+    other_values: np.ndarray,
+    op: str = "<=",
+) -> np.ndarray:
+    """
+    Flag values violating ``value <op> other`` where the other series has an
+    observation at the same time. Both series must be sorted by time.
+    """
+    failed = np.zeros(len(values), dtype=bool)
+    if not len(values) or not len(other_values):
+        return failed
+    pos = np.searchsorted(other_times, times)
+    pos = np.minimum(pos, len(other_times) - 1)
+    matched = other_times[pos] == times
+    ok = _OPERATORS[op](values[matched], other_values[pos[matched]])
+    failed[matched] = ~ok
+    return failed
+
+
+def run_checks(values: np.ndarray, config: QCConfig) -> np.ndarray:
+    """Return the QC flag mask of one time ordered series"""
+    flags = np.zeros(len(values), dtype=np.int16)
+    flags[range_check(values, config.min_value, config.max_value)] |= RANGE
+    if config.max_step is not None:
+        flags[step_check(values, config.max_step)] |= STEP
+    if config.spike_threshold is not None:
+        flags[spike_check(values, config.spike_threshold)] |= SPIKE
+    if config.persistence_count is not None:
+        flags[
+            persistence_check(
+                values, config.persistence_count, config.persistence_tolerance
+            )
+        ] |= PERSISTENCE
+    return flags
+
+
+def checked_mask(config: QCConfig, rules: Iterable[ConsistencyRule] = ()) -> int:
+    """Return the mask of checks that ``config`` and ``rules`` actually run"""
+    mask = 0
+    if config.min_value is not None or config.max_value is not None:
+        mask |= RANGE
+    if config.max_step is not None:
+        mask |= STEP
+    if config.spike_threshold is not None:
+        mask |= SPIKE
+    if config.persistence_count is not None:
+        mask |= PERSISTENCE
+    if any(r.observed_property_id == config.observed_property_id for r in rules):
+        mask |= CONSISTENCY
+    return mask
+
+
+def checked_masks(
+    configs: Dict[int, QCConfig], rules: Iterable[ConsistencyRule] = ()
+) -> Dict[int, int]:
+    """
+    Return the mask of checks run per property, for every configured
+    property and every property a consistency rule checks
+    """
+    rules = list(rules)
+    property_ids = set(configs) | {r.observed_property_id for r in rules}
+    return {
+        pid: checked_mask(configs.get(pid) or QCConfig(observed_property_id=pid), rules)
+        for pid in property_ids
+    }
+
+
+def quality_json(flags: int, checked: int) -> dict:
+    """``result_quality`` document for a flag mask"""
+    return {
+        "qc_flags": int(flags),
+        "qc_checked": int(checked),
+        "qc_failed": [name for name, bit in CHECKS.items() if flags & bit],
+    }
+
+
+def flag_station(
+    property_ids: np.ndarray,
+    times: np.ndarray,
+    values: np.ndarray,
+    configs: Dict[int, QCConfig],
+    rules: Iterable[ConsistencyRule] = (),
+) -> np.ndarray:
+    """
+    Return QC flags for all observations of one host. The inputs must be
+    sorted by property then time.
+    """
+    flags = np.zeros(len(values), dtype=np.int16)
+    series = {}
+    starts = np.flatnonzero(np.r_[True, property_ids[1:] != property_ids[:-1]])
+    ends = np.r_[starts[1:], len(property_ids)]
+    for start, end in zip(starts, ends):
+        property_id = property_ids[start]
+        series[property_id] = slice(start, end)
+        config = configs.get(property_id)
+        if config is not None:
+            flags[start:end] = run_checks(values[start:end], config)
+
+    for rule in rules:
+        a = series.get(rule.observed_property_id)
+        b = series.get(rule.other_property_id)
+        if a is None or b is None:
+            continue
+        failed = consistency_check(times[a], values[a], times[b], values[b], rule.op)
+        flags[a][failed] |= CONSISTENCY
+    return flags
+
+
+def _fetch(conn, host_id: str, property_ids, start, end):
+    q = (
+        select(
+            observation.c.id,
+            observation.c.observed_property_id,
+            func.extract("epoch", observation.c.phenomenon_end),
+            observation.c.result_value,
+        )
+        .where(
+            and_(
+                observation.c.host_id == host_id,
+                observation.c.observed_property_id.in_(property_ids),
+                observation.c.result_value.isnot(None),
+            )
+        )
+        .order_by(observation.c.observed_property_id, observation.c.phenomenon_end)
+        .execution_options(stream_results=True)
+    )
+    if start is not None:
+        q = q.where(observation.c.phenomenon_end >= start)
+    if end is not None:
+        q = q.where(observation.c.phenomenon_end < end)
+    rows = conn.execute(q).fetchall()
+    ids = np.array([r[0] for r in rows], dtype=object)
+    property_ids = np.array([r[1] for r in rows], dtype=np.int64)
+    times = np.array([r[2] for r in rows], dtype=float)
+    vals = np.array([r[3] for r in rows], dtype=float)
+    return ids, property_ids, times, vals
+
+
+def write_quality(conn, ids, documents: List[dict], batch_size: int = 5000):
+    """
+    Merge ``result_quality`` documents into the existing ones with one
+    ``UPDATE ... FROM (VALUES ...)`` statement per batch, keeping keys
+    written by anything else than QC.
+    """
+    for start in range(0, len(ids), batch_size):
+        batch = values(
+            column("id", String), column("result_quality", JSONB), name="qc"
+        ).data(
+            list(zip(ids[start:start + batch_size], documents[start:start + batch_size]))
+        )
+        conn.execute(
+            update(observation)
+            .values(
+                result_quality=func.coalesce(
+                    observation.c.result_quality, cast("{}", JSONB)
+                ).op("||")(cast(batch.c.result_quality, JSONB))
+            )
+            .where(observation.c.id == batch.c.id)
+        )
+
+
+def qc_station(
+    host_id: str,
+    configs: Dict[int, QCConfig],
+    rules: Iterable[ConsistencyRule] = (),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    db_url: Optional[str] = None,
+    batch_size: int = 5000,
+) -> QCResult:
+    """Run every configured check over one host's observations in a window"""
+    rules = list(rules)
+    property_ids = set(configs)
+    for rule in rules:
+        property_ids.update((rule.observed_property_id, rule.other_property_id))
+
+    engine = create_engine(db_url or get_cdm_connection_string())
+    try:
+        with engine.begin() as conn:
+            ids, pids, times, vals = _fetch(conn, host_id, sorted(property_ids), start, end)
+            flags = flag_station(pids, times, vals, configs, rules)
+            checked = checked_masks(configs, rules)
+            keep = np.isin(pids, list(checked))
+            documents = [
+                quality_json(f, checked[p]) for f, p in zip(flags[keep], pids[keep])
+            ]
+            write_quality(conn, ids[keep], documents, batch_size)
+    finally:
+        engine.dispose()
+
+    result = QCResult(host_id=host_id, observations=int(keep.sum()))
+    result.flagged = int(np.count_nonzero(flags[keep]))
+    result.counts = {
+        name: int(np.count_nonzero(flags[keep] & bit)) for name, bit in CHECKS.items()
+    }
+    return result
+
+
+def run_qc(
+    host_ids: Iterable[str],
+    configs: Iterable[QCConfig],
+    rules: Iterable[ConsistencyRule] = (),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    workers: Optional[int] = None,
+    db_url: Optional[str] = None,
+) -> List[QCResult]:
+    """Run QC for many hosts, one host per task in a process pool"""
+    configs = {c.observed_property_id: c for c in configs}
+    rules = list(rules)
+    db_url = db_url or get_cdm_connection_string()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(qc_station, host_id, configs, rules, start, end, db_url)
+            for host_id in host_ids
+        ]
+        return [future.result() for future in futures]
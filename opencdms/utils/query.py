@@ -0,0 +1,380 @@
+"""
+Typed builder for observation queries. Every filter compiles to a condition
+an index can serve: bare columns compared with constants, ``&&`` and
+``ST_DWithin`` on the geography column and ``@>`` on ``result_quality``.
+An optional guard runs ``EXPLAIN`` first and refuses, or warns about,
+plans scanning large tables sequentially.
+"""
+import json
+import warnings
+from dataclasses import dataclass, replace
+from datetime import date, datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from geoalchemy2 import Geography
+from sqlalchemy import (
+    SmallInteger,
+    and_,
+    cast,
+    func,
+    literal,
+    literal_column,
+    or_,
+    select,
+    text,
+)
+from sqlalchemy.dialects.postgresql import JSONB
+
+from opencdms.provider.opencdmsdb import observation, observed_property
+from opencdms.utils.compact import READ_EXPRESSIONS, is_enabled
+from opencdms.utils.hierarchy import under_features
+from opencdms.utils.qc import CHECKS
+from opencdms.utils.units import canonical_columns, join_units
+
+DEFAULT_CHUNK_SIZE = 10000
+
+# Aliased so the compact storage read expressions (written for ``o``) apply
+o = observation.alias("o")
+p = observed_property.alias("p")
+
+
+class SequentialScanError(RuntimeError):
+    """A query plan scans too many rows sequentially"""
+
+
+@dataclass(frozen=True)
+class ExplainGuard:
+    """
+    Check plans before running them: ``action`` ("raise" or "warn") when a
+    sequential scan reads a table of more than ``max_rows`` rows.
+    """
+
+    max_rows: int = 1_000_000
+    action: str = "raise"
+
+
+def _timestamp(value, name: str) -> datetime:
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day, tzinfo=timezone.utc)
+    raise TypeError(f"{name} must be a datetime or date, not {type(value).__name__}")
+
+
+def _ids(values: Iterable, kind: type, name: str) -> Tuple:
+    if isinstance(values, (str, bytes)):
+        raise TypeError(f"{name} must be an iterable of {kind.__name__}")
+    values = tuple(values)
+    for value in values:
+        if not isinstance(value, kind) or isinstance(value, bool):
+            raise TypeError(f"{name} must contain {kind.__name__} values, not {value!r}")
+    return values
+
+
+def _quality(document: dict):
+    return o.c.result_quality.contains(cast(json.dumps(document), JSONB))
+
+
+@dataclass(frozen=True)
+class ObservationQuery:
+    """
+    An immutable observation query, each method returns a narrowed copy::
+
+        query = (
+            ObservationQuery()
+            .between(datetime(2020, 1, 1), datetime(2021, 1, 1))
+            .properties([1, 2])
+            .near(-1.5, 52.0, 25000)
+            .passed_qc()
+        )
+        rows = query.execute(conn, guard=ExplainGuard()).fetchall()
+
+    With ``compact=True`` (compact storage enabled, see
+    ``opencdms.utils.compact``) QC filters test the ``qc_flags`` bitmask and
+    the JSON columns are rebuilt in the select list. ``in_canonical_units``
+    converts ``result_value`` to the units of its observed property.
+    """
+
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    host_ids: Optional[Tuple[str, ...]] = None
+    observed_property_ids: Optional[Tuple[int, ...]] = None
+    collection_ids: Optional[Tuple[str, ...]] = None
+    feature_ids: Optional[Tuple[str, ...]] = None
+    spatial: Tuple = ()
+    qc_passed: Optional[bool] = None
+    qc_failed: Tuple[str, ...] = ()
+    limit_rows: Optional[int] = None
+    compact: bool = False
+    canonical: bool = False
+    extra: Tuple = ()
+
+    @classmethod
+    def for_connection(cls, conn) -> "ObservationQuery":
+        """An empty query matching the storage mode of the database"""
+        return cls(compact=is_enabled(conn))
+
+    def between(self, start=None, end=None) -> "ObservationQuery":
+        """``phenomenon_end`` in ``[start, end)``, naive values are UTC"""
+        return replace(
+            self,
+            start=None if start is None else _timestamp(start, "start"),
+            end=None if end is None else _timestamp(end, "end"),
+        )
+
+    def hosts(self, host_ids: Iterable[str]) -> "ObservationQuery":
+        return replace(self, host_ids=_ids(host_ids, str, "host_ids"))
+
+    def properties(self, observed_property_ids: Iterable[int]) -> "ObservationQuery":
+        ids = _ids(observed_property_ids, int, "observed_property_ids")
+        return replace(self, observed_property_ids=ids)
+
+    def collections(self, collection_ids: Iterable[str]) -> "ObservationQuery":
+        return replace(self, collection_ids=_ids(collection_ids, str, "collection_ids"))
+
+    def under_features(self, feature_ids: Iterable[str]) -> "ObservationQuery":
+        """
+        Observations of these features or any feature below them, through
+        the closure table of ``opencdms.utils.hierarchy``
+        """
+        return replace(self, feature_ids=_ids(feature_ids, str, "feature_ids"))
+
+    def bbox(
+        self, minx: float, miny: float, maxx: float, maxy: float
+    ) -> "ObservationQuery":
+        """Observations located inside a longitude / latitude box"""
+        envelope = cast(
+            func.ST_MakeEnvelope(float(minx), float(miny), float(maxx), float(maxy), 4326),
+            Geography,
+        )
+        return self._spatial(o.c.location.op("&&")(envelope))
+
+    def near(
+        self, longitude: float, latitude: float, metres: float
+    ) -> "ObservationQuery":
+        """Observations located within ``metres`` of a point"""
+        point = cast(
+            func.ST_SetSRID(func.ST_MakePoint(float(longitude), float(latitude)), 4326),
+            Geography,
+        )
+        return self._spatial(func.ST_DWithin(o.c.location, point, float(metres)))
+
+    def intersects(self, wkt: str) -> "ObservationQuery":
+        """Observations located inside a (longitude / latitude) WKT shape"""
+        if not isinstance(wkt, str):
+            raise TypeError("wkt must be a string")
+        shape = func.ST_GeogFromText(f"SRID=4326;{wkt}")
+        return self._spatial(func.ST_Intersects(o.c.location, shape))
+
+    def _spatial(self, condition) -> "ObservationQuery":
+        return replace(self, spatial=self.spatial + (condition,))
+
+    def passed_qc(self, passed: bool = True) -> "ObservationQuery":
+        """Observations checked with no QC flag set (or with some set)"""
+        return replace(self, qc_passed=bool(passed))
+
+    def failed_check(self, *checks: str) -> "ObservationQuery":
+        """Observations failing all the named QC checks, see ``qc.CHECKS``"""
+        unknown = sorted(set(checks) - set(CHECKS))
+        if unknown:
+            raise ValueError(f"Unknown QC checks: {', '.join(unknown)}")
+        return replace(self, qc_failed=self.qc_failed + checks)
+
+    def where(self, *conditions) -> "ObservationQuery":
+        """Further conditions on the ``o`` alias, used as they are"""
+        return replace(self, extra=self.extra + conditions)
+
+    def in_canonical_units(self, canonical: bool = True) -> "ObservationQuery":
+        """
+        Select ``result_value`` and ``result_uom`` in the canonical units of
+        the observed property, see ``opencdms.utils.units.canonical_value``
+        """
+        return replace(self, canonical=bool(canonical))
+
+    def limit(self, rows: int) -> "ObservationQuery":
+        return replace(self, limit_rows=int(rows))
+
+    def _qc_conditions(self) -> List:
+        flags = literal_column("o.qc_flags", SmallInteger)
+        pairs = []  # (JSON document condition, qc_flags condition)
+        if self.qc_passed is True:
+            pairs.append((_quality({"qc_flags": 0}), flags == 0))
+        elif self.qc_passed is False:
+            failed = o.c.result_quality.has_key("qc_flags") & ~_quality({"qc_flags": 0})
+            pairs.append((failed, flags != 0))
+        if self.qc_failed:
+            mask = 0
+            for check in self.qc_failed:
+                mask |= CHECKS[check]
+            pairs.append(
+                (_quality({"qc_failed": list(self.qc_failed)}), flags.op("&")(literal(mask)) == mask)
+            )
+        if not self.compact:
+            return [document for document, _ in pairs]
+        # Compacted rows have NULL documents, the others keep theirs
+        return [
+            or_(compacted, and_(flags.is_(None), document))
+            for document, compacted in pairs
+        ]
+
+    def filters(self) -> List:
+        """The WHERE conditions of the query"""
+        conditions = []
+        if self.start is not None:
+            conditions.append(o.c.phenomenon_end >= self.start)
+        if self.end is not None:
+            conditions.append(o.c.phenomenon_end < self.end)
+        if self.host_ids is not None:
+            conditions.append(o.c.host_id.in_(self.host_ids))
+        if self.observed_property_ids is not None:
+            conditions.append(o.c.observed_property_id.in_(self.observed_property_ids))
+        if self.collection_ids is not None:
+            conditions.append(o.c.collection_id.in_(self.collection_ids))
+        if self.feature_ids is not None:
+            conditions.append(under_features(self.feature_ids, o.c.feature_of_interest_id))
+        conditions.extend(self.spatial)
+        conditions.extend(self._qc_conditions())
+        conditions.extend(self.extra)
+        return conditions
+
+    def columns(self) -> List:
+        """
+        All observation columns, JSON ones rebuilt in compact mode and
+        values converted when in canonical units
+        """
+        columns = canonical_columns(o, p) if self.canonical else list(o.c)
+        if not self.compact:
+            return columns
+        return [
+            literal_column(READ_EXPRESSIONS[c.name], c.type).label(c.name)
+            if c.name in READ_EXPRESSIONS
+            else c
+            for c in columns
+        ]
+
+    def statement(self, columns: Optional[Sequence] = None):
+        """The SELECT, ordered by ``phenomenon_end`` and id"""
+        q = select(*(columns or self.columns())).order_by(o.c.phenomenon_end, o.c.id)
+        if self.canonical:
+            q = q.select_from(join_units(o, p))
+        conditions = self.filters()
+        if conditions:
+            q = q.where(*conditions)
+        if self.limit_rows is not None:
+            q = q.limit(self.limit_rows)
+        return q
+
+    def execute(self, conn, columns=None, guard: Optional[ExplainGuard] = None):
+        """Run the query, checking its plan first when given a ``guard``"""
+        statement = self.statement(columns)
+        if guard is not None:
+            check_plan(conn, statement, guard)
+        return conn.execute(statement)
+
+    def iter_chunks(
+        self,
+        conn,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        columns=None,
+        guard: Optional[ExplainGuard] = None,
+    ) -> Iterator[list]:
+        """Yield lists of rows read from a server side cursor"""
+        statement = self.statement(columns)
+        if guard is not None:
+            check_plan(conn, statement, guard)
+        result = conn.execution_options(
+            stream_results=True, max_row_buffer=chunk_size
+        ).execute(statement)
+        yield from result.partitions(chunk_size)
+
+
+def observation_query(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    host_ids: Optional[Iterable[str]] = None,
+    observed_property_ids: Optional[Iterable[int]] = None,
+    collection_ids: Optional[Iterable[str]] = None,
+    columns=None,
+    table=observation,
+):
+    """
+    Select observations in a time window, optionally filtered by ids, from
+    ``table`` (``cdm.observation`` or a view with the same columns), in
+    ``phenomenon_end`` and id order. Used by the exports and the archive.
+    """
+    q = select(*(columns or table.c)).order_by(table.c.phenomenon_end, table.c.id)
+    if start is not None:
+        q = q.where(table.c.phenomenon_end >= start)
+    if end is not None:
+        q = q.where(table.c.phenomenon_end < end)
+    if host_ids is not None:
+        q = q.where(table.c.host_id.in_(list(host_ids)))
+    if observed_property_ids is not None:
+        q = q.where(table.c.observed_property_id.in_(list(observed_property_ids)))
+    if collection_ids is not None:
+        q = q.where(table.c.collection_id.in_(list(collection_ids)))
+    return q
+
+
+def explain(conn, statement) -> dict:
+    """The estimated plan of a statement (``EXPLAIN (FORMAT JSON, VERBOSE)``)"""
+    compiled = statement.compile(
+        dialect=conn.dialect, compile_kwargs={"render_postcompile": True}
+    )
+    plan = conn.exec_driver_sql(
+        f"EXPLAIN (FORMAT JSON, VERBOSE) {compiled}", compiled.params
+    ).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]
+
+
+def sequential_scans(plan: dict) -> List[Tuple[str, int]]:
+    """(schema.relation, estimated rows returned) of each sequential scan"""
+    scans = []
+    if plan.get("Node Type") == "Seq Scan":
+        relation = plan.get("Relation Name", "")
+        if plan.get("Schema"):
+            relation = f"{plan['Schema']}.{relation}"
+        scans.append((relation, int(plan.get("Plan Rows", 0))))
+    for child in plan.get("Plans", []):
+        scans.extend(sequential_scans(child))
+    return scans
+
+
+def _table_rows(conn, relations: Iterable[str]) -> Dict[str, int]:
+    # Planner statistics, -1 when a table was never analyzed
+    rows = conn.execute(
+        text(
+            "SELECT name, CAST(c.reltuples AS bigint) "
+            "FROM unnest(CAST(:names AS text[])) AS name "
+            "JOIN pg_class AS c ON c.oid = to_regclass(name)"
+        ),
+        {"names": sorted(set(relations))},
+    )
+    return dict(rows.fetchall())
+
+
+def check_plan(conn, statement, guard: ExplainGuard) -> List[Tuple[str, int]]:
+    """
+    Apply ``guard`` to the plan of ``statement``, returning the offending
+    (relation, rows) scans when it only warns. The rows are the table size
+    from planner statistics, or the plan estimate when there are none.
+    """
+    scans = sequential_scans(explain(conn, statement))
+    if not scans:
+        return []
+    sizes = _table_rows(conn, [relation for relation, _ in scans])
+    offending = []
+    for relation, estimate in scans:
+        rows = max(sizes.get(relation, -1), estimate)
+        if rows > guard.max_rows:
+            offending.append((relation, rows))
+    if offending:
+        message = "Sequential scan of " + ", ".join(
+            f"{relation} (~{rows} rows)" for relation, rows in offending
+        )
+        if guard.action == "raise":
+            raise SequentialScanError(message)
+        warnings.warn(message, RuntimeWarning, stacklevel=2)
+    return offending
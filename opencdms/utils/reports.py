@@ -0,0 +1,139 @@
+"""
+Wide records of coincident observations: one row per ``report_id`` and one
+column per observed property, pivoted inside the database.
+"""
+import re
+from datetime import datetime
+from typing import Dict, IO, Iterable, Iterator, Optional, Union
+
+import pandas as pd
+from sqlalchemy import cast, func, select
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
+
+from opencdms.provider.opencdmsdb import observation, observed_property
+
+DEFAULT_CHUNK_SIZE = 10000
+
+# Columns identifying a report, ahead of the property columns
+KEY_COLUMNS = ["report_id", "host_id", "phenomenon_end"]
+
+
+def _column_name(name: Optional[str], property_id: int) -> str:
+    name = re.sub(r"\W+", "_", (name or "").strip()).strip("_").lower()
+    return name or f"property_{property_id}"
+
+
+def report_columns(
+    conn, observed_property_ids: Optional[Iterable[int]] = None
+) -> Dict[int, str]:
+    """
+    Column names for observed properties, from their short names (falling
+    back to ``property_<id>``), for all properties unless ids are given.
+    """
+    q = select(observed_property.c.id, observed_property.c.short_name).order_by(
+        observed_property.c.id
+    )
+    if observed_property_ids is not None:
+        q = q.where(observed_property.c.id.in_(list(observed_property_ids)))
+    columns = {}
+    for property_id, short_name in conn.execute(q):
+        name = _column_name(short_name, property_id)
+        if name in columns.values() or name in KEY_COLUMNS:
+            name = f"{name}_{property_id}"
+        columns[property_id] = name
+    return columns
+
+
+def report_query(
+    columns: Dict[int, str],
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    host_ids: Optional[Iterable[str]] = None,
+    collection_ids: Optional[Iterable[str]] = None,
+    value: str = "result_value",
+):
+    """
+    Pivot observations sharing a ``report_id`` with one conditional
+    aggregate (``max(...) FILTER (WHERE observed_property_id = ...)``) per
+    entry of ``columns`` (property id -> column name), so only the wide
+    rows leave the database. ``value`` is ``result_value`` or
+    ``result_description``. Reports are ordered by time.
+    """
+    source = observation.c[value]
+    aggregates = []
+    for property_id, name in columns.items():
+        aggregate = func.max(source).filter(
+            observation.c.observed_property_id == property_id
+        )
+        if value == "result_value":
+            aggregate = cast(aggregate, DOUBLE_PRECISION)
+        aggregates.append(aggregate.label(name))
+
+    phenomenon_end = func.max(observation.c.phenomenon_end)
+    q = (
+        select(
+            observation.c.report_id,
+            observation.c.host_id,
+            phenomenon_end.label("phenomenon_end"),
+            *aggregates,
+        )
+        .where(
+            observation.c.report_id.isnot(None),
+            observation.c.observed_property_id.in_(list(columns)),
+        )
+        .group_by(observation.c.report_id, observation.c.host_id)
+        .order_by(phenomenon_end, observation.c.report_id)
+    )
+    if start is not None:
+        q = q.where(observation.c.phenomenon_end >= start)
+    if end is not None:
+        q = q.where(observation.c.phenomenon_end < end)
+    if host_ids is not None:
+        q = q.where(observation.c.host_id.in_(list(host_ids)))
+    if collection_ids is not None:
+        q = q.where(observation.c.collection_id.in_(list(collection_ids)))
+    return q
+
+
+def iter_reports(
+    conn,
+    observed_property_ids: Optional[Iterable[int]] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    columns: Optional[Dict[int, str]] = None,
+    **filters,
+) -> Iterator[pd.DataFrame]:
+    """
+    Yield wide report frames of up to ``chunk_size`` rows read from a
+    server side cursor. ``filters`` are those of ``report_query``.
+    """
+    columns = columns or report_columns(conn, observed_property_ids)
+    query = report_query(columns, **filters)
+    result = conn.execution_options(
+        stream_results=True, max_row_buffer=chunk_size
+    ).execute(query)
+    names = list(result.keys())
+    for rows in result.partitions(chunk_size):
+        yield pd.DataFrame.from_records(rows, columns=names)
+
+
+def export_reports(
+    conn,
+    output: Union[str, IO[str]],
+    observed_property_ids: Optional[Iterable[int]] = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    **filters,
+) -> int:
+    """Write wide reports as CSV to a path or text file, returns the count"""
+    if isinstance(output, str):
+        stream = open(output, "w", newline="", encoding="utf-8")
+    else:
+        stream = output
+    count = 0
+    try:
+        for df in iter_reports(conn, observed_property_ids, chunk_size, **filters):
+            df.to_csv(stream, index=False, header=count == 0)
+            count += len(df)
+    finally:
+        if isinstance(output, str):
+            stream.close()
+    return count
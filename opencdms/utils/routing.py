@@ -0,0 +1,190 @@
+"""Route read-only work to replicas and writes to the primary database"""
+import itertools
+import re
+import threading
+import time
+from typing import List, Optional
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+
+from opencdms.config import config
+from opencdms.utils.db import (
+    get_cdm_connection_string,
+    get_cdm_replica_connection_strings,
+)
+from opencdms.utils.limits import install
+
+# Textual SQL that only reads: plain SELECT (no row locks) and SHOW. Any other
+# ``text()`` statement may write and goes to the primary.
+_READ_TEXT = re.compile(
+    r"\s*(SHOW\b|SELECT\b(?!.*\bFOR\s+(NO\s+KEY\s+)?(UPDATE|SHARE|KEY\s+SHARE)\b))",
+    re.IGNORECASE | re.DOTALL,
+)
+
+# A replica that replayed everything it received is not behind, however
+# long ago the primary last committed
+_LAG_SQL = text(
+    "SELECT CASE "
+    "WHEN NOT pg_is_in_recovery() THEN 0 "
+    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE("
+    "extract(epoch FROM now() - pg_last_xact_replay_timestamp()), 0) "
+    "END"
+)
+
+
+class ReplicaRouter:
+    """
+    Chooses the engine for read-only work: one of the replicas, picked round
+    robin or by fewest checked out connections, skipping replicas that lag
+    more than ``max_lag`` seconds or can not be reached. Falls back to the
+    primary when no replica is usable.
+    """
+
+    def __init__(
+        self,
+        primary: Engine,
+        replicas: List[Engine],
+        strategy: str = "round_robin",
+        max_lag: float = 30.0,
+        check_interval: float = 5.0,
+    ):
+        if strategy not in ("round_robin", "least_load"):
+            raise ValueError(f"Unknown replica strategy: {strategy}")
+        self.primary = primary
+        self.replicas = replicas
+        self.strategy = strategy
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._cycle = itertools.cycle(range(len(replicas)))
+        self._lag = {}
+        self._checked = {}
+        self._lock = threading.Lock()
+
+    def lag(self, engine: Engine) -> Optional[float]:
+        """Replication lag in seconds, or None if the replica is unreachable"""
+        now = time.monotonic()
+        with self._lock:
+            checked = self._checked.get(engine, now - self.check_interval)
+            if now - checked < self.check_interval:
+                return self._lag.get(engine)
+            # Other threads keep the previous lag while this one checks
+            self._checked[engine] = now
+        lag = None
+        try:
+            with engine.connect() as conn:
+                if engine.dialect.name == "postgresql":
+                    lag = float(conn.execute(_LAG_SQL).scalar())
+                else:
+                    lag = 0.0
+        except DBAPIError:
+            lag = None
+        with self._lock:
+            self._lag[engine] = lag
+        return lag
+
+    def healthy(self, engine: Engine) -> bool:
+        lag = self.lag(engine)
+        return lag is not None and lag <= self.max_lag
+
+    def reader(self) -> Engine:
+        """Engine to use for the next piece of read-only work"""
+        with self._lock:
+            if self.strategy == "least_load":
+                candidates = sorted(self.replicas, key=_checked_out)
+            else:
+                start = next(self._cycle, 0)
+                candidates = self.replicas[start:] + self.replicas[:start]
+        # Lag checks connect to the replicas, outside the lock
+        for engine in candidates:
+            if self.healthy(engine):
+                return engine
+        return self.primary
+
+    def writer(self) -> Engine:
+        return self.primary
+
+
+def _checked_out(engine: Engine) -> int:
+    """Connections of an engine currently in use, a proxy for its load"""
+    checkedout = getattr(engine.pool, "checkedout", None)
+    return checkedout() if checkedout else 0
+
+
+def _writes(clause) -> bool:
+    """Whether a statement may write"""
+    if isinstance(clause, TextClause):
+        return not _READ_TEXT.match(clause.text)
+    return isinstance(clause, UpdateBase)
+
+
+class RoutingSession(Session):
+    """
+    Session sending reads to a replica and writes to the primary.
+
+    Once the session has flushed or executed a write, every later statement
+    goes to the primary too, so the session always reads its own writes.
+    ``text()`` statements count as writes unless they are a plain SELECT or
+    SHOW. Call ``use_primary`` before selects with side effects, such as
+    those calling functions that write.
+    """
+
+    def __init__(self, router: ReplicaRouter, **kwargs):
+        super().__init__(**kwargs)
+        self.router = router
+        self._use_primary = False
+        self._reader = None
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or _writes(clause):
+            self._use_primary = True
+        if self._use_primary:
+            return self.router.writer()
+        if self._reader is None:
+            # Stick to one replica so reads within the session are consistent
+            self._reader = self.router.reader()
+        return self._reader
+
+    def use_primary(self):
+        """Send everything from now on to the primary"""
+        self._use_primary = True
+        return self
+
+    def close(self):
+        super().close()
+        self._use_primary = False
+        self._reader = None
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> ReplicaRouter:
+    """Process wide router built from ``OpenCDMSConfig``"""
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ReplicaRouter(
+                install(create_engine(get_cdm_connection_string(), pool_pre_ping=True)),
+                [
+                    install(create_engine(url, pool_pre_ping=True))
+                    for url in get_cdm_replica_connection_strings()
+                ],
+                strategy=config.CDM_DB_REPLICA_STRATEGY,
+                max_lag=config.CDM_DB_REPLICA_MAX_LAG,
+            )
+        return _router
+
+
+def cdm_routing_session(router: Optional[ReplicaRouter] = None) -> RoutingSession:
+    """Like ``cdm_session`` but routing reads to replicas when configured"""
+    SessionLocal = sessionmaker(
+        class_=RoutingSession, router=router or get_router()
+    )
+    return SessionLocal()
@@ -1,11 +1,11 @@
 from datetime import datetime,timedelta
-from uuid import uuid4
 
 from sqlalchemy import create_engine, schema
 from sqlalchemy.orm import sessionmaker, close_all_sessions, Session, clear_mappers
 from faker import Faker
 
 from opencdms.utils.db import get_cdm_connection_string
+from opencdms.utils.ids import uuid7
 from opencdms.provider.opencdmsdb import mapper_registry, start_mappers
 from opencdms.models import cdm
 
@@ -36,7 +36,7 @@ def seed_observations(db_session: Session):
                 links=["https://links.features.com/1"]
             )
     user = cdm.User(
-        id=str(uuid4()),
+        id=uuid7(),
         name="John Doe"
     )
     status = cdm.RecordStatus(
@@ -47,7 +47,7 @@ def seed_observations(db_session: Session):
     
     time_zone = cdm.TimeZone(abbreviation="WAT",name="lagos/africa",offset="1")
     source_type = cdm.SourceType(
-        id=str(uuid4()),
+        id=uuid7(),
         description="A source type"
     )
     db_session.add(source_type)
@@ -59,7 +59,7 @@ def seed_observations(db_session: Session):
 
 
     feature = cdm.Feature(
-        id=str(uuid4()),
+        id=uuid7(),
         type_id=feature_type.id,
         elevation=2.9,
         name="FEATURE2",
@@ -67,13 +67,13 @@ def seed_observations(db_session: Session):
         description="A description"
     )
     collection = cdm.Collection(
-        id=str(uuid4()),
+        id=uuid7(),
         name="Collection 1",
         links=[" A link"]
     )
 
     observer = cdm.Observer(
-        id=str(uuid4()),
+        id=uuid7(),
         description="A good observer",
         links=["A link"],
         location="POINT(-71.060316 48.432044)",
@@ -88,7 +88,7 @@ def seed_observations(db_session: Session):
     )
 
     host = cdm.Host(
-        id=str(uuid4()),
+        id=uuid7(),
         name="Host Zone",
         version=1,
         change_date=datetime.utcnow(),
@@ -112,7 +112,7 @@ def seed_observations(db_session: Session):
 
 
     source = cdm.Source(
-        id=str(uuid4()),
+        id=uuid7(),
         name="Source 1",
         source_type_id=source_type.id,
         links=["A link"],
@@ -127,7 +127,7 @@ def seed_observations(db_session: Session):
 
     
     def _create_observations(lon: float, lat: float):
-        observation_id = str(uuid4())
+        observation_id = uuid7()
         observation = cdm.Observation(
             id=observation_id,
             location=cdm.Observation.set_location(lon, lat),
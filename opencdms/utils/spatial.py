@@ -0,0 +1,240 @@
+"""In-memory spatial index of ``cdm.host`` for point-to-station assignment"""
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from geoalchemy2 import Geometry
+from sqlalchemy import cast, func, select
+from sqlalchemy.engine import Connectable
+
+from opencdms.provider.opencdmsdb import host
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # pragma: no cover - scipy is optional
+    cKDTree = None
+
+EARTH_RADIUS_M = 6371008.8
+
+# Number of query points compared against all hosts at once when scipy is
+# not available and we fall back to brute force.
+_BRUTE_FORCE_CHUNK = 4096
+
+
+def lonlat_to_xyz(longitude, latitude) -> np.ndarray:
+    """
+    Convert arrays of longitude / latitude (degrees) to unit vectors so that
+    euclidean (chord) distance orders points like great circle distance.
+    """
+    lon = np.radians(np.asarray(longitude, dtype=float))
+    lat = np.radians(np.asarray(latitude, dtype=float))
+    cos_lat = np.cos(lat)
+    return np.column_stack(
+        (cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat))
+    )
+
+
+def chord_to_metres(chord) -> np.ndarray:
+    """Convert chord length on the unit sphere to great circle metres"""
+    chord = np.clip(np.asarray(chord, dtype=float), 0.0, 2.0)
+    return 2.0 * np.arcsin(chord / 2.0) * EARTH_RADIUS_M
+
+
+def metres_to_chord(metres: float) -> float:
+    """Convert a great circle distance in metres to chord length"""
+    angle = min(metres / EARTH_RADIUS_M, np.pi)
+    return 2.0 * np.sin(angle / 2.0)
+
+
+class HostIndex:
+    """
+    Cache of hosts with their location, elevation and WIGOS identifier,
+    answering nearest host and within radius lookups for whole coordinate
+    arrays.
+
+    Uses a KD-tree over unit sphere coordinates when scipy is installed and a
+    chunked NumPy brute force search otherwise.
+    """
+
+    def __init__(self, engine: Connectable, status_id: Optional[int] = None):
+        self.engine = engine
+        self.status_id = status_id
+        self.watermark: Optional[datetime] = None
+        self.ids = np.empty(0, dtype=object)
+        self.wigos_station_identifiers = np.empty(0, dtype=object)
+        self.elevations = np.empty(0, dtype=float)
+        self.longitudes = np.empty(0, dtype=float)
+        self.latitudes = np.empty(0, dtype=float)
+        self._xyz = np.empty((0, 3), dtype=float)
+        self._tree = None
+        self._loaded = False
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _filter(self, q):
+        q = q.where(host.c.location.isnot(None))
+        if self.status_id is not None:
+            q = q.where(host.c.status_id == self.status_id)
+        return q
+
+    def _query(self, ids: Optional[List[str]] = None):
+        location = cast(host.c.location, Geometry)
+        q = select(
+            host.c.id,
+            host.c.wigos_station_identifier,
+            host.c.elevation,
+            host.c.change_date,
+            func.ST_X(location).label("longitude"),
+            func.ST_Y(location).label("latitude"),
+        )
+        if ids is not None:
+            q = q.where(host.c.id.in_(ids))
+        return self._filter(q)
+
+    def _current(self, conn) -> Dict[str, Optional[datetime]]:
+        """id -> change_date of every host the index should hold"""
+        q = self._filter(select(host.c.id, host.c.change_date))
+        return dict(conn.execute(q).fetchall())
+
+    def _rows(self, conn, ids: Optional[List[str]] = None):
+        return conn.execute(self._query(ids)).fetchall()
+
+    def load(self) -> "HostIndex":
+        """Load every host from the database, replacing the cache"""
+        with self.engine.connect() as conn:
+            rows = self._rows(conn)
+        self.watermark = None
+        self._set_rows({}, rows)
+        self._loaded = True
+        return self
+
+    def refresh(self) -> int:
+        """
+        Reload hosts that are new or whose ``change_date`` is newer than the
+        last seen value, and drop hosts that were deleted or no longer match
+        (another status, no location). Returns the number of hosts added,
+        updated or dropped.
+        """
+        if not self._loaded:
+            self.load()
+            return len(self)
+        with self.engine.connect() as conn:
+            current = self._current(conn)
+            cached = set(self.ids)
+            changed = [
+                _id
+                for _id, change_date in current.items()
+                if _id not in cached
+                or (
+                    change_date is not None
+                    and (self.watermark is None or change_date > self.watermark)
+                )
+            ]
+            rows = self._rows(conn, changed) if changed else []
+        dropped = cached.difference(current)
+        if not changed and not dropped:
+            return 0
+        kept = {
+            _id: (
+                _id,
+                self.wigos_station_identifiers[i],
+                self.elevations[i],
+                None,
+                self.longitudes[i],
+                self.latitudes[i],
+            )
+            for i, _id in enumerate(self.ids)
+            if _id not in dropped
+        }
+        self._set_rows(kept, rows)
+        return len(changed) + len(dropped)
+
+    def _set_rows(self, current: dict, rows):
+        for row in rows:
+            if row.change_date is not None and (
+                self.watermark is None or row.change_date > self.watermark
+            ):
+                self.watermark = row.change_date
+            if row.longitude is None or row.latitude is None:
+                # Host moved to (or still has) no location, drop it
+                current.pop(row.id, None)
+                continue
+            current[row.id] = tuple(row)
+
+        values = list(current.values())
+        self.ids = np.array([v[0] for v in values], dtype=object)
+        self.wigos_station_identifiers = np.array(
+            [v[1] for v in values], dtype=object
+        )
+        self.elevations = np.array(
+            [np.nan if v[2] is None else float(v[2]) for v in values], dtype=float
+        )
+        self.longitudes = np.array([v[4] for v in values], dtype=float)
+        self.latitudes = np.array([v[5] for v in values], dtype=float)
+        self._xyz = lonlat_to_xyz(self.longitudes, self.latitudes)
+        self._tree = None
+        if cKDTree is not None and values:
+            self._tree = cKDTree(self._xyz)
+
+    def nearest(self, longitude, latitude) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Return the position in the index of the nearest host and the distance
+        in metres to it for each coordinate pair.
+        """
+        if not len(self):
+            raise ValueError("Host index is empty, call load() first")
+        points = lonlat_to_xyz(longitude, latitude)
+        if self._tree is not None:
+            chord, idx = self._tree.query(points)
+            return idx, chord_to_metres(chord)
+
+        idx = np.empty(len(points), dtype=np.intp)
+        chord = np.empty(len(points), dtype=float)
+        for start in range(0, len(points), _BRUTE_FORCE_CHUNK):
+            chunk = points[start:start + _BRUTE_FORCE_CHUNK]
+            # |a - b|^2 == 2 - 2 a.b for unit vectors
+            dist2 = 2.0 - 2.0 * chunk @ self._xyz.T
+            best = np.argmin(dist2, axis=1)
+            idx[start:start + len(chunk)] = best
+            chord[start:start + len(chunk)] = np.sqrt(
+                np.maximum(dist2[np.arange(len(chunk)), best], 0.0)
+            )
+        return idx, chord_to_metres(chord)
+
+    def nearest_host_ids(
+        self, longitude, latitude, max_distance: Optional[float] = None
+    ) -> np.ndarray:
+        """
+        Return the id of the nearest host for each coordinate pair, or None
+        where the nearest host is further than ``max_distance`` metres.
+        """
+        idx, distance = self.nearest(longitude, latitude)
+        ids = self.ids[idx]
+        if max_distance is not None:
+            ids = ids.copy()
+            ids[distance > max_distance] = None
+        return ids
+
+    def within(self, longitude, latitude, radius: float) -> List[np.ndarray]:
+        """
+        Return, for each coordinate pair, the positions in the index of all
+        hosts within ``radius`` metres.
+        """
+        points = lonlat_to_xyz(longitude, latitude)
+        if not len(self):
+            return [np.empty(0, dtype=np.intp) for _ in range(len(points))]
+        chord = metres_to_chord(radius)
+        if self._tree is not None:
+            return [
+                np.asarray(sorted(found), dtype=np.intp)
+                for found in self._tree.query_ball_point(points, chord)
+            ]
+
+        result = []
+        limit = 2.0 - chord * chord
+        for start in range(0, len(points), _BRUTE_FORCE_CHUNK):
+            chunk = points[start:start + _BRUTE_FORCE_CHUNK]
+            mask = (2.0 * chunk @ self._xyz.T) >= limit
+            result.extend(np.flatnonzero(row) for row in mask)
+        return result
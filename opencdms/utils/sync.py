@@ -0,0 +1,327 @@
+"""Incremental, resumable copy of CDM tables between two databases"""
+import io
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Dict, Iterable, Optional
+
+from sqlalchemy import Table, text
+from sqlalchemy.engine import Engine
+
+from opencdms.provider.opencdmsdb import (
+    collection,
+    host,
+    observation,
+    observer,
+    source,
+)
+from opencdms.utils.compact import (
+    COMPACT_COLUMNS,
+    ENABLED_SQL,
+    READ_EXPRESSIONS,
+    is_enabled,
+    upsert_assignments,
+)
+
+# Referenced tables come before the tables referencing them
+TABLES = [host, observer, source, collection, observation]
+
+DEFAULT_BATCH_SIZE = 50000
+
+STATE_SQL = """
+CREATE TABLE IF NOT EXISTS cdm.sync_state (
+    source_name text NOT NULL,
+    table_name text NOT NULL,
+    change_date timestamptz,
+    last_id text,
+    updated timestamptz NOT NULL DEFAULT now(),
+    PRIMARY KEY (source_name, table_name)
+);
+ALTER TABLE cdm.sync_state ADD COLUMN IF NOT EXISTS checksum text;
+"""
+
+# Keyset of tables with change_date, NULL sorting first as -infinity
+_KEY = "coalesce(change_date, CAST('-infinity' AS timestamptz))"
+
+# Index on the source matching the keyset of ``batch_sql``
+_KEYSET_INDEX_SQL = (
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS {name}_sync_keyset "
+    f"ON {{schema}}.{{name}} (({_KEY}), id)"
+)
+
+# Fingerprint of a table without change_date, to copy it again only when
+# something changed
+_CHECKSUM_SQL = (
+    "SELECT md5(coalesce(string_agg(md5(CAST(t.* AS text)), '' ORDER BY t.id), '')) "
+    "FROM {schema}.{name} AS t"
+)
+
+
+@dataclass()
+class SyncResult:
+    """Rows copied per table and batches committed by one run"""
+
+    rows: Dict[str, int] = field(default_factory=dict)
+    batches: int = 0
+
+
+def _columns(table: Table) -> str:
+    return ", ".join(f'"{c.name}"' for c in table.c)
+
+
+def _has_change_date(table: Table) -> bool:
+    return "change_date" in table.c
+
+
+def _select_list(table: Table, compacted: bool) -> str:
+    if not compacted:
+        return _columns(table)
+    # Documents rebuilt from the compact columns of the row ``o``
+    return ", ".join(
+        f'{READ_EXPRESSIONS[c.name]} AS "{c.name}"'
+        if c.name in READ_EXPRESSIONS
+        else f'o."{c.name}"'
+        for c in table.c
+    )
+
+
+def batch_sql(table: Table, compacted: bool = False) -> str:
+    """
+    Keyset paged select of the next batch, for %(change_date)s, %(last_id)s
+    and %(limit)s, following the ``keyset_index_sql`` index or, for tables
+    without ``change_date``, the primary key. ``compacted`` is whether the
+    source has compact storage enabled (``opencdms.utils.compact``), whose
+    observations are read with their documents rebuilt.
+    """
+    compacted = compacted and table is observation
+    name = f"{table.schema}.{table.name}"
+    if compacted:
+        name += " AS o"
+    if _has_change_date(table):
+        return (
+            f"SELECT {_select_list(table, compacted)} FROM {name} "
+            f"WHERE ({_KEY}, id) > (%(change_date)s::timestamptz, %(last_id)s) "
+            f"ORDER BY {_KEY}, id "
+            "LIMIT %(limit)s"
+        )
+    return (
+        f"SELECT {_columns(table)} FROM {name} "
+        "WHERE id > %(last_id)s ORDER BY id LIMIT %(limit)s"
+    )
+
+
+def last_key_sql(table: Table, compacted: bool = False) -> str:
+    """``change_date`` and id of the last row of ``batch_sql``"""
+    batch = batch_sql(table, compacted)
+    if _has_change_date(table):
+        return (
+            f"SELECT change_date, id FROM ({batch}) AS b "
+            f"ORDER BY {_KEY} DESC, id DESC LIMIT 1"
+        )
+    return f"SELECT NULL, max(id) FROM ({batch}) AS b"
+
+
+def keyset_index_sql(table: Table) -> Optional[str]:
+    """Index the source needs for ``batch_sql``, None for the primary key"""
+    if not _has_change_date(table):
+        return None
+    return _KEYSET_INDEX_SQL.format(schema=table.schema, name=table.name)
+
+
+def install_source_indexes(source_engine: Engine, tables: Iterable[Table] = TABLES):
+    """Create the keyset indexes on the source, without blocking its writes"""
+    with source_engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        for table in tables:
+            sql = keyset_index_sql(table)
+            if sql:
+                conn.execute(text(sql))
+
+
+def upsert_sql(table: Table, staging: str, compacted: bool = False) -> str:
+    """
+    Upsert staged rows. Rows with ``change_date`` only replace older rows,
+    the others only when something differs. ``compacted`` is whether the
+    target has compact storage enabled (``opencdms.utils.compact``).
+    """
+    name = f"{table.schema}.{table.name}"
+    columns = _columns(table)
+    compacted = compacted and table is observation
+    assignments = ", ".join(upsert_assignments([c.name for c in table.c], compacted))
+    if _has_change_date(table):
+        condition = (
+            "coalesce(EXCLUDED.change_date, '-infinity') "
+            ">= coalesce(t.change_date, '-infinity')"
+        )
+    else:
+        condition = "(t.*) IS DISTINCT FROM (EXCLUDED.*)"
+    return (
+        f"INSERT INTO {name} AS t ({columns}) SELECT {columns} FROM {staging} "
+        f"ON CONFLICT (id) DO UPDATE SET {assignments} WHERE {condition}"
+    )
+
+
+def _compacted(cursor) -> bool:
+    cursor.execute(ENABLED_SQL)
+    return cursor.fetchone()[0] == len(COMPACT_COLUMNS)
+
+
+def _load_state(conn, source_name: str, table: Table):
+    row = conn.execute(
+        text(
+            "SELECT change_date, last_id, checksum FROM cdm.sync_state "
+            "WHERE source_name = :source_name AND table_name = :table_name"
+        ),
+        {"source_name": source_name, "table_name": table.name},
+    ).one_or_none()
+    return (row.change_date, row.last_id, row.checksum) if row else (None, None, None)
+
+
+def _save_state(
+    cursor, source_name: str, table: Table, change_date, last_id, checksum=None
+):
+    cursor.execute(
+        "INSERT INTO cdm.sync_state "
+        "(source_name, table_name, change_date, last_id, checksum) "
+        "VALUES (%s, %s, %s, %s, %s) ON CONFLICT (source_name, table_name) DO UPDATE "
+        "SET change_date = EXCLUDED.change_date, last_id = EXCLUDED.last_id, "
+        "checksum = EXCLUDED.checksum, updated = now()",
+        (source_name, table.name, change_date, last_id, checksum),
+    )
+
+
+def _checksum(source_engine: Engine, table: Table) -> str:
+    with source_engine.connect() as conn:
+        return conn.execute(
+            text(_CHECKSUM_SQL.format(schema=table.schema, name=table.name))
+        ).scalar()
+
+
+def sync_table(
+    source_engine: Engine,
+    target_engine: Engine,
+    table: Table,
+    source_name: str,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    overlap: timedelta = timedelta(0),
+) -> SyncResult:
+    """
+    Copy rows of ``table`` changed since the stored watermark in batches.
+
+    Each batch is streamed with COPY out of the source and into a staging
+    table on the target, upserted, and committed together with the new
+    watermark, so an interrupted run continues from the last batch.
+    ``overlap`` re-reads rows just below the watermark, for rows committed
+    late with an earlier ``change_date``.
+
+    Tables without ``change_date`` are copied whole, and again only once
+    their checksum on the source has changed.
+    """
+    result = SyncResult(rows={table.name: 0})
+    with target_engine.begin() as conn:
+        conn.execute(text(STATE_SQL))
+        change_date, last_id, checksum = _load_state(conn, source_name, table)
+    if change_date is not None and overlap:
+        change_date, last_id = change_date - overlap, None
+    if not _has_change_date(table):
+        # Passes store the checksum they started from and reset last_id
+        # when complete; a table changed since starts a new pass
+        source_checksum = _checksum(source_engine, table)
+        if checksum != source_checksum:
+            checksum, last_id = source_checksum, None
+        elif last_id is None:
+            return result
+
+    source_compacted = False
+    if table is observation:
+        with source_engine.connect() as conn:
+            source_compacted = is_enabled(conn)
+    staging = f"_sync_{table.name}"
+    select = batch_sql(table, source_compacted)
+    while True:
+        source_connection = source_engine.raw_connection()
+        try:
+            with source_connection.cursor() as cursor:
+                params = {
+                    # NULL change_dates sort first, as -infinity
+                    "change_date": change_date or "-infinity",
+                    "last_id": last_id or "",
+                    "limit": batch_size,
+                }
+                # The same snapshot for the batch and its last key, whose
+                # order is the source's
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                cursor.execute(last_key_sql(table, source_compacted), params)
+                key = cursor.fetchone()
+                query = cursor.mogrify(select, params).decode()
+                buffer = io.StringIO()
+                cursor.copy_expert(f"COPY ({query}) TO STDOUT", buffer)
+            source_connection.rollback()
+        finally:
+            source_connection.close()
+        buffer.seek(0)
+
+        target_connection = target_engine.raw_connection()
+        try:
+            with target_connection.cursor() as cursor:
+                cursor.execute(
+                    f"CREATE TEMP TABLE {staging} "
+                    f"(LIKE {table.schema}.{table.name}) ON COMMIT DROP"
+                )
+                cursor.copy_expert(
+                    f"COPY {staging} ({_columns(table)}) FROM STDIN", buffer
+                )
+                cursor.execute(f"SELECT count(*) FROM {staging}")
+                count = cursor.fetchone()[0]
+                if count and key is not None:
+                    change_date, last_id = key
+                if count:
+                    compacted = table is observation and _compacted(cursor)
+                    cursor.execute(upsert_sql(table, staging, compacted))
+                done = count < batch_size
+                # A completed pass over a table without change_date starts
+                # from the beginning again once the table has changed
+                _save_state(
+                    cursor,
+                    source_name,
+                    table,
+                    change_date if _has_change_date(table) else None,
+                    None if done and not _has_change_date(table) else last_id,
+                    None if _has_change_date(table) else checksum,
+                )
+            target_connection.commit()
+        finally:
+            target_connection.close()
+
+        result.rows[table.name] += count
+        result.batches += 1
+        if done:
+            return result
+
+
+def sync(
+    source_engine: Engine,
+    target_engine: Engine,
+    source_name: str,
+    tables: Optional[Iterable[Table]] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    overlap: timedelta = timedelta(0),
+    create_indexes: bool = True,
+) -> SyncResult:
+    """
+    Synchronise ``tables`` (default ``TABLES``, in foreign key order) from
+    the source database into the target database. ``source_name`` keys the
+    watermarks, one set per source the target is fed from. The keyset
+    indexes are created on the source first, unless ``create_indexes`` is
+    false.
+    """
+    result = SyncResult()
+    tables = list(tables or TABLES)
+    if create_indexes:
+        install_source_indexes(source_engine, tables)
+    for table in tables:
+        table_result = sync_table(
+            source_engine, target_engine, table, source_name, batch_size, overlap
+        )
+        result.rows.update(table_result.rows)
+        result.batches += table_result.batches
+    return result
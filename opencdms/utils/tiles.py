@@ -0,0 +1,475 @@
+"""Mapbox Vector Tiles of hosts and observations, with a z/x/y tile cache"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import text
+
+from opencdms.utils.db import SKIP_MAINTENANCE_SQL, install_change_date_index
+
+# Columns encoded as feature attributes in each layer
+LAYERS = {
+    "observation": {
+        "table": "cdm.observation",
+        "columns": [
+            "id",
+            "host_id",
+            "observed_property_id",
+            "result_value",
+            "result_uom",
+            "phenomenon_end",
+        ],
+        "time_column": "phenomenon_end",
+        "property_column": "observed_property_id",
+    },
+    "host": {
+        "table": "cdm.host",
+        "columns": ["id", "name", "wigos_station_identifier", "elevation"],
+        "time_column": None,
+        "property_column": None,
+    },
+}
+
+DEFAULT_EXTENT = 4096
+DEFAULT_BUFFER = 64
+
+# Where observations and hosts were before they moved or were deleted, for
+# tile caches to invalidate. Entries are kept for a day.
+INSTALL_SQL = f"""
+CREATE TABLE IF NOT EXISTS cdm.tile_change (
+    id bigserial PRIMARY KEY,
+    location geography(Point, 4326) NOT NULL,
+    recorded timestamptz NOT NULL DEFAULT now()
+);
+CREATE INDEX IF NOT EXISTS tile_change_recorded ON cdm.tile_change (recorded);
+
+CREATE OR REPLACE FUNCTION cdm.record_tile_changes() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    {SKIP_MAINTENANCE_SQL}
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO cdm.tile_change (location)
+        SELECT DISTINCT o.location FROM old_rows AS o
+        WHERE o.location IS NOT NULL;
+    ELSE
+        INSERT INTO cdm.tile_change (location)
+        SELECT DISTINCT o.location
+        FROM old_rows AS o
+        JOIN new_rows AS n ON n.id = o.id
+        WHERE o.location IS NOT NULL
+          AND NOT ST_Equals(
+              CAST(o.location AS geometry),
+              coalesce(CAST(n.location AS geometry), 'POINT EMPTY')
+          );
+    END IF;
+    DELETE FROM cdm.tile_change WHERE recorded < now() - interval '1 day';
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS observation_tile_update ON cdm.observation;
+CREATE TRIGGER observation_tile_update
+    AFTER UPDATE ON cdm.observation
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION cdm.record_tile_changes();
+
+DROP TRIGGER IF EXISTS observation_tile_delete ON cdm.observation;
+CREATE TRIGGER observation_tile_delete
+    AFTER DELETE ON cdm.observation
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION cdm.record_tile_changes();
+
+DROP TRIGGER IF EXISTS host_tile_update ON cdm.host;
+CREATE TRIGGER host_tile_update
+    AFTER UPDATE ON cdm.host
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION cdm.record_tile_changes();
+
+DROP TRIGGER IF EXISTS host_tile_delete ON cdm.host;
+CREATE TRIGGER host_tile_delete
+    AFTER DELETE ON cdm.host
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION cdm.record_tile_changes();
+"""
+
+UNINSTALL_SQL = """
+DROP TRIGGER IF EXISTS observation_tile_update ON cdm.observation;
+DROP TRIGGER IF EXISTS observation_tile_delete ON cdm.observation;
+DROP TRIGGER IF EXISTS host_tile_update ON cdm.host;
+DROP TRIGGER IF EXISTS host_tile_delete ON cdm.host;
+DROP FUNCTION IF EXISTS cdm.record_tile_changes();
+DROP TABLE IF EXISTS cdm.tile_change;
+"""
+
+# Where observations and hosts changed since :since are now. Observations
+# are found through the ``change_date`` index (see ``install_indexes``).
+_CHANGED_SQL = text(
+    """
+    SELECT max(change_date) AS watermark,
+           array_agg(ST_X(CAST(location AS geometry))) AS longitude,
+           array_agg(ST_Y(CAST(location AS geometry))) AS latitude
+    FROM (
+        SELECT change_date, location FROM cdm.observation
+        WHERE change_date > :since AND location IS NOT NULL
+        UNION ALL
+        SELECT change_date, location FROM cdm.host
+        WHERE change_date > :since AND location IS NOT NULL
+    ) AS changed
+    """
+)
+
+# Where they were, recorded after the entry :since
+_MOVED_SQL = text(
+    """
+    SELECT max(id) AS change_id,
+           array_agg(ST_X(CAST(location AS geometry))) AS longitude,
+           array_agg(ST_Y(CAST(location AS geometry))) AS latitude
+    FROM cdm.tile_change
+    WHERE id > :since
+    """
+)
+
+_LAST_CHANGE_SQL = text("SELECT coalesce(max(id), 0) FROM cdm.tile_change")
+
+_LAYER_SQL = """
+SELECT ST_AsMVT(tile.*, '{name}', :extent, 'geom')
+FROM (
+    SELECT
+        ST_AsMVTGeom(
+            ST_Transform(CAST(t.location AS geometry), 3857),
+            ST_TileEnvelope(:z, :x, :y),
+            :extent,
+            :buffer
+        ) AS geom,
+        {columns}
+    FROM {table} AS t
+    WHERE t.location && CAST(
+        ST_Transform(ST_TileEnvelope(:z, :x, :y, margin => :margin), 4326)
+        AS geography
+    )
+    {filters}
+) AS tile
+WHERE tile.geom IS NOT NULL
+"""
+
+
+def layer_sql(name: str, start=None, end=None, observed_property_ids=None) -> str:
+    """SQL producing one MVT layer for tile :z/:x/:y"""
+    layer = LAYERS[name]
+    filters = []
+    if layer["time_column"]:
+        if start is not None:
+            filters.append(f"AND t.{layer['time_column']} >= :start")
+        if end is not None:
+            filters.append(f"AND t.{layer['time_column']} < :end")
+    if layer["property_column"] and observed_property_ids is not None:
+        filters.append(f"AND t.{layer['property_column']} = ANY(:observed_property_ids)")
+    columns = ", ".join(f"t.{column}" for column in layer["columns"])
+    return _LAYER_SQL.format(
+        name=name, table=layer["table"], columns=columns, filters="\n    ".join(filters)
+    )
+
+
+def install_indexes(engine):
+    """
+    Create the ``change_date`` index of ``cdm.observation`` the periodic
+    refreshes use, concurrently. Without it each refresh scans the table.
+    """
+    install_change_date_index(engine)
+
+
+def install(conn):
+    """Create the triggers recording where observations and hosts moved from"""
+    conn.execute(text(INSTALL_SQL))
+
+
+def uninstall(conn):
+    conn.execute(text(UNINSTALL_SQL))
+
+
+def render_tile(
+    conn,
+    z: int,
+    x: int,
+    y: int,
+    layers: Iterable[str] = ("host", "observation"),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    observed_property_ids: Optional[Iterable[int]] = None,
+    extent: int = DEFAULT_EXTENT,
+    buffer: int = DEFAULT_BUFFER,
+) -> bytes:
+    """
+    Render a vector tile with one layer per name in ``layers``, encoded by
+    PostGIS with ST_AsMVT. Layers are concatenated, which MVT allows.
+    """
+    params = {
+        "z": z,
+        "x": x,
+        "y": y,
+        "extent": extent,
+        "buffer": buffer,
+        "margin": buffer / extent,
+        "start": start,
+        "end": end,
+        "observed_property_ids": (
+            list(observed_property_ids) if observed_property_ids is not None else None
+        ),
+    }
+    tile = b""
+    for name in layers:
+        sql = layer_sql(name, start, end, params["observed_property_ids"])
+        data = conn.execute(text(sql), params).scalar()
+        tile += bytes(data or b"")
+    return tile
+
+
+def tiles_for_points(longitude, latitude, z: int, margin: float = 0.0) -> np.ndarray:
+    """
+    Return the unique (x, y) WebMercatorQuad tiles containing the points, or
+    containing them within ``margin`` (a fraction of the tile size) of their
+    edges, as tiles rendered with a buffer do.
+    """
+    lon = np.asarray(longitude, dtype=float)
+    lat = np.clip(np.asarray(latitude, dtype=float), -85.0511287798, 85.0511287798)
+    n = 2 ** z
+    fx = (lon + 180.0) / 360.0 * n
+    lat_rad = np.radians(lat)
+    fy = (1.0 - np.log(np.tan(lat_rad) + 1.0 / np.cos(lat_rad)) / np.pi) / 2.0 * n
+    offsets = (-margin, 0.0, margin) if margin else (0.0,)
+    xy = np.concatenate([
+        np.column_stack((np.floor(fx + dx), np.floor(fy + dy)))
+        for dx in offsets for dy in offsets
+    ]) if len(lon) else np.zeros((0, 2))
+    xy = np.clip(xy, 0, n - 1).astype(np.int64)
+    return np.unique(xy, axis=0) if len(xy) else xy
+
+
+class TileCache:
+    """
+    z/x/y cache of rendered tiles, held in memory or on disk under ``path``.
+    The least recently used tiles beyond ``max_tiles`` and tiles older than
+    ``max_age`` seconds are evicted.
+
+    Tiles are dropped by ``invalidate_points`` when observations inside their
+    extent, ``margin`` (the tile buffer over its extent) included, change.
+    ``refresh`` finds those observations from ``change_date`` (indexed by
+    ``install_indexes``), and where they were before from
+    ``cdm.tile_change`` (see ``install``).
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_tiles: int = 10000,
+        max_age: Optional[float] = None,
+        margin: float = DEFAULT_BUFFER / DEFAULT_EXTENT,
+    ):
+        self.path = path
+        self.max_tiles = max_tiles
+        self.max_age = max_age
+        self.margin = margin
+        self.watermark: Optional[datetime] = None
+        self.change_id: Optional[int] = None
+        # (z, x, y, variant) -> time written, least recently used first,
+        # with the tiles themselves in ``_tiles`` unless stored on disk
+        self._written = OrderedDict()
+        self._tiles = {}
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self._scan()
+
+    def _scan(self):
+        """Pick up tiles left on disk by a previous process"""
+        found = []
+        for root, _, files in os.walk(self.path):
+            parts = os.path.relpath(root, self.path).split(os.sep)
+            if len(parts) != 3:
+                continue
+            variant, z, x = parts
+            for name in files:
+                if name.endswith(".mvt"):
+                    key = (int(z), int(x), int(name[:-4]), variant)
+                    found.append((os.path.getmtime(os.path.join(root, name)), key))
+        for written, key in sorted(found):
+            self._written[key] = written
+        self._evict()
+
+    @staticmethod
+    def variant(*args) -> str:
+        """Short key for the layers / filters a tile was rendered with"""
+        return hashlib.md5(repr(args).encode("utf-8")).hexdigest()[:12]
+
+    def _file(self, key: Tuple[int, int, int, str]) -> str:
+        z, x, y, variant = key
+        return os.path.join(self.path, variant, str(z), str(x), f"{y}.mvt")
+
+    def get(
+        self, key: Tuple[int, int, int, str], max_age: Optional[float] = None
+    ) -> Optional[bytes]:
+        """The cached tile, None if missing or older than ``max_age`` seconds"""
+        with self._lock:
+            written = self._written.get(key)
+            if written is None:
+                return None
+            ages = [a for a in (max_age, self.max_age) if a is not None]
+            if ages and time.time() - written > min(ages):
+                self._remove(key)
+                return None
+            self._written.move_to_end(key)
+            if not self.path:
+                return self._tiles[key]
+            try:
+                with open(self._file(key), "rb") as stream:
+                    return stream.read()
+            except FileNotFoundError:
+                self._written.pop(key, None)
+                return None
+
+    def put(self, key: Tuple[int, int, int, str], tile: bytes):
+        with self._lock:
+            if self.path:
+                filename = self._file(key)
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                tmp = f"{filename}.{os.getpid()}.tmp"
+                with open(tmp, "wb") as stream:
+                    stream.write(tile)
+                os.replace(tmp, filename)
+            else:
+                self._tiles[key] = tile
+            self._written[key] = time.time()
+            self._written.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        while len(self._written) > self.max_tiles:
+            self._remove(next(iter(self._written)))
+        if self.max_age is not None:
+            oldest = time.time() - self.max_age
+            for key, written in list(self._written.items()):
+                if written < oldest:
+                    self._remove(key)
+
+    def expire(self) -> int:
+        """Evict the tiles older than ``max_age``, returning how many"""
+        with self._lock:
+            count = len(self._written)
+            self._evict()
+            return count - len(self._written)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._written):
+                self._remove(key)
+
+    def _remove(self, key):
+        if self.path:
+            try:
+                os.remove(self._file(key))
+            except FileNotFoundError:
+                pass
+        self._tiles.pop(key, None)
+        self._written.pop(key, None)
+
+    def invalidate_points(self, longitude, latitude) -> int:
+        """Drop every cached tile containing one of the points"""
+        with self._lock:
+            keys = list(self._written)
+            if not keys or not len(np.atleast_1d(longitude)):
+                return 0
+            removed = 0
+            for z in {key[0] for key in keys}:
+                stale = {
+                    tuple(xy)
+                    for xy in tiles_for_points(longitude, latitude, z, self.margin)
+                }
+                for key in keys:
+                    if key[0] == z and (key[1], key[2]) in stale:
+                        self._remove(key)
+                        removed += 1
+            return removed
+
+    def refresh(self, conn) -> int:
+        """
+        Invalidate tiles containing observations or hosts changed since the
+        last refresh, where they are now and, when ``install`` was run, where
+        they were before they moved or were deleted. The first call only
+        records the current watermarks.
+        """
+        installed = conn.execute(
+            text("SELECT to_regclass('cdm.tile_change') IS NOT NULL")
+        ).scalar()
+        if self.watermark is None:
+            self.watermark = conn.execute(
+                text(
+                    "SELECT greatest("
+                    "(SELECT max(change_date) FROM cdm.observation), "
+                    "(SELECT max(change_date) FROM cdm.host))"
+                )
+            ).scalar() or datetime.min
+            if installed:
+                self.change_id = conn.execute(_LAST_CHANGE_SQL).scalar()
+            return 0
+
+        longitude, latitude = [], []
+        row = conn.execute(_CHANGED_SQL, {"since": self.watermark}).one()
+        if row.watermark is not None:
+            self.watermark = row.watermark
+            longitude += row.longitude
+            latitude += row.latitude
+        if installed:
+            row = conn.execute(_MOVED_SQL, {"since": self.change_id or 0}).one()
+            if row.change_id is not None:
+                self.change_id = row.change_id
+                longitude += row.longitude
+                latitude += row.latitude
+        return self.invalidate_points(longitude, latitude)
+
+
+class TileService:
+    """
+    Renders tiles through a ``TileCache``, refreshing it periodically.
+
+    Tiles of a rolling window (``period`` seconds up to now) are cached
+    under the period, not its start, and rendered again once older than
+    ``window_interval`` seconds.
+    """
+
+    def __init__(
+        self,
+        engine,
+        cache: TileCache,
+        check_interval: float = 30.0,
+        window_interval: float = 60.0,
+    ):
+        self.engine = engine
+        self.cache = cache
+        self.check_interval = check_interval
+        self.window_interval = window_interval
+        self._checked = 0.0
+
+    def get_tile(
+        self, z: int, x: int, y: int, period: Optional[float] = None, **options
+    ) -> bytes:
+        if time.monotonic() - self._checked > self.check_interval:
+            with self.engine.connect() as conn:
+                self.cache.refresh(conn)
+            self.cache.expire()
+            self._checked = time.monotonic()
+        key = (z, x, y, TileCache.variant(sorted(options.items()), period))
+        tile = self.cache.get(key, self.window_interval if period else None)
+        if tile is None:
+            if period:
+                options["start"] = datetime.now(timezone.utc) - timedelta(
+                    seconds=period
+                )
+            with self.engine.connect() as conn:
+                tile = render_tile(conn, z, x, y, **options)
+            self.cache.put(key, tile)
+        return tile
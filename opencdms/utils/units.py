@@ -0,0 +1,335 @@
+"""Vectorised conversion of observation values to canonical units"""
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import Float, case, cast, func, literal, select
+
+from opencdms.provider.opencdmsdb import observation, observed_property
+
+# unit -> (dimension, factor, offset) such that
+# value_in_base_unit = value * factor + offset
+_DEFINITIONS = {
+    # temperature, base Kelvin
+    "K": ("temperature", 1.0, 0.0),
+    "degC": ("temperature", 1.0, 273.15),
+    "degF": ("temperature", 5.0 / 9.0, 273.15 - 32.0 * 5.0 / 9.0),
+    # pressure, base Pascal
+    "Pa": ("pressure", 1.0, 0.0),
+    "hPa": ("pressure", 100.0, 0.0),
+    "kPa": ("pressure", 1000.0, 0.0),
+    "bar": ("pressure", 100000.0, 0.0),
+    "mbar": ("pressure", 100.0, 0.0),
+    "mmHg": ("pressure", 133.322387415, 0.0),
+    "inHg": ("pressure", 3386.389, 0.0),
+    # length (elevation, precipitation, snow depth, visibility), base metre
+    "m": ("length", 1.0, 0.0),
+    "mm": ("length", 0.001, 0.0),
+    "cm": ("length", 0.01, 0.0),
+    "km": ("length", 1000.0, 0.0),
+    "in": ("length", 0.0254, 0.0),
+    "ft": ("length", 0.3048, 0.0),
+    # speed, base metre per second
+    "m/s": ("speed", 1.0, 0.0),
+    "km/h": ("speed", 1000.0 / 3600.0, 0.0),
+    "kn": ("speed", 1852.0 / 3600.0, 0.0),
+    "mph": ("speed", 0.44704, 0.0),
+    # dimensionless ratios, base fraction
+    "1": ("ratio", 1.0, 0.0),
+    "%": ("ratio", 0.01, 0.0),
+    # angles, base degree
+    "deg": ("angle", 1.0, 0.0),
+    "rad": ("angle", 180.0 / np.pi, 0.0),
+    # irradiance, base W m-2
+    "W/m2": ("irradiance", 1.0, 0.0),
+    "kW/m2": ("irradiance", 1000.0, 0.0),
+}
+
+# Spellings found in source data for the units above
+ALIASES = {
+    "kelvin": "K",
+    "c": "degC",
+    "°c": "degC",
+    "celsius": "degC",
+    "deg c": "degC",
+    "deg_c": "degC",
+    "f": "degF",
+    "°f": "degF",
+    "fahrenheit": "degF",
+    "pascal": "Pa",
+    "hectopascal": "hPa",
+    "mb": "mbar",
+    "millibar": "mbar",
+    "metre": "m",
+    "meter": "m",
+    "millimetre": "mm",
+    "millimeter": "mm",
+    "m s-1": "m/s",
+    "m s**-1": "m/s",
+    "ms-1": "m/s",
+    "kmh": "km/h",
+    "km h-1": "km/h",
+    "kt": "kn",
+    "knot": "kn",
+    "knots": "kn",
+    "percent": "%",
+    "degree": "deg",
+    "degrees": "deg",
+    "radian": "rad",
+    "w m-2": "W/m2",
+    "w/m^2": "W/m2",
+}
+
+
+def _spellings() -> Dict[str, str]:
+    spellings = {unit.lower(): unit for unit in _DEFINITIONS}
+    spellings.update(ALIASES)
+    return spellings
+
+
+# Lower case spelling of a unit or alias -> unit, shared by the Python and
+# SQL conversions: units are matched after trimming spaces and lower casing
+SPELLINGS = _spellings()
+
+
+class UnitConversionError(ValueError):
+    """Raised when values can not be converted between units"""
+
+
+def normalise_unit(unit: Optional[str]) -> Optional[str]:
+    """Return the canonical spelling of a unit, or the unit unchanged"""
+    if unit is None:
+        return None
+    stripped = unit.strip(" ")
+    return SPELLINGS.get(stripped.lower(), stripped)
+
+
+def _compile() -> Dict[Tuple[str, str], Tuple[float, float]]:
+    table = {}
+    for source, (dimension, f_source, o_source) in _DEFINITIONS.items():
+        for target, (other, f_target, o_target) in _DEFINITIONS.items():
+            if dimension == other:
+                table[(source, target)] = (
+                    f_source / f_target,
+                    (o_source - o_target) / f_target,
+                )
+    return table
+
+
+# (from unit, to unit) -> (factor, offset), compiled once at import time
+CONVERSIONS = _compile()
+
+
+def conversion(from_unit: str, to_unit: str) -> Tuple[float, float]:
+    """Return the (factor, offset) converting ``from_unit`` to ``to_unit``"""
+    key = (normalise_unit(from_unit), normalise_unit(to_unit))
+    if key[0] == key[1]:
+        return 1.0, 0.0
+    try:
+        return CONVERSIONS[key]
+    except KeyError:
+        raise UnitConversionError(
+            f"Can not convert from '{from_unit}' to '{to_unit}'"
+        ) from None
+
+
+def convert(values, from_units, to_units, errors: str = "raise") -> np.ndarray:
+    """
+    Convert an array of values. ``from_units`` and ``to_units`` may each be a
+    single unit or an array of units with the same length as ``values``.
+
+    Each distinct pair of units is looked up once and the conversion applied
+    to the whole array in a single multiply-add. With ``errors="nan"``
+    values that can not be converted become NaN instead of raising
+    ``UnitConversionError``.
+    """
+    values = np.asarray(values, dtype=float)
+    if np.ndim(from_units) == 0 and np.ndim(to_units) == 0:
+        try:
+            factor, offset = conversion(from_units, to_units)
+        except UnitConversionError:
+            if errors == "raise":
+                raise
+            return np.full_like(values, np.nan)
+        return values * factor + offset
+
+    from_units = np.broadcast_to(np.asarray(from_units, dtype=object), values.shape)
+    to_units = np.broadcast_to(np.asarray(to_units, dtype=object), values.shape)
+    pairs = np.char.add(
+        np.char.add(from_units.astype(str), "\x1f"), to_units.astype(str)
+    )
+    unique, inverse = np.unique(pairs, return_inverse=True)
+
+    factors = np.empty(len(unique), dtype=float)
+    offsets = np.empty(len(unique), dtype=float)
+    failed = []
+    for i, pair in enumerate(unique):
+        from_unit, to_unit = pair.split("\x1f")
+        try:
+            factors[i], offsets[i] = conversion(from_unit, to_unit)
+        except UnitConversionError:
+            factors[i], offsets[i] = np.nan, np.nan
+            failed.append((from_unit, to_unit))
+    if failed and errors == "raise":
+        raise UnitConversionError(
+            "Can not convert "
+            + ", ".join(f"'{a}' to '{b}'" for a, b in failed)
+        )
+    inverse = inverse.reshape(values.shape)
+    return values * factors[inverse] + offsets[inverse]
+
+
+def to_canonical(
+    df,
+    canonical_units: Mapping,
+    value_column: str = "result_value",
+    uom_column: str = "result_uom",
+    property_column: str = "observed_property_id",
+    errors: str = "raise",
+):
+    """
+    Return a copy of an observation DataFrame with ``value_column``
+    converted to the canonical unit of each row's observed property, as given
+    by ``canonical_units`` (observed_property id -> units).
+    """
+    df = df.copy()
+    targets = df[property_column].map(canonical_units)
+    # Rows whose property has no canonical unit are left as they are
+    targets = targets.where(targets.notna(), df[uom_column])
+    df[value_column] = convert(
+        df[value_column].to_numpy(dtype=float),
+        df[uom_column].to_numpy(dtype=object),
+        targets.to_numpy(dtype=object),
+        errors=errors,
+    )
+    df[uom_column] = targets
+    return df
+
+
+def canonical_units(conn) -> Dict[int, str]:
+    """Return observed_property id -> canonical units from the database"""
+    rows = conn.execute(
+        select(observed_property.c.id, observed_property.c.units)
+    ).fetchall()
+    return {row.id: row.units for row in rows if row.units}
+
+
+def canonical_value(value_column=None, uom_column=None, units_column=None):
+    """
+    SQL expression converting ``observation.result_value`` to the canonical
+    units in ``observed_property.units`` using the same definitions as
+    ``convert``. The query must join ``observed_property``. Values already in
+    canonical units, or of properties without canonical units, are passed
+    through and unknown conversions give NULL.
+    """
+    value_column = observation.c.result_value if value_column is None else value_column
+    uom_column = observation.c.result_uom if uom_column is None else uom_column
+    units_column = observed_property.c.units if units_column is None else units_column
+    # Empty units are no canonical units, as in ``canonical_units``
+    units_column = func.nullif(units_column, "")
+
+    source_dimension, source_factor, source_offset = _unit_cases(uom_column)
+    target_dimension, target_factor, target_offset = _unit_cases(units_column)
+    value = cast(value_column, Float)
+    return case(
+        (units_column.is_(None), value),
+        (func.trim(uom_column) == func.trim(units_column), value),
+        (
+            source_dimension == target_dimension,
+            (value * source_factor + source_offset - target_offset) / target_factor,
+        ),
+        else_=None,
+    )
+
+
+def _unit_cases(column):
+    """CASE expressions giving the dimension, factor and offset of a unit"""
+    spellings = {unit: set() for unit in _DEFINITIONS}
+    for spelling, unit in SPELLINGS.items():
+        spellings[unit].add(spelling)
+    # As ``normalise_unit``
+    lowered = func.lower(func.trim(column))
+    whens = [
+        (lowered.in_(sorted(spellings[unit])), definition)
+        for unit, definition in _DEFINITIONS.items()
+    ]
+    return tuple(
+        case(*[(when, literal(d[i])) for when, d in whens], else_=None)
+        for i in range(3)
+    )
+
+
+def select_canonical(*columns):
+    """
+    Select observations with ``result_value`` and ``result_uom`` replaced by
+    the value in canonical units and the canonical unit. Any other columns of
+    ``observation`` to return can be passed in.
+    """
+    columns = columns or [
+        c for c in observation.c if c.name not in ("result_value", "result_uom")
+    ]
+    return select(
+        *columns,
+        canonical_value().label("result_value"),
+        canonical_uom().label("result_uom"),
+    ).select_from(join_units(observation))
+
+
+def canonical_uom(uom_column=None, units_column=None):
+    """SQL expression of the units ``canonical_value`` gives values in"""
+    uom_column = observation.c.result_uom if uom_column is None else uom_column
+    units_column = observed_property.c.units if units_column is None else units_column
+    return func.coalesce(func.nullif(units_column, ""), uom_column)
+
+
+def join_units(table, properties=observed_property):
+    """``table`` (observations) outer joined with their observed properties"""
+    return table.outerjoin(
+        properties, table.c.observed_property_id == properties.c.id
+    )
+
+
+def canonical_columns(table, properties=observed_property) -> List:
+    """
+    Columns of ``table``, an observation table or alias joined by
+    ``join_units``, with ``result_value`` and ``result_uom`` in canonical units
+    """
+    value = canonical_value(
+        table.c.result_value, table.c.result_uom, properties.c.units
+    ).label("result_value")
+    uom = canonical_uom(table.c.result_uom, properties.c.units).label("result_uom")
+    return [
+        value if c.name == "result_value" else uom if c.name == "result_uom" else c
+        for c in table.c
+    ]
+
+
+def canonical_records(
+    records: Sequence[Sequence],
+    names: Sequence[str],
+    canonical_units: Mapping,
+) -> List[list]:
+    """
+    ``records`` (rows of the columns ``names``) with ``result_value`` and
+    ``result_uom`` in canonical units, converted as ``canonical_value`` does
+    """
+    value, uom, prop = (
+        names.index(name)
+        for name in ("result_value", "result_uom", "observed_property_id")
+    )
+    records = [list(record) for record in records]
+    if not records:
+        return records
+    from_units = np.array([r[uom] for r in records], dtype=object)
+    targets = np.array(
+        [canonical_units.get(r[prop]) or r[uom] for r in records], dtype=object
+    )
+    values = convert(
+        np.array([r[value] for r in records], dtype=float),
+        from_units,
+        targets,
+        errors="nan",
+    )
+    for record, converted, target in zip(records, values, targets):
+        record[value] = None if np.isnan(converted) else float(converted)
+        record[uom] = target
+    return records
@@ -22,6 +22,11 @@ test_requirements = [
     "pytest>=3",
 ]
 
+extras_requirements = {
+    # Parquet archive of old observations (opencdms.utils.archive)
+    "archive": ["pyarrow"],
+}
+
 setup(
     author="OpenCDMS",
     author_email="info@opencdms.org",
@@ -37,6 +42,7 @@ setup(
         "Programming Language :: Python :: 3.9",
     ],
     description="OpenCDMS Python package",
+    extras_require=extras_requirements,
     entry_points={
         "console_scripts": [
             "opencdms=opencdms.cli:main",
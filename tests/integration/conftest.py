@@ -0,0 +1,40 @@
+"""
+Fixtures of tests run against the CDM database (see ``make startdb``).
+Tests using them are skipped when the database is not reachable.
+"""
+import pytest
+from sqlalchemy import create_engine, insert, text
+from sqlalchemy.exc import OperationalError
+
+from opencdms.provider.opencdmsdb import host, mapper_registry, observed_property
+from opencdms.utils.db import get_cdm_connection_string
+
+
+@pytest.fixture(scope="module")
+def cdm_engine():
+    engine = create_engine(get_cdm_connection_string())
+    try:
+        engine.connect().close()
+    except OperationalError as error:
+        pytest.skip(f"CDM database is not reachable: {error.orig}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS postgis"))
+        conn.execute(text("CREATE SCHEMA IF NOT EXISTS cdm"))
+    mapper_registry.metadata.create_all(engine)
+    yield engine
+    mapper_registry.metadata.drop_all(engine)
+    engine.dispose()
+
+
+@pytest.fixture
+def cdm_conn(cdm_engine):
+    """
+    Connection in a transaction rolled back after the test, DDL included,
+    with hosts ``h1`` and ``h2`` and observed properties 1 and 2
+    """
+    with cdm_engine.connect() as conn:
+        transaction = conn.begin()
+        conn.execute(insert(host), [{"id": "h1"}, {"id": "h2"}])
+        conn.execute(insert(observed_property), [{"id": 1}, {"id": 2}])
+        yield conn
+        transaction.rollback()
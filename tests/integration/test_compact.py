@@ -0,0 +1,107 @@
+import json
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import delete, insert, select, text
+
+from opencdms.provider.opencdmsdb import host, observation
+from opencdms.utils import compact
+
+QUALITY = {"qc_flags": 4, "qc_checked": 31, "qc_failed": ["spike"]}
+
+
+@pytest.fixture
+def observations(cdm_engine):
+    with cdm_engine.begin() as conn:
+        conn.execute(insert(host), [{"id": "h1"}])
+        conn.execute(
+            insert(observation),
+            [
+                {
+                    "id": f"obs-{i:03d}",
+                    "host_id": "h1",
+                    "phenomenon_end": datetime(2020, 1, 1, tzinfo=timezone.utc),
+                    "result_quality": QUALITY if i % 2 else None,
+                    "parameter": {"height": 2} if i % 3 == 0 else None,
+                }
+                for i in range(25)
+            ],
+        )
+    yield
+    with cdm_engine.begin() as conn:
+        conn.execute(text(compact.DISABLE_SQL))
+        conn.execute(delete(observation))
+        conn.execute(delete(host))
+
+
+def _documents(conn, table):
+    return conn.execute(
+        select(table.c.id, table.c.result_quality, table.c.parameter).order_by(table.c.id)
+    ).all()
+
+
+def test_enable_and_disable_round_trip(cdm_engine, observations):
+    with cdm_engine.connect() as conn:
+        before = _documents(conn, observation)
+
+    assert compact.enable(cdm_engine, batch_size=7) == 17
+    with cdm_engine.connect() as conn:
+        assert compact.is_enabled(conn)
+        assert _documents(conn, compact.observation_compat) == before
+        stored = conn.execute(
+            text(
+                "SELECT count(*) FROM cdm.observation "
+                "WHERE result_quality IS NOT NULL OR parameter IS NOT NULL"
+            )
+        ).scalar()
+        assert stored == 0
+        assert conn.execute(text("SELECT count(*) FROM cdm.parameter_set")).scalar() == 1
+
+    assert compact.disable(cdm_engine, batch_size=7) == 17
+    with cdm_engine.connect() as conn:
+        assert not compact.is_enabled(conn)
+        assert _documents(conn, observation) == before
+
+
+def test_upserts_of_mapped_columns_keep_compacted_values(cdm_engine, observations):
+    compact.enable(cdm_engine)
+    columns = ["id", "host_id", "phenomenon_end", "result_quality", "parameter"]
+    upsert = text(
+        f"INSERT INTO cdm.observation ({', '.join(columns)}) "
+        "VALUES (:id, 'h1', :end, CAST(:quality AS jsonb), CAST(:parameter AS jsonb)) "
+        "ON CONFLICT (id) DO UPDATE SET "
+        + ", ".join(compact.upsert_assignments(columns, compacted=True))
+    )
+    passed = {"qc_flags": 0, "qc_checked": 31, "qc_failed": []}
+    end = datetime(2020, 1, 2, tzinfo=timezone.utc)
+    with cdm_engine.begin() as conn:
+        conn.execute(
+            upsert,
+            [
+                # NULL documents keep the stored ones
+                {"id": "obs-000", "end": end, "quality": None, "parameter": None},
+                {"id": "obs-001", "end": end, "quality": None, "parameter": None},
+                # New documents replace them, compacted again
+                {
+                    "id": "obs-003",
+                    "end": end,
+                    "quality": json.dumps(passed),
+                    "parameter": json.dumps({"height": 10}),
+                },
+            ],
+        )
+    with cdm_engine.connect() as conn:
+        documents = {
+            row.id: (row.result_quality, row.parameter)
+            for row in _documents(conn, compact.observation_compat)
+        }
+        stored = conn.execute(
+            text(
+                "SELECT count(*) FROM cdm.observation "
+                "WHERE result_quality IS NOT NULL OR parameter IS NOT NULL"
+            )
+        ).scalar()
+    assert documents["obs-000"] == (None, {"height": 2})
+    assert documents["obs-001"] == (QUALITY, None)
+    assert documents["obs-003"] == (passed, {"height": 10})
+    assert stored == 0
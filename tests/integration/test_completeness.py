@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import insert
+
+from opencdms.provider.opencdmsdb import observation
+from opencdms.utils.completeness import completeness, gaps
+
+START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+END = START + timedelta(hours=10)
+HOUR = timedelta(hours=1)
+
+
+def _observe(conn, hours, host_id="h1"):
+    conn.execute(
+        insert(observation),
+        [
+            {
+                "id": f"{host_id}-{hour}",
+                "host_id": host_id,
+                "observed_property_id": 1,
+                "phenomenon_end": START + hour * HOUR,
+                "result_value": 1,
+            }
+            for hour in hours
+        ],
+    )
+
+
+def _gaps(conn, **options):
+    return [
+        (row.host_id, row.gap_start, row.gap_end, row.missing)
+        for row in gaps(conn, START, END, HOUR, **options)
+    ]
+
+
+def test_leading_interior_and_trailing_gaps(cdm_conn):
+    _observe(cdm_conn, [1, 2, 5, 7])
+    assert _gaps(cdm_conn) == [
+        ("h1", START, START + HOUR, 1),
+        ("h1", START + 2 * HOUR, START + 5 * HOUR, 2),
+        ("h1", START + 5 * HOUR, START + 7 * HOUR, 1),
+        ("h1", START + 7 * HOUR, END, 2),
+    ]
+    (row,) = completeness(cdm_conn, START, END, HOUR)
+    assert (row.expected, row.missing) == (10, 6)
+
+
+def test_no_gap_when_the_first_slot_is_observed(cdm_conn):
+    _observe(cdm_conn, range(10))
+    assert _gaps(cdm_conn) == []
+
+
+def test_pairs_without_data(cdm_conn):
+    _observe(cdm_conn, range(10))
+    assert _gaps(cdm_conn, host_ids=["h1", "h2"], property_ids=[1]) == [
+        ("h2", START, END, 10),
+    ]
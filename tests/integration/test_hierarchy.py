@@ -0,0 +1,110 @@
+import pytest
+from sqlalchemy import insert, text, update
+from sqlalchemy.exc import DBAPIError
+
+from opencdms.provider.opencdmsdb import feature
+from opencdms.utils import hierarchy
+from opencdms.utils.hierarchy import ancestors, descendants, feature_closure
+
+# country > basin > river > station
+FEATURES = [
+    {"id": "station", "parent_id": "river"},
+    {"id": "river", "parent_id": "basin"},
+    {"id": "basin", "parent_id": "country"},
+    {"id": "country", "parent_id": None},
+]
+
+
+def _closure(conn):
+    c = feature_closure.c
+    return {
+        (row.ancestor_id, row.descendant_id): row.depth
+        for row in conn.execute(feature_closure.select().where(c.depth > 0))
+    }
+
+
+@pytest.fixture
+def closure_conn(cdm_engine, cdm_conn):
+    hierarchy.install_indexes(cdm_engine)
+    hierarchy.install(cdm_conn)
+    return cdm_conn
+
+
+def test_index_is_built_concurrently_and_valid(cdm_engine):
+    hierarchy.install_indexes(cdm_engine)
+    hierarchy.install_indexes(cdm_engine)
+    with cdm_engine.connect() as conn:
+        valid = conn.execute(
+            text(
+                "SELECT indisvalid FROM pg_index WHERE indexrelid = "
+                "to_regclass('cdm.observation_feature_of_interest')"
+            )
+        ).scalar()
+    assert valid is True
+
+
+def test_children_inserted_before_their_parents(closure_conn):
+    # One statement with the children first
+    closure_conn.execute(insert(feature), FEATURES)
+    assert ancestors(closure_conn, "station") == ["river", "basin", "country"]
+    assert sorted(descendants(closure_conn, "basin")) == ["basin", "river", "station"]
+    assert _closure(closure_conn)[("country", "station")] == 3
+
+
+def test_parents_set_after_the_children(closure_conn):
+    closure_conn.execute(
+        insert(feature), [{"id": f["id"], "parent_id": None} for f in FEATURES]
+    )
+    assert _closure(closure_conn) == {}
+    for f in FEATURES[:-1]:
+        closure_conn.execute(
+            update(feature).where(feature.c.id == f["id"])
+            .values(parent_id=f["parent_id"])
+        )
+    assert ancestors(closure_conn, "station") == ["river", "basin", "country"]
+
+
+def test_moving_a_subtree(closure_conn):
+    closure_conn.execute(insert(feature), FEATURES + [{"id": "sea"}])
+    closure_conn.execute(
+        update(feature).where(feature.c.id == "river").values(parent_id="sea")
+    )
+    assert ancestors(closure_conn, "station") == ["river", "sea"]
+    assert sorted(descendants(closure_conn, "basin")) == ["basin"]
+    assert sorted(descendants(closure_conn, "sea")) == ["river", "sea", "station"]
+
+    # Detached, the subtree keeps only its own links
+    closure_conn.execute(
+        update(feature).where(feature.c.id == "river").values(parent_id=None)
+    )
+    assert _closure(closure_conn) == {
+        ("country", "basin"): 1,
+        ("river", "station"): 1,
+    }
+
+
+def test_cycles_are_rejected(closure_conn):
+    closure_conn.execute(insert(feature), FEATURES)
+    savepoint = closure_conn.begin_nested()
+    with pytest.raises(DBAPIError, match="forms a cycle"):
+        closure_conn.execute(
+            update(feature).where(feature.c.id == "country")
+            .values(parent_id="station")
+        )
+    savepoint.rollback()
+
+    savepoint = closure_conn.begin_nested()
+    with pytest.raises(DBAPIError, match="forms a cycle"):
+        closure_conn.execute(
+            update(feature).where(feature.c.id == "river").values(parent_id="river")
+        )
+    savepoint.rollback()
+    assert ancestors(closure_conn, "station") == ["river", "basin", "country"]
+
+
+def test_rebuild_matches_the_triggers(closure_conn):
+    closure_conn.execute(insert(feature), FEATURES)
+    maintained = _closure(closure_conn)
+    hierarchy.rebuild(closure_conn)
+    assert _closure(closure_conn) == maintained
+    assert len(maintained) == 6
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import delete, insert, select, text, update
+
+from opencdms.provider.opencdmsdb import observation
+from opencdms.utils import latest
+from opencdms.utils.latest import latest_observation
+
+START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+def _observation(i, hours, host_id="h1", property_id=1, value=None):
+    return {
+        "id": f"obs-{i}",
+        "host_id": host_id,
+        "observed_property_id": property_id,
+        "phenomenon_end": START + timedelta(hours=hours),
+        "result_value": i if value is None else value,
+    }
+
+
+def _latest(conn):
+    return {
+        (row.host_id, row.observed_property_id): (row.observation_id, row.result_value)
+        for row in conn.execute(select(latest_observation))
+    }
+
+
+@pytest.fixture
+def installed(cdm_engine):
+    latest.install_indexes(cdm_engine)
+    with cdm_engine.begin() as conn:
+        latest.install(conn)
+    yield
+    with cdm_engine.begin() as conn:
+        latest.uninstall(conn)
+        conn.execute(delete(observation))
+
+
+def test_index_is_built_concurrently_and_valid(cdm_engine, installed):
+    with cdm_engine.connect() as conn:
+        valid = conn.execute(
+            text(
+                "SELECT indisvalid FROM pg_index WHERE indexrelid = "
+                "to_regclass('cdm.observation_host_property_end')"
+            )
+        ).scalar()
+    assert valid is True
+    # Installing again keeps the index
+    latest.install_indexes(cdm_engine)
+
+
+def test_inserts_keep_the_newest_row(cdm_conn, installed):
+    cdm_conn.execute(insert(observation), [_observation(1, 1), _observation(2, 3)])
+    # An older observation arriving late does not replace the latest one
+    cdm_conn.execute(insert(observation), [_observation(3, 2)])
+    cdm_conn.execute(insert(observation), [_observation(4, 0, host_id="h2")])
+    assert _latest(cdm_conn) == {("h1", 1): ("obs-2", 2), ("h2", 1): ("obs-4", 4)}
+
+
+def test_updates_and_deletes_fall_back_to_the_previous_row(cdm_conn, installed):
+    cdm_conn.execute(
+        insert(observation), [_observation(1, 1), _observation(2, 2), _observation(3, 3)]
+    )
+    cdm_conn.execute(
+        update(observation).where(observation.c.id == "obs-3").values(result_value=30)
+    )
+    assert _latest(cdm_conn) == {("h1", 1): ("obs-3", 30)}
+
+    # Moved back in time, the next newest row takes over
+    cdm_conn.execute(
+        update(observation).where(observation.c.id == "obs-3")
+        .values(phenomenon_end=START)
+    )
+    assert _latest(cdm_conn) == {("h1", 1): ("obs-2", 2)}
+
+    cdm_conn.execute(delete(observation).where(observation.c.id == "obs-2"))
+    assert _latest(cdm_conn) == {("h1", 1): ("obs-1", 1)}
+
+    cdm_conn.execute(delete(observation))
+    assert _latest(cdm_conn) == {}
+
+
+def test_rebuild_matches_the_triggers(cdm_conn, installed):
+    cdm_conn.execute(
+        insert(observation),
+        [_observation(1, 1), _observation(2, 5, property_id=2), _observation(3, 2)],
+    )
+    maintained = _latest(cdm_conn)
+    latest.rebuild(cdm_conn)
+    assert _latest(cdm_conn) == maintained == {
+        ("h1", 1): ("obs-3", 3),
+        ("h1", 2): ("obs-2", 2),
+    }
@@ -0,0 +1,34 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy import delete, func, select
+
+from opencdms.provider.opencdmsdb import observed_property
+from opencdms.utils.lookup import DimensionCache
+
+
+@pytest.fixture
+def properties(cdm_engine):
+    yield
+    with cdm_engine.begin() as conn:
+        conn.execute(delete(observed_property))
+
+
+def test_concurrent_creation_inserts_each_code_once(cdm_engine, properties):
+    codes = ["at", "rh", "ws", None]
+
+    def resolve(_):
+        cache = DimensionCache(cdm_engine)
+        return list(cache.resolve("observed_property", codes, create_missing=True))
+
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(resolve, range(4)))
+
+    assert all(result == results[0] for result in results)
+    assert results[0][3] is None
+    with cdm_engine.connect() as conn:
+        rows = conn.execute(
+            select(observed_property.c.short_name, func.count())
+            .group_by(observed_property.c.short_name)
+        ).fetchall()
+    assert sorted(rows) == [("at", 1), ("rh", 1), ("ws", 1)]
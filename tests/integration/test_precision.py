@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import delete, insert, select, text
+
+from opencdms.provider.opencdmsdb import host, observation, observed_property
+from opencdms.utils import changefeed, latest, precision
+
+START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def observations(cdm_engine):
+    with cdm_engine.begin() as conn:
+        conn.execute(insert(host), [{"id": "h1"}])
+        conn.execute(insert(observed_property), [{"id": 1}])
+        conn.execute(
+            insert(observation),
+            [
+                {
+                    "id": f"obs-{i:03d}",
+                    "host_id": "h1",
+                    "observed_property_id": 1,
+                    "phenomenon_end": START + timedelta(hours=i),
+                    "result_value": i + 0.5,
+                    "change_date": START,
+                }
+                for i in range(25)
+            ],
+        )
+        changefeed.install(conn)
+        latest.install(conn)
+    yield
+    with cdm_engine.begin() as conn:
+        latest.uninstall(conn)
+        changefeed.uninstall(conn)
+        conn.execute(delete(observation))
+        conn.execute(delete(observed_property))
+        conn.execute(delete(host))
+
+
+def test_backfill_pages_every_row_without_firing_triggers(cdm_engine, observations):
+    with cdm_engine.connect() as conn:
+        updated = conn.execute(
+            text("SELECT updated FROM cdm.latest_observation")
+        ).scalar()
+    with cdm_engine.connect() as listener:
+        listener.execution_options(isolation_level="AUTOCOMMIT").execute(
+            text(f"LISTEN {changefeed.CHANNEL}")
+        )
+        result = precision.migrate_column(
+            cdm_engine, "observation", "result_value", batch_size=10
+        )
+        listener.execute(text("SELECT 1"))
+        assert listener.connection.dbapi_connection.notifies == []
+
+    assert result.rows == 25
+    with cdm_engine.connect() as conn:
+        assert precision.column_type(conn, "observation", "result_value") == (
+            "double precision"
+        )
+        values = conn.execute(
+            select(observation.c.result_value).order_by(observation.c.id)
+        ).scalars().all()
+        assert [float(v) for v in values] == [i + 0.5 for i in range(25)]
+        assert conn.execute(
+            text(
+                "SELECT col_description('cdm.observation'::regclass, attnum) "
+                "FROM pg_attribute WHERE attrelid = 'cdm.observation'::regclass "
+                "AND attname = 'result_value'"
+            )
+        ).scalar() == observation.c.result_value.comment
+        assert conn.execute(
+            text("SELECT updated FROM cdm.latest_observation")
+        ).scalar() == updated
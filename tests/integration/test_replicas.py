@@ -0,0 +1,32 @@
+"""
+Run against a primary and a streaming replica, e.g. with
+CDM_DB_REPLICAS=127.0.0.1:35433 pytest tests/integration/test_replicas.py
+"""
+import pytest
+from sqlalchemy import text
+
+from opencdms.config import config
+from opencdms.utils.routing import cdm_routing_session, get_router
+
+pytestmark = pytest.mark.skipif(
+    not config.CDM_DB_REPLICAS, reason="CDM_DB_REPLICAS is not set"
+)
+
+
+def _is_replica(session):
+    return session.execute(text("SELECT pg_is_in_recovery()")).scalar()
+
+
+def test_replica_lag_is_measured():
+    router = get_router()
+    assert all(router.lag(replica) is not None for replica in router.replicas)
+
+
+def test_reads_use_replica_until_session_writes():
+    session = cdm_routing_session()
+    try:
+        assert _is_replica(session) is True
+        session.use_primary()
+        assert _is_replica(session) is False
+    finally:
+        session.close()
@@ -0,0 +1,45 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import delete, insert, update
+
+from opencdms.provider.opencdmsdb import host, record_status
+from opencdms.utils.spatial import HostIndex
+
+START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def hosts(cdm_engine):
+    with cdm_engine.begin() as conn:
+        conn.execute(insert(record_status), [{"id": 1}, {"id": 2}])
+        conn.execute(
+            insert(host),
+            [
+                {"id": "lagos", "location": "SRID=4326;POINT(3.3792 6.5244)",
+                 "status_id": 1, "change_date": START},
+                {"id": "abuja", "location": "SRID=4326;POINT(7.4951 9.0579)",
+                 "status_id": 1, "change_date": START},
+                {"id": "accra", "location": "SRID=4326;POINT(-0.187 5.6037)",
+                 "status_id": 1, "change_date": START},
+            ],
+        )
+    yield
+    with cdm_engine.begin() as conn:
+        conn.execute(delete(host))
+        conn.execute(delete(record_status))
+
+
+def test_refresh_follows_deletes_and_status_changes(cdm_engine, hosts):
+    index = HostIndex(cdm_engine, status_id=1).load()
+    assert sorted(index.ids) == ["abuja", "accra", "lagos"]
+
+    with cdm_engine.begin() as conn:
+        conn.execute(delete(host).where(host.c.id == "accra"))
+        conn.execute(
+            update(host).where(host.c.id == "abuja")
+            .values(status_id=2, change_date=START + timedelta(days=1))
+        )
+    assert index.refresh() == 2
+    assert list(index.ids) == ["lagos"]
+    assert index.nearest_host_ids([7.4], [9.1])[0] == "lagos"
@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import delete, insert, select, text, update
+
+from opencdms.provider.opencdmsdb import host, observation, observer
+from opencdms.utils import compact
+from opencdms.utils.sync import sync
+
+START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def rows(cdm_engine):
+    with cdm_engine.begin() as conn:
+        conn.execute(
+            insert(host),
+            [
+                {"id": f"h{i}", "change_date": START + timedelta(hours=i % 3) if i else None}
+                for i in range(5)
+            ],
+        )
+        conn.execute(insert(observer), [{"id": f"o{i}"} for i in range(3)])
+    yield
+    with cdm_engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS cdm.sync_state"))
+        conn.execute(delete(observer))
+        conn.execute(delete(host))
+
+
+def test_incremental_runs(cdm_engine, rows):
+    # The database is its own source, upserts leave the rows as they are
+    def run():
+        return sync(cdm_engine, cdm_engine, "self", [host, observer], batch_size=2).rows
+
+    assert run() == {"host": 5, "observer": 3}
+    assert run() == {"host": 0, "observer": 0}
+
+    with cdm_engine.begin() as conn:
+        conn.execute(
+            update(host).where(host.c.id == "h0").values(change_date=START + timedelta(days=1))
+        )
+        conn.execute(update(observer).where(observer.c.id == "o1").values(name="new"))
+    assert run() == {"host": 1, "observer": 3}
+    assert run() == {"host": 0, "observer": 0}
+
+    with cdm_engine.connect() as conn:
+        indexes = conn.execute(
+            text("SELECT indexname FROM pg_indexes WHERE indexname = 'host_sync_keyset'")
+        ).all()
+    assert len(indexes) == 1
+
+
+QUALITY = {"qc_flags": 4, "qc_checked": 31, "qc_failed": ["spike"]}
+
+
+@pytest.fixture
+def compacted(cdm_engine):
+    with cdm_engine.begin() as conn:
+        conn.execute(insert(host), [{"id": "h1", "change_date": START}])
+        conn.execute(
+            insert(observation),
+            [
+                {
+                    "id": "obs-1",
+                    "host_id": "h1",
+                    "phenomenon_end": START,
+                    "change_date": START,
+                    "result_quality": QUALITY,
+                    "parameter": {"height": 2},
+                }
+            ],
+        )
+    compact.enable(cdm_engine)
+    yield
+    with cdm_engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS cdm.sync_state"))
+        conn.execute(text(compact.DISABLE_SQL))
+        conn.execute(delete(observation))
+        conn.execute(delete(host))
+
+
+def test_compacted_observations_keep_their_documents(cdm_engine, compacted):
+    result = sync(cdm_engine, cdm_engine, "self", [host, observation])
+    assert result.rows == {"host": 1, "observation": 1}
+
+    view = compact.observation_compat
+    with cdm_engine.connect() as conn:
+        documents = conn.execute(select(view.c.result_quality, view.c.parameter)).one()
+        stored = conn.execute(
+            text("SELECT result_quality, qc_flags, qc_checked FROM cdm.observation")
+        ).one()
+    assert tuple(documents) == (QUALITY, {"height": 2})
+    assert tuple(stored) == (None, 4, 31)
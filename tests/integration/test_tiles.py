@@ -0,0 +1,49 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import delete, insert, text, update
+
+from opencdms.provider.opencdmsdb import host
+from opencdms.utils import tiles
+from opencdms.utils.tiles import TileCache
+
+START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+def test_refresh_drops_tiles_a_host_moved_from(cdm_conn):
+    tiles.install(cdm_conn)
+    cdm_conn.execute(
+        update(host).where(host.c.id == "h1")
+        .values(location="SRID=4326;POINT(-45 -30)", change_date=START)
+    )
+    cache = TileCache()
+    cache.refresh(cdm_conn)
+    cache.put((2, 1, 2, "a"), b"old")
+    cache.put((2, 2, 1, "a"), b"new")
+
+    cdm_conn.execute(
+        update(host).where(host.c.id == "h1")
+        .values(location="SRID=4326;POINT(45 30)", change_date=datetime.now(timezone.utc))
+    )
+    assert cache.refresh(cdm_conn) == 2
+    assert cache.get((2, 1, 2, "a")) is None
+    assert cache.get((2, 2, 1, "a")) is None
+
+
+def test_refresh_drops_tiles_of_deleted_hosts(cdm_conn):
+    tiles.install(cdm_conn)
+    cdm_conn.execute(insert(host), [{"id": "h3", "location": "SRID=4326;POINT(-45 -30)"}])
+    cache = TileCache()
+    cache.refresh(cdm_conn)
+    cache.put((2, 1, 2, "a"), b"tile")
+    cdm_conn.execute(delete(host).where(host.c.id == "h3"))
+    assert cache.refresh(cdm_conn) == 1
+    assert cache.get((2, 1, 2, "a")) is None
+
+
+def test_install_indexes_builds_the_change_date_index(cdm_engine):
+    tiles.install_indexes(cdm_engine)
+    tiles.install_indexes(cdm_engine)
+    with cdm_engine.connect() as conn:
+        assert conn.execute(
+            text("SELECT to_regclass('cdm.observation_change_date') IS NOT NULL")
+        ).scalar()
@@ -0,0 +1,147 @@
+import json
+import os
+from datetime import datetime
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, event
+
+from opencdms.utils import archive, export
+
+
+def test_partitions_overlapping_window(tmp_path):
+    for year, month in [(1990, 1), (1990, 2), (1991, 12)]:
+        os.makedirs(tmp_path / f"year={year}" / f"month={month:02d}")
+    os.makedirs(tmp_path / "other")
+
+    months = archive.partitions(str(tmp_path), datetime(1990, 1, 15), datetime(1990, 3, 1))
+    assert [(y, m) for y, m, _ in months] == [(1990, 1), (1990, 2)]
+    assert len(archive.partitions(str(tmp_path))) == 3
+    assert archive.partitions(str(tmp_path / "missing")) == []
+
+
+def test_write_and_read_back(tmp_path):
+    pytest.importorskip("pyarrow")
+    df = pd.DataFrame(
+        {
+            "id": ["b", "a", "c"],
+            "host_id": ["h1", "h1", "h2"],
+            "observed_property_id": [1, 1, 2],
+            "phenomenon_end": pd.to_datetime(
+                ["1990-01-02", "1990-01-01", "1990-02-01"], utc=True
+            ),
+            "result_value": [1.5, 2.5, None],
+            "result_quality": ['{"qc_flags": 0}', None, None],
+            "longitude": [1.0, 1.0, 2.0],
+            "latitude": [50.0, 50.0, 51.0],
+        }
+    )
+    for name in archive.COLUMNS:
+        if name not in df:
+            df[name] = None
+    assert len(archive.write_partitions(str(tmp_path), df)) == 2
+
+    frames = list(archive.iter_archive(str(tmp_path), end=datetime(1990, 2, 1)))
+    assert len(frames) == 1
+    assert list(frames[0]["id"]) == ["a", "b"]
+
+    rows = [row for batch in archive.iter_archive_rows(str(tmp_path), host_ids=["h2"])
+            for row in batch]
+    assert len(rows) == 1
+    row = dict(zip(archive.COLUMNS, rows[0]))
+    assert row["observed_property_id"] == 2
+    assert row["result_value"] is None
+
+
+def _frame(ids, ends, **columns):
+    df = pd.DataFrame(
+        {
+            "id": ids,
+            "host_id": ["h1"] * len(ids),
+            "observed_property_id": [1] * len(ids),
+            "phenomenon_end": pd.to_datetime(ends, utc=True),
+            "result_value": [1.5] * len(ids),
+            "longitude": [1.0] * len(ids),
+            "latitude": [50.0] * len(ids),
+            **columns,
+        }
+    )
+    for name in archive.COLUMNS:
+        if name not in df:
+            df[name] = None
+    return df
+
+
+@pytest.fixture
+def hot_db():
+    """SQLite database with a ``cdm.observation`` of ids only"""
+    engine = create_engine("sqlite://")
+
+    @event.listens_for(engine, "connect")
+    def attach(dbapi_connection, _):
+        dbapi_connection.execute("ATTACH DATABASE ':memory:' AS cdm")
+
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE cdm.observation (id TEXT PRIMARY KEY)")
+    return engine
+
+
+def test_null_json_columns_read_as_none(tmp_path):
+    pytest.importorskip("pyarrow")
+    archive.write_partitions(str(tmp_path), _frame(["a"], ["1990-01-01"]))
+    (row,) = [row for batch in archive.iter_archive_rows(str(tmp_path)) for row in batch]
+    row = dict(zip(archive.COLUMNS, row))
+    for name in archive.JSON_COLUMNS:
+        assert row[name] is None
+    assert row["result_value"] == 1.5
+
+    line = export._archived_feature(
+        [c.name for c in export.PROPERTY_COLUMNS], tuple(row.values())
+    )
+
+    def reject(constant):
+        raise ValueError(constant)
+
+    feature = json.loads(line, parse_constant=reject)
+    assert feature["properties"]["parameter"] is None
+    assert feature["geometry"]["coordinates"] == [1.0, 50.0]
+
+
+def test_same_rows_archived_twice_are_read_once(tmp_path):
+    pytest.importorskip("pyarrow")
+    df = _frame(["a", "b"], ["1990-01-01", "1990-01-02"])
+    first = archive.write_partitions(str(tmp_path), df)
+    assert archive.write_partitions(str(tmp_path), df.iloc[::-1]) == first
+    # Another batch repeating a row
+    archive.write_partitions(str(tmp_path), _frame(["b", "c"], ["1990-01-02"] * 2))
+    (frame,) = archive.iter_archive(str(tmp_path))
+    assert list(frame["id"]) == ["a", "b", "c"]
+
+
+def test_pending_files_are_hidden_until_published(tmp_path, hot_db):
+    pytest.importorskip("pyarrow")
+    root = str(tmp_path)
+    committed = archive.stage_partitions(root, _frame(["a"], ["1990-01-01"]))
+    rolled_back = archive.stage_partitions(root, _frame(["b"], ["1990-01-02"]))
+    assert list(archive.iter_archive(root)) == []
+    assert archive.pending_files(root) == sorted(committed + rolled_back)
+
+    with hot_db.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO cdm.observation VALUES ('b')")
+        assert len(archive.recover(conn, root)) == 1
+    assert archive.pending_files(root) == []
+    (frame,) = archive.iter_archive(root)
+    assert list(frame["id"]) == ["a"]
+
+
+def test_rows_still_in_the_database_are_read_from_it(tmp_path, hot_db):
+    pytest.importorskip("pyarrow")
+    archive.write_partitions(str(tmp_path), _frame(["a", "b"], ["1990-01-01"] * 2))
+    with hot_db.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO cdm.observation VALUES ('a')")
+        rows = [
+            row
+            for batch in archive.iter_archive_rows(str(tmp_path), conn=conn)
+            for row in batch
+        ]
+    assert [row[0] for row in rows] == ["b"]
@@ -0,0 +1,91 @@
+import pytest
+from sqlalchemy import Column, Integer, String, create_engine, select
+from sqlalchemy.orm import Session, declarative_base
+
+from opencdms.utils.batches import iter_chunks, run_in_chunks
+
+Base = declarative_base()
+
+
+class Reading(Base):
+    __tablename__ = "reading"
+    host_id = Column(String, primary_key=True)
+    number = Column(Integer, primary_key=True)
+    value = Column(Integer)
+
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all(
+            Reading(host_id=host, number=n, value=0)
+            for host in ("a", "b")
+            for n in range(5)
+        )
+        session.commit()
+        yield session
+
+
+def test_pages_by_key_and_releases_chunks(session):
+    seen = []
+    for chunk in iter_chunks(session, Reading, chunk_size=3):
+        seen.extend((r.host_id, r.number) for r in chunk)
+        for reading in chunk:
+            reading.value = 1
+        assert len(session.identity_map) == len(chunk)
+    assert seen == sorted(seen) and len(seen) == 10
+    assert len(session.identity_map) == 0
+    assert session.execute(select(Reading.value)).scalars().all() == [1] * 10
+
+
+def test_filters_resume_and_stats(session):
+    stats = run_in_chunks(
+        session,
+        Reading,
+        lambda chunk: None,
+        chunk_size=2,
+        where=[Reading.host_id == "b"],
+        after=("b", 0),
+        commit=True,
+        trace_memory=True,
+    )
+    assert [s.rows for s in stats] == [2, 2]
+    assert stats[-1].last_key == ("b", 4)
+    assert all(s.peak_rss > 0 and s.traced_peak is not None for s in stats)
+
+
+def test_expire_keeps_objects(session):
+    (chunk,) = iter_chunks(session, Reading, chunk_size=20, release="expire")
+    assert len(chunk) == len(session.identity_map) == 10
+    with pytest.raises(ValueError):
+        next(iter_chunks(session, Reading, release="forget"))
+
+
+def test_breaking_out_flushes_and_releases_the_chunk(session):
+    chunks = iter_chunks(session, Reading, chunk_size=3, commit=True)
+    for chunk in chunks:
+        for reading in chunk:
+            reading.value = 1
+        break
+    chunks.close()
+    assert len(session.identity_map) == 0
+    assert session.execute(select(Reading.value)).scalars().all() == [1] * 3 + [0] * 7
+    # Flushed only, the caller decides
+    session.rollback()
+    assert session.execute(select(Reading.value)).scalars().all() == [0] * 10
+
+
+def test_failing_chunk_is_released_and_not_committed(session):
+    def process(chunk):
+        for reading in chunk:
+            reading.value = 1
+        if chunk[0].host_id == "b":
+            raise RuntimeError("bad chunk")
+
+    with pytest.raises(RuntimeError):
+        run_in_chunks(session, Reading, process, chunk_size=5, commit=True)
+    assert len(session.identity_map) == 0
+    session.rollback()
+    assert session.execute(select(Reading.value)).scalars().all() == [1] * 5 + [0] * 5
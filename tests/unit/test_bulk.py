@@ -0,0 +1,58 @@
+from opencdms.utils.bulk import features_to_frame, validate_observations
+
+
+def _feature(**properties):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [3.38, 6.52]},
+        "properties": {
+            "host_id": "host",
+            "phenomenon_end": "2023-01-01T00:00:00Z",
+            "observed_property_id": 1,
+            **properties,
+        },
+    }
+
+
+def test_validate_observations_coerces_columns():
+    df, errors = validate_observations(
+        features_to_frame([_feature(result_value="1.5", result_quality={"qc": 0})])
+    )
+    assert errors == {}
+    row = df.iloc[0]
+    assert row["location"] == "SRID=4326;POINT(3.38 6.52)"
+    assert row["result_value"] == 1.5
+    assert row["result_quality"] == '{"qc": 0}'
+    assert row["version"] == 1
+    assert row["id"]
+
+
+def test_validate_observations_reports_every_row():
+    features = [
+        _feature(),
+        _feature(phenomenon_end="yesterday", colour="blue"),
+        {"type": "Feature", "geometry": None, "properties": {"host_id": "host"}},
+    ]
+    _, errors = validate_observations(features_to_frame(features))
+    assert 0 not in errors
+    assert errors[1] == ["unknown property 'colour'", "invalid datetime 'phenomenon_end'"]
+    assert "missing 'phenomenon_end'" in errors[2]
+    assert "missing point geometry" in errors[2]
+
+
+def test_validate_observations_duplicate_ids():
+    features = [_feature(), _feature()]
+    features[0]["id"] = features[1]["id"] = "same"
+    _, errors = validate_observations(features_to_frame(features))
+    assert errors == {0: ["duplicate id"], 1: ["duplicate id"]}
+
+
+def test_validate_observations_parses_json_text():
+    df, errors = validate_observations(
+        features_to_frame([
+            _feature(result_quality='{"qc_flags": 0}'),
+            _feature(parameter="{not json"),
+        ])
+    )
+    assert df.iloc[0]["result_quality"] == '{"qc_flags": 0}'
+    assert errors == {1: ["invalid JSON 'parameter'"]}
@@ -0,0 +1,30 @@
+import json
+from datetime import datetime, timezone
+
+from opencdms.utils import db
+from opencdms.utils.changefeed import coalesce, install_indexes, parse_notification
+
+
+def test_parse_and_coalesce_notifications():
+    first = json.dumps({"w": 30.0, "c": [["h1", 1, 0, 10, 2], ["h2", 1, 5, 5, 1]]})
+    second = json.dumps({"w": 40.0, "c": [["h1", 1, 20, 60, 3]]})
+    events = parse_notification(first) + parse_notification(second)
+    assert len(events) == 3
+
+    merged = {(e.host_id, e.observed_property_id): e for e in coalesce(events)}
+    assert len(merged) == 2
+    h1 = merged[("h1", 1)]
+    assert h1.start == datetime(1970, 1, 1, tzinfo=timezone.utc)
+    assert h1.end == datetime.fromtimestamp(60, tz=timezone.utc)
+    assert h1.count == 5
+    assert h1.watermark == 40.0
+    assert events[0].count == 2  # inputs are not modified
+
+
+def test_install_indexes_builds_the_change_date_index(monkeypatch):
+    built = []
+    monkeypatch.setattr(
+        db, "create_index_concurrently", lambda *args: built.append(args[1:])
+    )
+    install_indexes(None)
+    assert built == [("cdm.observation_change_date", db.CHANGE_DATE_INDEX)]
@@ -0,0 +1,51 @@
+from opencdms.utils import compact, qc
+
+
+def test_checks_in_bit_order():
+    # cdm.qc_quality_json lists failed checks by bit, as quality_json does
+    bits = list(qc.CHECKS.values())
+    assert bits == sorted(bits)
+    assert qc.quality_json(qc.RANGE | qc.SPIKE, 31)["qc_failed"] == ["range", "spike"]
+    for name, bit in qc.CHECKS.items():
+        assert f"('{name}', {bit})" in compact.ENABLE_SQL
+
+
+def test_view_keeps_observation_columns():
+    sql = compact.view_sql()
+    assert "AS result_quality" in sql and "AS parameter" in sql
+    assert [c.name for c in compact.observation_compat.c] == [
+        c.name for c in qc.observation.c
+    ]
+
+
+def test_upsert_assignments_carry_supplied_compact_columns():
+    columns = ["id", "result_quality", "qc_flags", "qc_checked", "parameter_id"]
+    assert compact.upsert_assignments(columns, compacted=True) == [
+        '"result_quality" = EXCLUDED."result_quality"',
+        '"qc_flags" = EXCLUDED."qc_flags"',
+        '"qc_checked" = EXCLUDED."qc_checked"',
+        '"parameter_id" = EXCLUDED."parameter_id"',
+    ]
+
+
+def test_upsert_assignments_of_mapped_columns_rebuild_documents():
+    columns = [c.name for c in qc.observation.c]
+    assignments = compact.upsert_assignments(columns, compacted=True)
+    assert len(assignments) == len(columns) - 1
+    # Left out, the stored values are kept unless a document replaces them
+    targets = [a.split(" = ")[0] for a in assignments]
+    assert not any(f'"{name}"' in targets for name in compact.COMPACT_COLUMNS)
+    assert (
+        '"result_quality" = coalesce(EXCLUDED.result_quality, '
+        "cdm.qc_quality_json(EXCLUDED.qc_flags, EXCLUDED.qc_checked))"
+    ) in assignments
+    assert "p.id = EXCLUDED.parameter_id" in assignments[columns.index("parameter") - 1]
+    assert compact.upsert_assignments(columns, compacted=False) == [
+        f'"{name}" = EXCLUDED."{name}"' for name in columns[1:]
+    ]
+
+
+def test_backfills_page_in_primary_key_order():
+    for sql in (compact._COMPACT_SQL, compact._EXPAND_SQL):
+        assert "WHERE id > :last_id\n    ORDER BY id\n" in sql
+        assert "COLLATE" not in sql
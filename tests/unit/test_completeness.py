@@ -0,0 +1,38 @@
+from datetime import datetime, timedelta
+
+from opencdms.utils.completeness import _GAPS, _params
+
+START = datetime(2020, 1, 1)
+END = datetime(2020, 1, 2)
+
+
+def test_params_one_frequency_for_every_property():
+    params = _params(START, END, timedelta(hours=1), ("h1", "h2"), iter([1, 2]))
+    assert params["host_ids"] == ["h1", "h2"]
+    assert params["property_ids"] == [1, 2]
+    assert params["explicit_pairs"] is True
+    assert params["default_seconds"] == 3600.0
+    assert params["freq_properties"] == params["freq_seconds"] == []
+
+
+def test_params_per_property_frequency():
+    params = _params(
+        datetime(2020, 1, 1), datetime(2020, 1, 2), {1: timedelta(minutes=10)}, None, None
+    )
+    assert params["property_ids"] == [1]
+    assert params["freq_seconds"] == [600.0]
+    assert params["default_seconds"] is None
+    assert params["explicit_pairs"] is False
+
+
+def test_params_pairs_from_data_without_both_filters():
+    params = _params(START, END, timedelta(minutes=10), ["h1"], None)
+    assert params["host_ids"] == ["h1"]
+    assert params["property_ids"] is None
+    assert params["explicit_pairs"] is False
+
+
+def test_leading_gaps_count_the_start_slot():
+    leading = _GAPS.split("-- from the window start")[1].split("UNION ALL")[0]
+    assert "floor(" in leading
+    assert ">= ps.step" in leading
@@ -0,0 +1,236 @@
+import csv
+import io
+import json
+from collections import namedtuple
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, event
+
+from opencdms.provider.opencdmsdb import observation
+from opencdms.utils import archive, export
+
+NAMES = [c.name for c in export.PROPERTY_COLUMNS]
+CsvRow = namedtuple("CsvRow", NAMES + ["longitude", "latitude"])
+FeatureRow = namedtuple("FeatureRow", NAMES + ["geometry"])
+
+END = datetime(1990, 1, 1, 6, tzinfo=timezone.utc)
+
+
+def _values(_id, **values):
+    row = dict.fromkeys(NAMES)
+    row.update(
+        id=_id, host_id="h1", observed_property_id=1, phenomenon_end=END, **values
+    )
+    return [row[name] for name in NAMES]
+
+
+def _csv_row(_id, longitude=1.0, latitude=50.0, **values):
+    return CsvRow(*_values(_id, **values), longitude, latitude)
+
+
+def _feature_row(_id, geometry='{"type":"Point","coordinates":[1,50]}', **values):
+    return FeatureRow(*_values(_id, **values), geometry)
+
+
+@pytest.fixture
+def serve(monkeypatch):
+    """Serve rows in place of the server side cursor, from the plain table"""
+    rows = []
+
+    def stream(conn, query, batch_size):
+        for i in range(0, len(rows), batch_size):
+            yield rows[i:i + batch_size]
+
+    monkeypatch.setattr(export, "source_table", lambda conn: observation)
+    monkeypatch.setattr(export, "_stream", stream)
+    return rows.extend
+
+
+def _read_csv(text):
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+def test_csv_encoding_json_and_nulls(serve, tmp_path):
+    serve(
+        [
+            _csv_row(
+                "a",
+                result_value=Decimal("1.5"),
+                comments='Ñandú, "−5 °C"\nsecond line',
+                result_quality={"qc_flags": 1, "note": "ß"},
+                parameter=[],
+            ),
+            _csv_row("b", longitude=None, latitude=None),
+        ]
+    )
+    path = str(tmp_path / "observations.csv")
+    export.export(None, path)
+    with open(path, newline="", encoding="utf-8") as stream:
+        a, b = _read_csv(stream.read())
+
+    assert list(a)[-2:] == ["longitude", "latitude"]
+    assert a["comments"] == 'Ñandú, "−5 °C"\nsecond line'
+    assert a["result_value"] == "1.5"
+    assert a["phenomenon_end"] == "1990-01-01T06:00:00+00:00"
+    assert json.loads(a["result_quality"]) == {"qc_flags": 1, "note": "ß"}
+    assert a["parameter"] == "[]"
+    assert (a["longitude"], a["latitude"]) == ("1.0", "50.0")
+    # NULL is an empty field, in JSON columns and coordinates too
+    assert b["result_value"] == b["result_quality"] == b["comments"] == ""
+    assert b["longitude"] == b["latitude"] == ""
+
+
+def test_csv_header_once_and_a_chunk_per_batch(serve):
+    serve([_csv_row(str(i)) for i in range(5)])
+    chunks = list(export.iter_csv(None, batch_size=2))
+    assert len(chunks) == 4
+    assert chunks[0].startswith("id,")
+    assert [row["id"] for row in _read_csv("".join(chunks))] == list("01234")
+
+
+def test_geojsonseq_encoding_json_and_nulls(serve):
+    serve(
+        [
+            _feature_row(
+                "a",
+                result_value=Decimal("1.5"),
+                comments="Ñandú\n°C",
+                result_quality={"qc_flags": 1, "note": "ß"},
+            ),
+            _feature_row("b", geometry=None),
+        ]
+    )
+    stream = io.StringIO()
+    export.export(None, stream, format="geojson")
+    lines = stream.getvalue().split("\n")
+    assert lines[-1] == ""
+    a, b = (json.loads(line) for line in lines[:-1])
+
+    assert a["id"] == "a"
+    assert a["geometry"] == {"type": "Point", "coordinates": [1, 50]}
+    assert a["properties"]["comments"] == "Ñandú\n°C"
+    assert a["properties"]["result_value"] == 1.5
+    assert a["properties"]["phenomenon_end"] == "1990-01-01T06:00:00+00:00"
+    assert a["properties"]["result_quality"] == {"qc_flags": 1, "note": "ß"}
+    assert b["geometry"] is None
+    assert b["properties"]["result_value"] is None
+    assert b["properties"]["result_quality"] is None
+
+
+def _archive(root, ids, **columns):
+    """Archive observations of host h1 with the given ids"""
+    df = pd.DataFrame(
+        {
+            "id": ids,
+            "host_id": ["h1"] * len(ids),
+            "observed_property_id": [1] * len(ids),
+            "phenomenon_end": pd.to_datetime(["1989-12-01"] * len(ids), utc=True),
+            "result_value": [0.5] * len(ids),
+            "result_quality": ['{"qc_flags": 2}'] * len(ids),
+            "parameter": ["{}"] * len(ids),
+            "comments": ["archivé"] * len(ids),
+            "longitude": [2.0] * len(ids),
+            "latitude": [51.0] * len(ids),
+            **columns,
+        }
+    )
+    for name in archive.COLUMNS:
+        if name not in df:
+            df[name] = None
+    archive.write_partitions(root, df)
+
+
+def test_csv_archived_rows_come_first(serve, tmp_path):
+    pytest.importorskip("pyarrow")
+    _archive(str(tmp_path), ["older", "old"])
+    serve([_csv_row("new")])
+    chunks = export.iter_csv(None, batch_size=1, archive_path=str(tmp_path))
+    rows = _read_csv("".join(chunks))
+
+    assert [row["id"] for row in rows] == ["old", "older", "new"]
+    old = rows[0]
+    assert json.loads(old["result_quality"]) == {"qc_flags": 2}
+    assert (old["longitude"], old["latitude"]) == ("2.0", "51.0")
+    assert old["comments"] == "archivé"
+    assert old["observed_property_id"] == "1"
+    assert old["phenomenon_end"] == "1989-12-01T00:00:00+00:00"
+
+
+def test_geojsonseq_archived_rows_come_first(serve, tmp_path):
+    pytest.importorskip("pyarrow")
+    _archive(str(tmp_path), ["old"])
+    serve([_feature_row("new")])
+    features = [
+        json.loads(line)
+        for chunk in export.iter_geojsonseq(None, archive_path=str(tmp_path))
+        for line in chunk.splitlines()
+    ]
+
+    assert [f["id"] for f in features] == ["old", "new"]
+    old = features[0]
+    assert old["geometry"] == {"type": "Point", "coordinates": [2.0, 51.0]}
+    assert old["properties"]["result_quality"] == {"qc_flags": 2}
+    assert old["properties"]["comments"] == "archivé"
+
+
+@pytest.fixture
+def hot_db():
+    """SQLite connection whose ``cdm.observation`` holds ids only"""
+    engine = create_engine("sqlite://")
+
+    @event.listens_for(engine, "connect")
+    def attach(dbapi_connection, _):
+        dbapi_connection.execute("ATTACH DATABASE ':memory:' AS cdm")
+
+    with engine.connect() as conn, conn.begin():
+        conn.exec_driver_sql("CREATE TABLE cdm.observation (id TEXT PRIMARY KEY)")
+        yield conn
+
+
+def _archive_with_nulls(root):
+    _archive(
+        root,
+        ["old", "moved"],
+        result_quality=[None, '{"qc_flags": 2}'],
+        parameter=[None, "{}"],
+        longitude=[None, 2.0],
+        latitude=[None, 51.0],
+    )
+
+
+def test_csv_database_rows_replace_archived_ones(serve, hot_db, tmp_path):
+    pytest.importorskip("pyarrow")
+    _archive_with_nulls(str(tmp_path))
+    # "moved" is back in the database with another value
+    hot_db.exec_driver_sql("INSERT INTO cdm.observation VALUES ('moved')")
+    serve([_csv_row("moved", result_value=Decimal("9"))])
+    rows = _read_csv("".join(export.iter_csv(hot_db, archive_path=str(tmp_path))))
+
+    assert [row["id"] for row in rows] == ["old", "moved"]
+    old, moved = rows
+    assert old["result_quality"] == old["parameter"] == ""
+    assert old["longitude"] == old["latitude"] == ""
+    assert moved["result_value"] == "9"
+
+
+def test_geojsonseq_database_rows_replace_archived_ones(serve, hot_db, tmp_path):
+    pytest.importorskip("pyarrow")
+    _archive_with_nulls(str(tmp_path))
+    hot_db.exec_driver_sql("INSERT INTO cdm.observation VALUES ('moved')")
+    serve([_feature_row("moved", result_value=Decimal("9"))])
+    lines = "".join(export.iter_geojsonseq(hot_db, archive_path=str(tmp_path)))
+
+    def reject(constant):
+        raise ValueError(constant)
+
+    old, moved = (
+        json.loads(line, parse_constant=reject) for line in lines.splitlines()
+    )
+    assert (old["id"], moved["id"]) == ("old", "moved")
+    assert old["geometry"] is None
+    assert old["properties"]["result_quality"] is None
+    assert old["properties"]["parameter"] is None
+    assert moved["properties"]["result_value"] == 9.0
@@ -0,0 +1,27 @@
+from sqlalchemy.dialects import postgresql
+
+from opencdms.utils.hierarchy import ancestors_query, under_features
+from opencdms.utils.query import ObservationQuery
+
+
+def _sql(statement):
+    return str(
+        statement.compile(
+            dialect=postgresql.dialect(), compile_kwargs={"render_postcompile": True}
+        )
+    )
+
+
+def test_observations_under_a_feature_without_recursion():
+    sql = _sql(ObservationQuery().under_features(["basin"]).statement())
+    assert "o.feature_of_interest_id IN (SELECT cdm.feature_closure.descendant_id" in sql
+    assert "cdm.feature_closure.ancestor_id IN (%(ancestor_id_1_1)s)" in sql
+    assert "RECURSIVE" not in sql
+
+
+def test_depth_limits():
+    sql = _sql(under_features("basin", max_depth=1).compile().statement)
+    assert "cdm.feature_closure.depth <= " in sql
+    sql = _sql(ancestors_query("station"))
+    assert "ORDER BY cdm.feature_closure.depth" in sql
+    assert "cdm.feature_closure.depth > " in sql
@@ -0,0 +1,104 @@
+import pytest
+from sqlalchemy import (
+    Column,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    bindparam,
+    create_engine,
+    insert,
+    select,
+)
+
+from opencdms.utils.hotqueries import HotQueryRegistry, benchmark, registry
+
+metadata = MetaData()
+reading = Table(
+    "reading", metadata, Column("host_id", String), Column("value", Integer)
+)
+
+
+def _by_host():
+    return select(reading.c.value).where(reading.c.host_id == bindparam("host_id"))
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(reading), [{"host_id": "h1", "value": 1}])
+    return engine
+
+
+def test_prepared_form_numbers_parameters():
+    query = registry["observation_window"]
+    assert query.parameters == ("host_id", "observed_property_id", "start", "end")
+    assert query.prepare_sql.startswith("PREPARE opencdms_observation_window AS SELECT")
+    assert "phenomenon_end >= $3 AND" in query.prepare_sql
+    assert query.execute_sql() == (
+        "EXECUTE opencdms_observation_window "
+        "(%(host_id)s, %(observed_property_id)s, %(start)s, %(end)s)"
+    )
+    assert "ANY ($1::VARCHAR[])" in registry["latest_observation"].prepare_sql
+
+
+def test_register_and_execute(engine):
+    hot = HotQueryRegistry()
+    hot.register("by_host", _by_host)
+    with pytest.raises(ValueError):
+        hot.register("by_host", _by_host)
+    with pytest.raises(ValueError):
+        hot.register("by host", _by_host)
+    with engine.connect() as conn:
+        assert hot.execute(conn, "by_host", host_id="h1").scalars().all() == [1]
+        with pytest.raises(TypeError):
+            hot.execute(conn, "by_host")
+        with pytest.raises(KeyError):
+            hot.execute(conn, "unknown")
+
+
+class _Dialect:
+    name = "postgresql"
+
+
+class _Connection:
+    dialect = _Dialect()
+
+    def __init__(self):
+        self.info = {}
+        self.sql = []
+
+    def exec_driver_sql(self, sql, params=None):
+        self.sql.append((sql, params))
+
+
+def test_prepares_once_per_connection():
+    hot = HotQueryRegistry()
+    hot.register("by_host", _by_host)
+    conn = _Connection()
+    hot.execute(conn, "by_host", host_id="h1")
+    hot.execute(conn, "by_host", host_id="h2", unused=1)
+    assert [sql.split()[0] for sql, _ in conn.sql] == ["PREPARE", "EXECUTE", "EXECUTE"]
+    assert conn.sql[-1] == ("EXECUTE opencdms_by_host (%(host_id)s)", {"host_id": "h2"})
+
+
+def test_benchmark(engine):
+    hot = HotQueryRegistry()
+    hot.register("by_host", _by_host)
+    results = benchmark(engine, {"by_host": {"host_id": "h1"}}, calls=5, hot=hot)
+    assert set(results["by_host"]) == {"uncached", "cached", "prepared"}
+
+
+def test_compacted_connections_read_the_compat_view():
+    query = registry["latest_observation"]
+    assert "FROM cdm.observation_compat" in query.compat.prepare_sql
+    assert "FROM cdm.observation_compat" not in query.prepare_sql
+    conn = _Connection()
+    conn.info["opencdms_compact"] = True
+    registry.execute(conn, "observation_by_id", id="x")
+    assert conn.sql[0][0].startswith("PREPARE opencdms_observation_by_id_compat AS")
+    assert conn.sql[1] == (
+        "EXECUTE opencdms_observation_by_id_compat (%(id)s)", {"id": "x"}
+    )
@@ -0,0 +1,18 @@
+from datetime import datetime, timedelta, timezone
+from uuid import UUID
+
+from opencdms.utils.ids import uuid7, uuid7_batch, uuid7_time
+
+
+def test_uuid7_layout():
+    value = UUID(uuid7())
+    assert value.version == 7
+    assert value.variant == "specified in RFC 4122"
+    assert abs(uuid7_time(value) - datetime.now(timezone.utc)) < timedelta(seconds=5)
+
+
+def test_ids_are_ordered_and_unique():
+    ids = uuid7_batch(50000) + [uuid7() for _ in range(1000)] + uuid7_batch(3)
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+    assert uuid7_batch(0) == []
@@ -0,0 +1,90 @@
+import pytest
+
+from opencdms.utils.ingest import IngestError, csv_chunks, feature_chunks, ingest
+
+
+def _feature(i):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "Point", "coordinates": [1.0, 2.0]},
+        "properties": {
+            "host_id": "h1",
+            "observed_property_id": 1,
+            "phenomenon_end": f"2020-01-01T00:{i:02d}:00Z",
+            "result_value": i,
+        },
+    }
+
+
+def test_chunks(tmp_path):
+    chunks = list(feature_chunks((_feature(i) for i in range(5)), chunk_size=2))
+    assert [len(c) for c in chunks] == [2, 2, 1]
+    assert list(chunks[0]["longitude"]) == [1.0, 1.0]
+
+    path = tmp_path / "obs.csv"
+    path.write_text("host_id,result_value\nh1,1\nh2,\n")
+    (chunk,) = csv_chunks([str(path)])
+    assert chunk["result_value"].isna().tolist() == [False, True]
+
+
+def test_writer_failure_stops_the_run():
+    # COPY is PostgreSQL only, so writing through SQLite fails
+    with pytest.raises(IngestError, match="writer failed"):
+        ingest(
+            feature_chunks((_feature(i) for i in range(10)), chunk_size=2),
+            workers=2,
+            writers=1,
+            queue_size=1,
+            db_url="sqlite://",
+            sample_interval=0.1,
+        )
+
+
+def _fake_copy(conn, df, errors, on_conflict="error"):
+    from opencdms.utils.bulk import BulkResult
+
+    ids = list(df["id"])
+    return BulkResult(ids=ids, errors=errors, written={ids[0]})
+
+
+def test_pipeline_totals(monkeypatch):
+    import multiprocessing
+
+    if multiprocessing.get_start_method() != "fork":
+        pytest.skip("patched writer needs fork")
+    monkeypatch.setattr("opencdms.utils.ingest.copy_observations", _fake_copy)
+    result = ingest(
+        feature_chunks((_feature(i) for i in range(10)), chunk_size=3),
+        workers=2,
+        writers=2,
+        queue_size=1,
+        db_url="sqlite://",
+        sample_interval=0.05,
+    )
+    assert result.rows_read == 10
+    assert result.stages["worker"].chunks == 4
+    assert result.stages["writer"].chunks == 4
+    assert result.rows_written == 4
+    assert result.rows_rejected == 6
+
+
+def test_csv_round_trip_keeps_json_documents(tmp_path):
+    import csv
+    import json
+
+    from opencdms.utils.bulk import validate_observations
+    from opencdms.utils.export import _csv_value
+
+    path = tmp_path / "export.csv"
+    with open(path, "w", newline="") as stream:
+        writer = csv.writer(stream)
+        writer.writerow(["host_id", "observed_property_id", "phenomenon_end",
+                         "result_quality", "parameter", "longitude", "latitude"])
+        writer.writerow([_csv_value(v) for v in [
+            "h1", 1, "2020-01-01T00:00:00+00:00", {"qc_flags": 0}, None, 1.0, 2.0
+        ]])
+    (chunk,) = csv_chunks([str(path)])
+    df, errors = validate_observations(chunk)
+    assert errors == {}
+    assert json.loads(df.iloc[0]["result_quality"]) == {"qc_flags": 0}
+    assert df.iloc[0]["parameter"] is None
@@ -0,0 +1,19 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy.dialects import postgresql
+
+from opencdms.utils.hotqueries import registry
+from opencdms.utils.latest import current_conditions_query
+
+
+def test_current_conditions_query():
+    now = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    sql = str(
+        current_conditions_query(
+            observed_property_ids=[1], bbox=(0, 50, 2, 52), max_age=timedelta(hours=3), now=now
+        ).compile(dialect=postgresql.dialect())
+    )
+    assert "FROM cdm.latest_observation" in sql
+    assert "cdm.latest_observation.location && CAST(ST_MakeEnvelope(" in sql
+    assert "cdm.latest_observation.phenomenon_end >=" in sql
+    assert "FROM cdm.latest_observation" in registry["current_conditions"].prepare_sql
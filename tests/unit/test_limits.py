@@ -0,0 +1,113 @@
+import pytest
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine, insert, select
+from sqlalchemy.exc import OperationalError
+
+from opencdms.config import config
+from opencdms.utils import limits
+from opencdms.utils.limits import (
+    Limits,
+    QueryTimeoutError,
+    RowLimitError,
+    clamp_limit,
+    fetch_limited,
+    install,
+    limits_for,
+    operation,
+)
+
+metadata = MetaData()
+number = Table("number", metadata, Column("value", Integer))
+
+
+@pytest.fixture
+def engine():
+    engine = install(create_engine("sqlite://"))
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(number), [{"value": i} for i in range(10)])
+    return engine
+
+
+def test_limits_from_config(monkeypatch):
+    monkeypatch.setattr(config, "CDM_DB_STATEMENT_TIMEOUT", 30.0)
+    monkeypatch.setattr(config, "CDM_DB_OPERATION_TIMEOUTS", "export=0, query=5")
+    monkeypatch.setattr(config, "CDM_DB_MAX_ROWS", 100)
+    assert limits_for("query") == Limits(5.0, 5.0, 100)
+    assert limits_for("export").statement_timeout is None
+    assert limits_for("other").statement_timeout == 30.0
+
+
+def test_statement_timeout_never_passes_the_deadline():
+    op = limits.Operation("query", Limits(statement_timeout=10, deadline=2))
+    assert 1 <= op.statement_timeout_ms() <= 2000
+    assert limits.Operation("query", Limits()).statement_timeout_ms() == 0
+
+
+def test_row_limit(engine):
+    with engine.connect() as conn:
+        assert len(fetch_limited(conn, select(number), 10)) == 10
+        with pytest.raises(RowLimitError):
+            fetch_limited(conn, select(number), 9)
+        with operation("query", Limits(max_rows=5)):
+            assert clamp_limit(10) == 5
+            with pytest.raises(RowLimitError):
+                fetch_limited(conn, select(number))
+
+
+class _Canceled(Exception):
+    pgcode = limits.QUERY_CANCELED
+
+
+def test_cancelled_queries_raise_timeout_errors(engine):
+    with pytest.raises(QueryTimeoutError, match="statement timeout"):
+        with operation("query", Limits(statement_timeout=1)):
+            raise OperationalError("SELECT 1", {}, _Canceled())
+    with pytest.raises(OperationalError):
+        with operation("query", Limits(statement_timeout=1)):
+            raise OperationalError("SELECT 1", {}, Exception())
+
+
+def test_deadline_cancels_registered_backends(monkeypatch):
+    cancelled = []
+    monkeypatch.setattr(limits, "_cancel", lambda url, pid: cancelled.append(pid))
+    with operation("query", Limits(deadline=0.01)) as op:
+        op.register("postgresql://", 42)
+        op._timer.join()
+    assert op.cancelled and cancelled == [42]
+    # Backends starting after the deadline are cancelled right away
+    op.register("postgresql://", 43)
+    assert cancelled == [42, 43]
+
+
+class _Cursor:
+    def __init__(self, statements):
+        self.statements = statements
+
+    def execute(self, sql, params):
+        self.statements.append(params)
+
+    def fetchone(self):
+        return (None, 7)
+
+    def close(self):
+        pass
+
+
+def _postgresql_connection(statements):
+    from types import SimpleNamespace
+
+    return SimpleNamespace(
+        dialect=SimpleNamespace(name="postgresql"),
+        connection=SimpleNamespace(cursor=lambda: _Cursor(statements)),
+        engine=SimpleNamespace(url="postgresql://"),
+    )
+
+
+def test_timeouts_only_apply_inside_operations(monkeypatch):
+    monkeypatch.setattr(config, "CDM_DB_STATEMENT_TIMEOUT", 30.0)
+    statements = []
+    limits._on_begin(_postgresql_connection(statements))
+    assert statements == []
+    with operation("query", Limits(statement_timeout=5)):
+        limits._on_begin(_postgresql_connection(statements))
+    assert statements == [("5000",)]
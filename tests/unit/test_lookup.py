@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from opencdms.utils.lookup import DimensionCache, UnresolvedCodesError
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = DimensionCache(engine=None)
+    mapping = {"at": 1, "": 2}
+    created = []
+
+    def create(dimension, codes):
+        created.append(codes)
+        mapping.update({code: 10 + i for i, code in enumerate(codes)})
+        return mapping
+
+    monkeypatch.setattr(cache, "codes", lambda dimension: mapping)
+    monkeypatch.setattr(cache, "create", create)
+    cache.created = created
+    return cache
+
+
+def test_none_and_empty_codes_differ(cache):
+    ids = cache.resolve("observed_property", ["at", None, "", "at"])
+    assert list(ids) == [1, None, 2, 1]
+
+
+def test_unknown_codes_reported_together(cache):
+    with pytest.raises(UnresolvedCodesError) as excinfo:
+        cache.resolve("observed_property", ["rh", "at", "ws", None])
+    assert excinfo.value.codes == ["rh", "ws"]
+
+
+def test_missing_codes_created_once(cache):
+    ids = cache.resolve(
+        "observed_property", np.array([["rh", "at"], ["rh", None]], dtype=object),
+        create_missing=True,
+    )
+    assert ids.tolist() == [[10, 1], [10, None]]
+    assert cache.created == [["rh"]]
@@ -0,0 +1,95 @@
+import numpy as np
+from sqlalchemy.dialects import postgresql
+
+from opencdms.utils import normals
+
+
+def _sql(statement):
+    return str(statement.compile(dialect=postgresql.dialect()))
+
+
+def test_monthly_normals_skip_incomplete_months_and_years():
+    # Series 0: 25 days of January in each of three years, means 1, 2, 3
+    # Series 1: one year only
+    series, years, index, values = [], [], [], []
+    for year, value in zip((2000, 2001, 2002), (1.0, 2.0, 3.0)):
+        series += [0] * 25
+        years += [year] * 25
+        index += [1] * 25
+        values += [value] * 25
+    # Too few days in February 2000
+    series += [0] * 5
+    years += [2000] * 5
+    index += [2] * 5
+    values += [9.0] * 5
+    series += [1] * 25
+    years += [2000] * 25
+    index += [1] * 25
+    values += [5.0] * 25
+    found, indexes, mean, std, count = normals.compute_normals(
+        np.array(series), np.array(years), np.array(index), np.array(values),
+        period="month", min_years=2,
+    )
+    assert list(found) == [0]
+    assert list(indexes) == [1]
+    assert mean[0] == 2.0
+    assert std[0] == 1.0
+    assert count[0] == 3
+
+
+def test_daily_normals_across_series():
+    found, indexes, mean, std, count = normals.compute_normals(
+        np.array([0, 0, 1, 1, 1]),
+        np.array([2000, 2001, 2000, 2001, 2000]),
+        np.array([10, 10, 10, 10, 11]),
+        np.array([1.0, 3.0, 4.0, 6.0, 7.0]),
+        period="day", min_years=1,
+    )
+    assert list(zip(found, indexes)) == [(0, 10), (1, 10), (1, 11)]
+    assert list(mean) == [2.0, 5.0, 7.0]
+    assert np.isnan(std[2])
+    assert list(count) == [2, 2, 1]
+
+
+def test_default_min_years():
+    assert normals.default_min_years((1991, 2020)) == 24
+
+
+def test_anomalies_join_normals_on_their_key():
+    sql = _sql(normals.anomalies_query(period="day", host_ids=["a"]))
+    assert "JOIN cdm.climate_normal ON" in sql
+    assert "make_date(%(make_date_1)s" in sql
+    assert "EXTRACT(doy FROM" in sql
+    assert "AS standardized_anomaly" in sql
+
+
+def test_daily_means_are_aggregated_in_the_database():
+    sql = _sql(normals.daily_means_query(["a"], period="month"))
+    assert "avg(d.value)" in sql
+    assert "GROUP BY d.host_id, d.observed_property_id, d.day" in sql
+
+
+def test_leap_days_do_not_count_as_extra_years():
+    # 28 and 29 February 2000 share day 59 with 28 February 2001
+    found, indexes, mean, std, count = normals.compute_normals(
+        np.array([0, 0, 0]),
+        np.array([2000, 2000, 2001]),
+        np.array([59, 59, 59]),
+        np.array([1.0, 3.0, 5.0]),
+        period="day", min_years=2,
+    )
+    assert list(count) == [2]
+    assert list(mean) == [3.5]
+    found, *_ = normals.compute_normals(
+        np.array([0, 0, 0]),
+        np.array([2000, 2000, 2001]),
+        np.array([59, 59, 59]),
+        np.array([1.0, 3.0, 5.0]),
+        period="day", min_years=3,
+    )
+    assert len(found) == 0
+
+
+def test_day_of_year_means_are_one_per_year_in_the_database():
+    sql = _sql(normals.daily_means_query(["a"], period="day"))
+    assert "GROUP BY m.host_id, m.observed_property_id, m.year, m.period_index" in sql
@@ -0,0 +1,31 @@
+from sqlalchemy import Numeric
+
+from opencdms.provider.opencdmsdb import host, observation
+from opencdms.utils import precision
+
+
+def test_columns_exist_and_default_to_numeric():
+    tables = {"observation": observation, "host": host}
+    for table, column in precision.COLUMNS:
+        if table in tables:
+            assert isinstance(tables[table].c[column].type, Numeric)
+
+
+def test_swap_replaces_column_with_shadow():
+    shadow, function = precision._names("observation", "result_value")
+    sql = precision._SWAP_SQL.format(
+        table="observation", column="result_value", shadow=shadow, function=function
+    )
+    assert "DROP COLUMN result_value;" in sql
+    assert sql.index(f"COMMENT ON COLUMN cdm.observation.{shadow}") < sql.index(
+        "DROP COLUMN"
+    )
+    assert f"RENAME COLUMN {shadow} TO result_value" in sql
+
+
+def test_backfill_pages_in_primary_key_order():
+    sql = precision._BACKFILL_SQL.format(
+        table="observation", column="result_value", shadow="s", function="f"
+    )
+    assert "WHERE id > :last_id\n    ORDER BY id\n" in sql
+    assert "COLLATE" not in sql
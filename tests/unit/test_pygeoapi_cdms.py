@@ -129,4 +129,29 @@ def test_get_not_existing_item_raise_exception(config):
     """Testing query for a not existing object"""
     p = CDMSProvider(config)
     with pytest.raises(ProviderItemNotFoundError):
-        p.get("2329039")
\ No newline at end of file
+        p.get("2329039")
+
+
+@pytest.mark.parametrize('select_properties', [
+    [], ['comments', 'host_id', 'result_value', 'phenomenon_end']
+])
+def test_sql_features_match_python_features(config, select_properties):
+    """Test features built by PostgreSQL match those built in Python"""
+    expected = CDMSProvider(config).query(
+        limit=15, select_properties=select_properties
+    )
+    result = CDMSProvider({**config, 'sql_features': True}).query(
+        limit=15, select_properties=select_properties
+    )
+    assert result['type'] == 'FeatureCollection'
+    assert len(result['features']) == len(expected['features']) == 15
+    for feature, expected_feature in zip(result['features'],
+                                         expected['features']):
+        geometry = feature.pop('geometry')
+        expected_geometry = expected_feature.pop('geometry')
+        assert feature == expected_feature
+        assert geometry['type'] == expected_geometry['type']
+        # ST_AsGeoJSON writes at most 15 decimals
+        assert geometry['coordinates'] == pytest.approx(
+            list(expected_geometry['coordinates']), abs=1e-15
+        )
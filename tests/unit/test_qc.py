@@ -0,0 +1,83 @@
+import numpy as np
+
+from opencdms.utils import qc
+
+
+def test_range_step_spike_persistence():
+    values = np.array([10.0, 11.0, 30.0, 12.0, 12.0, 12.0, 12.0, -80.0])
+    config = qc.QCConfig(
+        observed_property_id=1,
+        min_value=-50,
+        max_value=50,
+        max_step=10,
+        spike_threshold=10,
+        persistence_count=4,
+    )
+    flags = qc.run_checks(values, config)
+    assert flags[0] == 0
+    assert flags[2] == qc.STEP | qc.SPIKE
+    assert flags[3] & qc.STEP
+    assert all(flags[3:7] & qc.PERSISTENCE)
+    assert flags[7] & qc.RANGE
+
+
+def test_consistency_check_matches_coincident_times():
+    times = np.array([0.0, 60.0, 120.0])
+    dew_point = np.array([5.0, 12.0, 7.0])
+    air_temperature_times = np.array([0.0, 60.0])
+    air_temperature = np.array([10.0, 11.0])
+    failed = qc.consistency_check(
+        times, dew_point, air_temperature_times, air_temperature, "<="
+    )
+    assert list(failed) == [False, True, False]
+
+
+def test_flag_station_groups_by_property():
+    property_ids = np.array([1, 1, 1, 2, 2, 2])
+    times = np.array([0.0, 60.0, 120.0, 0.0, 60.0, 120.0])
+    values = np.array([10.0, 11.0, 99.0, 5.0, 12.0, 7.0])
+    configs = {1: qc.QCConfig(observed_property_id=1, max_value=50)}
+    rules = [qc.ConsistencyRule(observed_property_id=2, other_property_id=1)]
+    flags = qc.flag_station(property_ids, times, values, configs, rules)
+    assert list(flags) == [0, 0, qc.RANGE, 0, qc.CONSISTENCY, 0]
+
+
+def test_write_quality_updates_in_batches():
+    from types import SimpleNamespace
+
+    from sqlalchemy.dialects import postgresql
+
+    statements = []
+    conn = SimpleNamespace(execute=statements.append)
+    documents = [qc.quality_json(0, qc.RANGE)] * 3
+    qc.write_quality(conn, np.array(["a", "b", "c"]), documents, batch_size=2)
+    assert len(statements) == 2
+    sql = str(statements[1].compile(dialect=postgresql.dialect()))
+    assert sql.startswith("UPDATE cdm.observation SET result_quality=")
+    assert ") AS qc (id, result_quality) WHERE cdm.observation.id = qc.id" in sql
+
+
+def test_quality_json():
+    document = qc.quality_json(qc.RANGE | qc.SPIKE, qc.RANGE | qc.SPIKE | qc.STEP)
+    assert document["qc_failed"] == ["range", "spike"]
+    assert document["qc_checked"] == 7
+
+
+def test_rule_only_properties_are_checked():
+    configs = {1: qc.QCConfig(observed_property_id=1, max_value=50)}
+    rules = [qc.ConsistencyRule(observed_property_id=2, other_property_id=1)]
+    assert qc.checked_masks(configs, rules) == {1: qc.RANGE, 2: qc.CONSISTENCY}
+
+
+def test_write_quality_merges_documents():
+    from types import SimpleNamespace
+
+    from sqlalchemy.dialects import postgresql
+
+    statements = []
+    conn = SimpleNamespace(execute=statements.append)
+    qc.write_quality(conn, np.array(["a", "b", "c"]), [{"qc_flags": 0}] * 3, batch_size=2)
+    assert len(statements) == 2
+    sql = str(statements[0].compile(dialect=postgresql.dialect()))
+    assert "coalesce(cdm.observation.result_quality" in sql
+    assert "|| CAST(qc.result_quality AS JSONB)" in sql
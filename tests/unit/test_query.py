@@ -0,0 +1,122 @@
+import warnings
+from datetime import date, datetime, timezone
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from opencdms.utils.query import (
+    ExplainGuard,
+    ObservationQuery,
+    SequentialScanError,
+    check_plan,
+    sequential_scans,
+)
+
+
+def _sql(query):
+    return str(
+        query.statement().compile(
+            dialect=postgresql.dialect(), compile_kwargs={"render_postcompile": True}
+        )
+    )
+
+
+def test_filters_compare_bare_columns():
+    query = (
+        ObservationQuery()
+        .between(date(2020, 1, 1), datetime(2021, 1, 1))
+        .hosts(["h1", "h2"])
+        .properties([1])
+        .limit(10)
+    )
+    assert query.start == datetime(2020, 1, 1, tzinfo=timezone.utc)
+    sql = _sql(query)
+    assert "o.phenomenon_end >= %(phenomenon_end_1)s" in sql
+    assert "o.host_id IN (%(host_id_1_1)s, %(host_id_1_2)s)" in sql
+    assert "o.observed_property_id IN" in sql
+    assert "LIMIT" in sql
+
+
+def test_filters_are_typed():
+    with pytest.raises(TypeError):
+        ObservationQuery().between("2020-01-01")
+    with pytest.raises(TypeError):
+        ObservationQuery().properties(["1"])
+    with pytest.raises(TypeError):
+        ObservationQuery().hosts("h1")
+    with pytest.raises(ValueError):
+        ObservationQuery().failed_check("nonsense")
+
+
+def test_spatial_filters_keep_geography_column_uncast():
+    sql = _sql(ObservationQuery().bbox(-2, 51, 0, 53).near(-1.5, 52, 1000))
+    assert "o.location && CAST(ST_MakeEnvelope(" in sql
+    assert "ST_DWithin(o.location, CAST(" in sql
+
+
+def test_qc_filters_by_storage_mode():
+    query = ObservationQuery().passed_qc().failed_check("spike")
+    sql = _sql(query)
+    assert sql.count("o.result_quality @>") == 2
+    compact = _sql(ObservationQuery(compact=True).failed_check("spike", "step"))
+    assert "(o.qc_flags & %(param_1)s) = %(param_2)s" in compact
+    assert "o.qc_flags IS NULL AND o.result_quality @>" in compact
+    assert "cdm.qc_quality_json(o.qc_flags, o.qc_checked)) AS result_quality" in compact
+
+
+PLAN = {
+    "Node Type": "Limit",
+    "Plan Rows": 10,
+    "Plans": [
+        {
+            "Node Type": "Seq Scan",
+            "Schema": "cdm",
+            "Relation Name": "observation",
+            "Plan Rows": 500,
+        },
+        {"Node Type": "Index Scan", "Relation Name": "host", "Plan Rows": 1},
+    ],
+}
+
+
+class _Result:
+    def __init__(self, value):
+        self.value = value
+
+    def scalar(self):
+        return self.value
+
+    def fetchall(self):
+        return self.value
+
+
+class _Connection:
+    dialect = postgresql.dialect()
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def exec_driver_sql(self, sql, params):
+        assert sql.startswith("EXPLAIN (FORMAT JSON, VERBOSE) SELECT")
+        return _Result([{"Plan": PLAN}])
+
+    def execute(self, statement, params):
+        return _Result([(name, self.rows) for name in params["names"]])
+
+
+def test_sequential_scans():
+    assert sequential_scans(PLAN) == [("cdm.observation", 500)]
+
+
+def test_guard_uses_table_size():
+    statement = ObservationQuery().statement()
+    assert check_plan(_Connection(100), statement, ExplainGuard(max_rows=1000)) == []
+    with pytest.raises(SequentialScanError):
+        check_plan(_Connection(10 ** 7), statement, ExplainGuard(max_rows=1000))
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        offending = check_plan(
+            _Connection(10 ** 7), statement, ExplainGuard(max_rows=1000, action="warn")
+        )
+    assert offending == [("cdm.observation", 10 ** 7)]
+    assert "cdm.observation" in str(caught[0].message)
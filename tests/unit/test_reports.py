@@ -0,0 +1,19 @@
+from sqlalchemy.dialects import postgresql
+
+from opencdms.utils.reports import _column_name, report_query
+
+
+def test_column_names():
+    assert _column_name("Air Temp (2m)", 3) == "air_temp_2m"
+    assert _column_name(None, 3) == "property_3"
+
+
+def test_pivot_is_conditional_aggregation():
+    sql = str(
+        report_query({1: "at", 2: "rh"}, host_ids=["h1"]).compile(
+            dialect=postgresql.dialect()
+        )
+    )
+    assert sql.count("FILTER (WHERE cdm.observation.observed_property_id =") == 2
+    assert "GROUP BY cdm.observation.report_id, cdm.observation.host_id" in sql
+    assert "AS at" in sql and "AS rh" in sql
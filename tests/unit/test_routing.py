@@ -0,0 +1,123 @@
+import pytest
+from sqlalchemy import (
+    Column,
+    MetaData,
+    String,
+    Table,
+    create_engine,
+    insert,
+    select,
+    text,
+)
+from sqlalchemy.pool import QueuePool
+
+from opencdms.utils.routing import ReplicaRouter, cdm_routing_session
+
+metadata = MetaData()
+node = Table("node", metadata, Column("name", String))
+
+
+def _engine(path, name):
+    engine = create_engine(f"sqlite:///{path}", poolclass=QueuePool)
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(node).values(name=name))
+    return engine
+
+
+@pytest.fixture
+def engines(tmp_path):
+    return (
+        _engine(tmp_path / "primary.db", "primary"),
+        _engine(tmp_path / "replica1.db", "replica1"),
+        _engine(tmp_path / "replica2.db", "replica2"),
+    )
+
+
+def _names(session):
+    return sorted(session.execute(select(node.c.name)).scalars())
+
+
+def test_reads_go_to_replicas_round_robin(engines):
+    primary, *replicas = engines
+    router = ReplicaRouter(primary, replicas)
+    assert _names(cdm_routing_session(router)) == ["replica1"]
+    assert _names(cdm_routing_session(router)) == ["replica2"]
+    assert _names(cdm_routing_session(router)) == ["replica1"]
+
+
+def test_session_reads_its_own_writes(engines):
+    primary, *replicas = engines
+    session = cdm_routing_session(ReplicaRouter(primary, replicas))
+    assert _names(session) == ["replica1"]
+    session.execute(insert(node).values(name="new"))
+    assert _names(session) == ["new", "primary"]
+    session.commit()
+    assert _names(session) == ["new", "primary"]
+    session.close()
+    assert _names(session) == ["replica2"]
+
+
+def test_text_writes_go_to_the_primary(engines):
+    primary, *replicas = engines
+    session = cdm_routing_session(ReplicaRouter(primary, replicas))
+    assert session.execute(text("SELECT name FROM node")).scalar() == "replica1"
+    session.execute(text("UPDATE node SET name = 'updated'"))
+    assert _names(session) == ["updated"]
+    session.commit()
+    session.close()
+    with primary.connect() as conn:
+        assert conn.execute(select(node.c.name)).scalar() == "updated"
+    assert _names(session) == ["replica2"]
+
+
+def test_text_reads_that_lock_go_to_the_primary():
+    from opencdms.utils.routing import _writes
+
+    assert not _writes(text("  select 1"))
+    assert not _writes(text("SHOW server_version"))
+    assert _writes(text("SELECT * FROM node FOR UPDATE"))
+    assert _writes(text("select * from node\nfor no key update"))
+    assert _writes(text("WITH d AS (DELETE FROM node RETURNING *) SELECT 1"))
+    assert not _writes(text("SELECT for_update FROM node"))
+
+
+def test_falls_back_to_primary_when_replicas_lag(engines):
+    primary, *replicas = engines
+    router = ReplicaRouter(primary, replicas, max_lag=-1)
+    assert router.reader() is primary
+
+
+def test_least_load(engines):
+    primary, *replicas = engines
+    router = ReplicaRouter(primary, replicas, strategy="least_load")
+    with replicas[0].connect():
+        assert router.reader() is replicas[1]
+
+
+def test_lag_checks_run_outside_the_lock(engines):
+    from contextlib import nullcontext
+
+    primary, replica, _ = engines
+    locked = []
+
+    def connect():
+        locked.append(router._lock.locked())
+        return nullcontext()
+
+    class Probe:
+        dialect = replica.dialect
+        pool = replica.pool
+
+    probe = Probe()
+    probe.connect = connect
+    router = ReplicaRouter(primary, [probe])
+    assert router.reader() is probe
+    assert router.reader() is probe  # lag cached for check_interval
+    assert locked == [False]
+
+
+def test_idle_primary_is_no_lag():
+    from opencdms.utils.routing import _LAG_SQL
+
+    assert "pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0" in str(_LAG_SQL)
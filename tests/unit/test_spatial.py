@@ -0,0 +1,110 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from opencdms.utils import spatial
+from opencdms.utils.spatial import HostIndex
+
+Row = namedtuple(
+    "Row",
+    ["id", "wigos_station_identifier", "elevation", "change_date", "longitude", "latitude"],
+)
+
+NOW = datetime(2023, 1, 1)
+
+HOSTS = [
+    Row("lagos", "0-20000-0-65201", 38, NOW, 3.3792, 6.5244),
+    Row("abuja", "0-20000-0-65125", 476, NOW, 7.4951, 9.0579),
+    Row("boston", "0-20000-0-72509", 6, NOW - timedelta(days=1), -71.0589, 42.3601),
+]
+
+
+def _index(rows=HOSTS):
+    index = HostIndex(engine=None)
+    index._set_rows({}, rows)
+    return index
+
+
+def test_nearest_host_ids():
+    index = _index()
+    ids = index.nearest_host_ids([3.4, 7.4, -70.0], [6.5, 9.1, 42.0])
+    assert list(ids) == ["lagos", "abuja", "boston"]
+    assert index.watermark == NOW
+
+
+def test_nearest_respects_max_distance():
+    index = _index()
+    ids = index.nearest_host_ids([3.4, 0.0], [6.5, 0.0], max_distance=50000)
+    assert list(ids) == ["lagos", None]
+
+
+def test_within_radius():
+    index = _index()
+    found = index.within([5.0, -71.0], [8.0, 42.0], radius=400000)
+    assert sorted(index.ids[found[0]]) == ["abuja", "lagos"]
+    assert list(index.ids[found[1]]) == ["boston"]
+
+
+def test_brute_force_search(monkeypatch):
+    monkeypatch.setattr(spatial, "cKDTree", None)
+    index = _index()
+    idx, distance = index.nearest([3.3792], [6.5244])
+    assert index.ids[idx[0]] == "lagos"
+    assert np.isclose(distance[0], 0.0, atol=1.0)
+
+
+def test_incremental_rows_replace_and_drop():
+    index = _index()
+    later = NOW + timedelta(hours=1)
+    index._set_rows(
+        {_id: row for _id, row in zip(index.ids, HOSTS)},
+        [
+            Row("lagos", "0-20000-0-65201", 38, later, 0.0, 0.0),
+            Row("boston", None, None, later, None, None),
+        ],
+    )
+    assert sorted(index.ids) == ["abuja", "lagos"]
+    assert index.watermark == later
+    assert index.nearest_host_ids([0.1], [0.1])[0] == "lagos"
+
+
+class _Database:
+    """Hosts to serve through ``HostIndex._current`` and ``_rows``"""
+
+    def __init__(self, rows):
+        self.hosts = {row.id: row for row in rows}
+
+    def connect(self):
+        from contextlib import nullcontext
+
+        return nullcontext()
+
+    def install(self, index, monkeypatch):
+        monkeypatch.setattr(
+            index, "_current",
+            lambda conn: {_id: row.change_date for _id, row in self.hosts.items()},
+        )
+        monkeypatch.setattr(
+            index, "_rows",
+            lambda conn, ids=None: [self.hosts[_id] for _id in ids or self.hosts],
+        )
+
+
+def test_refresh_drops_deleted_and_filtered_hosts(monkeypatch):
+    database = _Database(HOSTS)
+    index = HostIndex(engine=database)
+    database.install(index, monkeypatch)
+    assert index.refresh() == 3
+    assert index.refresh() == 0
+
+    later = NOW + timedelta(hours=1)
+    # Deleted, or no longer matching the status / location filter
+    del database.hosts["boston"]
+    database.hosts["lagos"] = Row("lagos", "0-20000-0-65201", 38, later, 0.0, 0.0)
+    # Added without a change_date
+    database.hosts["accra"] = Row("accra", None, 61, None, -0.187, 5.6037)
+    assert index.refresh() == 3
+    assert sorted(index.ids) == ["abuja", "accra", "lagos"]
+    assert index.nearest_host_ids([0.1], [0.1])[0] == "lagos"
+    assert index.refresh() == 0
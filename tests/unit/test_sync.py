@@ -0,0 +1,43 @@
+from opencdms.provider.opencdmsdb import host, observation, observer
+from opencdms.utils.sync import TABLES, batch_sql, upsert_sql
+
+
+def test_tables_in_foreign_key_order():
+    names = [t.name for t in TABLES]
+    for table in TABLES:
+        for fk in table.foreign_keys:
+            target = fk.column.table.name
+            if target in names and target != table.name:
+                assert names.index(target) < names.index(table.name)
+
+
+def test_keyset_by_change_date_when_available():
+    assert "coalesce(change_date, CAST('-infinity' AS timestamptz))" in batch_sql(host)
+    assert "change_date" not in batch_sql(observer)
+
+
+def test_upsert_keeps_newer_target_rows():
+    sql = upsert_sql(host, "_sync_host")
+    assert "ON CONFLICT (id) DO UPDATE" in sql
+    assert ">= coalesce(t.change_date, '-infinity')" in sql
+    assert "IS DISTINCT FROM" in upsert_sql(observer, "_sync_observer")
+
+
+def test_keysets_follow_an_index():
+    from opencdms.utils.sync import keyset_index_sql, last_key_sql
+
+    key = "coalesce(change_date, CAST('-infinity' AS timestamptz))"
+    assert f"WHERE ({key}, id) >" in batch_sql(host)
+    assert f"ON cdm.host (({key}), id)" in keyset_index_sql(host)
+    assert "WHERE id > %(last_id)s ORDER BY id" in batch_sql(observer)
+    assert keyset_index_sql(observer) is None
+    assert "COLLATE" not in batch_sql(host) + last_key_sql(host)
+
+
+def test_compacted_source_observations_are_read_with_their_documents():
+    sql = batch_sql(observation, compacted=True)
+    assert "FROM cdm.observation AS o WHERE" in sql
+    assert 'cdm.qc_quality_json(o.qc_flags, o.qc_checked)) AS "result_quality"' in sql
+    assert 'WHERE p.id = o.parameter_id)) AS "parameter"' in sql
+    assert "o.qc_flags" not in batch_sql(observation)
+    assert batch_sql(host, compacted=True) == batch_sql(host)
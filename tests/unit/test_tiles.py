@@ -0,0 +1,81 @@
+from opencdms.utils.tiles import TileCache, layer_sql, tiles_for_points
+
+
+def test_tiles_for_points():
+    tiles = tiles_for_points([0.1, 0.2, -71.06], [0.1, 0.1, 42.36], 2)
+    assert [tuple(t) for t in tiles] == [(1, 1), (2, 1)]
+
+
+def test_layer_sql_filters_observations_only():
+    sql = layer_sql("observation", start=1, observed_property_ids=[1])
+    assert "phenomenon_end >= :start" in sql
+    assert "observed_property_id = ANY(:observed_property_ids)" in sql
+    assert ":start" not in layer_sql("host", start=1)
+
+
+def test_memory_cache_invalidation():
+    cache = TileCache(max_tiles=2)
+    cache.put((2, 2, 1, "a"), b"tile")
+    cache.put((2, 0, 1, "a"), b"other")
+    assert cache.invalidate_points([0.1], [0.1]) == 1
+    assert cache.get((2, 2, 1, "a")) is None
+    assert cache.get((2, 0, 1, "a")) == b"other"
+    cache.put((3, 0, 0, "a"), b"1")
+    cache.put((3, 1, 0, "a"), b"2")
+    assert cache.get((2, 0, 1, "a")) is None  # evicted
+
+
+def test_disk_cache_survives_restart(tmp_path):
+    TileCache(str(tmp_path)).put((2, 1, 2, "a"), b"tile")
+    cache = TileCache(str(tmp_path))
+    assert cache.get((2, 1, 2, "a")) == b"tile"
+    assert cache.invalidate_points([-45.0], [-30.0]) == 1
+    assert cache.get((2, 1, 2, "a")) is None
+
+
+def test_points_in_the_buffer_of_neighbouring_tiles():
+    # On the edge between tiles (1, 1) and (2, 1) of zoom 2
+    assert [tuple(t) for t in tiles_for_points([0.01], [45.0], 2)] == [(2, 1)]
+    tiles = tiles_for_points([0.01], [45.0], 2, margin=64 / 4096)
+    assert [tuple(t) for t in tiles] == [(1, 1), (2, 1)]
+
+
+def test_disk_cache_eviction(tmp_path, monkeypatch):
+    import time
+
+    cache = TileCache(str(tmp_path), max_tiles=2)
+    for x in range(3):
+        cache.put((2, x, 0, "a"), b"tile")
+    assert cache.get((2, 0, 0, "a")) is None
+    assert not (tmp_path / "a" / "2" / "0" / "0.mvt").exists()
+    assert cache.get((2, 2, 0, "a")) == b"tile"
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 120)
+    assert cache.get((2, 2, 0, "a"), max_age=60) is None
+    cache.max_age = 60
+    assert cache.expire() == 1
+    assert not list(tmp_path.rglob("*.mvt"))
+
+
+def test_rolling_window_tiles_share_a_key(monkeypatch):
+    from contextlib import nullcontext
+
+    from opencdms.utils import tiles
+
+    starts = []
+
+    def render(conn, z, x, y, start=None, **options):
+        starts.append(start)
+        return b"tile"
+
+    monkeypatch.setattr(tiles, "render_tile", render)
+    engine = type("Engine", (), {"connect": lambda self: nullcontext()})()
+    service = tiles.TileService(engine, TileCache(), check_interval=1e9)
+    service._checked = float("inf")
+    for _ in range(2):
+        assert service.get_tile(1, 0, 0, period=3600, layers=("host",)) == b"tile"
+    assert len(starts) == 1 and starts[0] is not None
+    service.window_interval = 0
+    service.get_tile(1, 0, 0, period=3600, layers=("host",))
+    assert len(starts) == 2
@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from opencdms.utils.units import UnitConversionError, convert, to_canonical
+
+
+def test_convert_scalar_units():
+    assert np.allclose(convert([0, 100], "degC", "K"), [273.15, 373.15])
+    assert np.allclose(convert([1013.25], "hPa", "Pa"), [101325])
+
+
+def test_convert_mixed_units_and_aliases():
+    values = convert([32, 212, 10], ["degF", "Fahrenheit", "kelvin"], "degC")
+    assert np.allclose(values, [0, 100, -263.15])
+
+
+def test_convert_reports_every_failed_pair():
+    with pytest.raises(UnitConversionError) as excinfo:
+        convert([1, 2, 3], ["hPa", "mm", "furlong"], ["Pa", "K", "m"])
+    assert "'mm' to 'K'" in str(excinfo.value)
+    assert "'furlong' to 'm'" in str(excinfo.value)
+
+
+def test_convert_errors_nan():
+    values = convert([1, 2], ["hPa", "mm"], ["Pa", "K"], errors="nan")
+    assert values[0] == 100
+    assert np.isnan(values[1])
+
+
+def test_to_canonical_dataframe():
+    df = pd.DataFrame(
+        {
+            "result_value": [10.0, 25.4, 3.0],
+            "result_uom": ["kt", "mm", "%"],
+            "observed_property_id": [1, 2, 3],
+        }
+    )
+    result = to_canonical(df, {1: "m/s", 2: "in"})
+    assert np.allclose(result["result_value"], [10 * 1852 / 3600, 1.0, 3.0])
+    assert list(result["result_uom"]) == ["m/s", "in", "%"]
+
+
+UNITS = [
+    # (result_uom, observed_property.units)
+    ("degC", "K"),
+    (" DEGC ", "K"),
+    ("°C", "degF"),
+    ("HPA", "Pa"),
+    ("Knots", "m/s"),
+    ("furlong", "furlong"),
+    ("furlong ", "furlong"),
+    ("Furlong", "furlong"),
+    ("mm", "K"),
+    (None, "K"),
+    ("mm", None),
+    ("mm", ""),
+]
+
+
+@pytest.fixture
+def units_db():
+    """SQLite database with the unit columns of observations and properties"""
+    from sqlalchemy import create_engine, event
+
+    engine = create_engine("sqlite://")
+
+    @event.listens_for(engine, "connect")
+    def attach(dbapi_connection, _):
+        dbapi_connection.execute("ATTACH DATABASE ':memory:' AS cdm")
+
+    with engine.begin() as conn:
+        conn.exec_driver_sql(
+            "CREATE TABLE cdm.observed_property (id INTEGER PRIMARY KEY, units TEXT)"
+        )
+        conn.exec_driver_sql(
+            "CREATE TABLE cdm.observation (id TEXT PRIMARY KEY, "
+            "observed_property_id INTEGER, result_value FLOAT, result_uom TEXT)"
+        )
+        for i, (uom, units) in enumerate(UNITS):
+            conn.exec_driver_sql(
+                "INSERT INTO cdm.observed_property VALUES (?, ?)", (i, units)
+            )
+            conn.exec_driver_sql(
+                "INSERT INTO cdm.observation VALUES (?, ?, ?, ?)",
+                (f"{i:02d}", i, 10.0, uom),
+            )
+    return engine
+
+
+def test_sql_and_python_conversions_agree(units_db):
+    from opencdms.provider.opencdmsdb import observation
+    from opencdms.utils.units import canonical_records, select_canonical
+
+    with units_db.connect() as conn:
+        rows = conn.execute(
+            select_canonical(observation.c.id).order_by(observation.c.id)
+        ).fetchall()
+    records = canonical_records(
+        [[10.0, uom, i] for i, (uom, _) in enumerate(UNITS)],
+        ["result_value", "result_uom", "observed_property_id"],
+        {i: units for i, (_, units) in enumerate(UNITS) if units},
+    )
+    for row, record in zip(rows, records):
+        assert row.result_uom == record[1]
+        if record[0] is None:
+            assert row.result_value is None, row
+        else:
+            assert row.result_value == pytest.approx(record[0]), row
+    assert [r[0] is None for r in records] == [
+        False, False, False, False, False, False, False, True, True, True, False, False
+    ]
+
+
+def test_normalise_unit_trims_spaces_and_case():
+    from opencdms.utils.units import normalise_unit
+
+    assert normalise_unit(" HPA ") == "hPa"
+    assert normalise_unit("Kelvin") == "K"
+    assert normalise_unit("furlong ") == "furlong"
+
+
+def test_query_in_canonical_units():
+    from sqlalchemy.dialects import postgresql
+
+    from opencdms.utils.query import ObservationQuery
+
+    sql = str(
+        ObservationQuery().in_canonical_units().statement()
+        .compile(dialect=postgresql.dialect())
+    )
+    assert "LEFT OUTER JOIN cdm.observed_property AS p" in sql
+    assert "coalesce(nullif(p.units" in sql
+    assert "JOIN" not in str(
+        ObservationQuery().statement().compile(dialect=postgresql.dialect())
+    )